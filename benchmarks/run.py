@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""
+Stitches benchmarks against a local in-process SSH server
+
+Usage:
+    python benchmarks/run.py [-o results.json] [-c baseline.json] [-n 50]
+                             [--only NAME,...]
+
+Results are written as JSON: {"meta": {...}, "results": {name: stats}},
+every stats dict has 'unit', 'samples', 'min', 'median', 'mean' and 'max'
+(lower is better for seconds, higher is better for MB/s). With -c the
+results are compared to a previous run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import paramiko
+
+from sshserver import SSHServer
+from stitches import Connection, Expect, ReplayConnection, Structure
+
+MEGABYTE = 1024 * 1024
+
+
+def _stats(samples, unit):
+    """ Summarize samples """
+    ordered = sorted(samples)
+    return {'unit': unit,
+            'samples': len(ordered),
+            'min': ordered[0],
+            'median': ordered[len(ordered) // 2],
+            'mean': sum(ordered) / len(ordered),
+            'max': ordered[-1]}
+
+
+def _timed(func, count):
+    """ Run func count times, return list of durations """
+    samples = []
+    for _ in range(count):
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return samples
+
+
+class Benchmarks(object):
+    """
+    Benchmark cases, every method named bench_* is a case
+    """
+    def __init__(self, server, key_filename, count):
+        self.server = server
+        self.key_filename = key_filename
+        self.count = count
+        self.tmpdir = tempfile.mkdtemp(prefix='stitches-bench-')
+
+    def instance(self):
+        """ Instance dict pointing to the local server """
+        return {'private_hostname': '127.0.0.1', 'public_hostname': '127.0.0.1',
+                'port': self.server.port, 'key_filename': self.key_filename}
+
+    def connection(self):
+        """ Connected connection """
+        connection = Connection(self.instance())
+        connection.connect()
+        return connection
+
+    def close(self):
+        """ Remove temporary files """
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def bench_connect(self):
+        """ Connection setup (handshake and authentication) """
+        def connect():
+            self.connection().disconnect()
+        return _stats(_timed(connect, self.count), 's')
+
+    def bench_exec_latency(self):
+        """ recv_exit_status of a trivial command """
+        connection = self.connection()
+        samples = _timed(lambda: connection.recv_exit_status('true'), self.count)
+        connection.disconnect()
+        return _stats(samples, 's')
+
+    def bench_output_throughput(self):
+        """ Streaming of large command output """
+        connection = self.connection()
+        size = 64 * MEGABYTE
+
+        def run():
+            assert connection.recv_exit_status('head -c %i /dev/zero' % size, 60) == 0
+        samples = _timed(run, max(1, self.count // 10))
+        connection.disconnect()
+        return _stats([size / MEGABYTE / sample for sample in samples], 'MB/s')
+
+    def bench_batch_latency(self):
+        """ Per-command latency of run_batch with 50 trivial commands """
+        connection = self.connection()
+        samples = _timed(lambda: connection.run_batch(['true'] * 50), max(1, self.count // 10))
+        connection.disconnect()
+        return _stats([sample / 50 for sample in samples], 's')
+
+    def bench_ping_pong(self):
+        """ Expect.ping_pong round-trip on an interactive channel """
+        connection = self.connection()
+        connection.channel
+        counter = [0]
+
+        def ping_pong():
+            counter[0] += 1
+            Expect.ping_pong(connection, 'echo pong%i' % counter[0],
+                             re.escape('\npong%i' % counter[0]))
+        samples = _timed(ping_pong, self.count)
+        connection.disconnect()
+        return _stats(samples, 's')
+
+    def bench_sftp_put(self):
+        """ SFTP upload rate """
+        connection = self.connection()
+        size = 32 * MEGABYTE
+        source = os.path.join(self.tmpdir, 'put-source')
+        with open(source, 'wb') as fd:
+            fd.write(os.urandom(size))
+        target = os.path.join(self.tmpdir, 'put-target')
+        samples = _timed(lambda: connection.sftp.put(source, target), max(1, self.count // 10))
+        connection.disconnect()
+        return _stats([size / MEGABYTE / sample for sample in samples], 'MB/s')
+
+    def bench_sftp_get(self):
+        """ SFTP download rate """
+        connection = self.connection()
+        size = 32 * MEGABYTE
+        source = os.path.join(self.tmpdir, 'get-source')
+        with open(source, 'wb') as fd:
+            fd.write(os.urandom(size))
+        target = os.path.join(self.tmpdir, 'get-target')
+        samples = _timed(lambda: connection.sftp.get(source, target), max(1, self.count // 10))
+        connection.disconnect()
+        return _stats([size / MEGABYTE / sample for sample in samples], 'MB/s')
+
+    def bench_put_tree(self):
+        """ put_tree of 1000 small files """
+        connection = self.connection()
+        source = os.path.join(self.tmpdir, 'tree-source')
+        for idx in range(1000):
+            subdir = os.path.join(source, str(idx % 10))
+            if not os.path.isdir(subdir):
+                os.makedirs(subdir)
+            with open(os.path.join(subdir, str(idx)), 'wb') as fd:
+                fd.write(os.urandom(1024))
+        targets = iter(range(1000000))
+        samples = _timed(lambda: connection.put_tree(source, os.path.join(self.tmpdir, 'tree-%i' % next(targets))),
+                         max(1, self.count // 10))
+        connection.disconnect()
+        return _stats(samples, 's')
+
+    def bench_replay(self):
+        """ Replay of a recorded (gzip compressed) session of 20 commands """
+        path = os.path.join(self.tmpdir, 'session.jsonl.gz')
+        commands = ['echo line%i; echo err%i >&2; exit %i' % (idx, idx, idx % 3) for idx in range(20)]
+        connection = Connection(self.instance(), record=path)
+        recorded = [connection.run(command) for command in commands]
+        # the session file is complete without closing the recorder
+        connection.disconnect()
+
+        def replay():
+            replayed = ReplayConnection(path)
+            for result in recorded:
+                res = replayed.run(result.command)
+                assert (res.status, res.stdout, res.stderr) == (result.status, result.stdout, result.stderr)
+            replayed.disconnect()
+        samples = _timed(replay, max(1, self.count // 10))
+        connection.recorder.close()
+        return _stats(samples, 's')
+
+    def bench_fanout(self):
+        """ Structure.run of a trivial command on 1..64 hosts """
+        results = {}
+        for hosts in (1, 4, 16, 64):
+            structure = Structure()
+            for _ in range(hosts):
+                structure.add_instance('BENCH', self.instance())
+            structure.connect_all()
+
+            def run():
+                assert not [res for res in structure.run('true', workers=hosts) if res.failed]
+            results['fanout_%i' % hosts] = _stats(_timed(run, max(1, self.count // 10)), 's')
+            structure.disconnect_all()
+        return results
+
+
+def compare(results, baseline):
+    """ Print comparison of results' medians to baseline """
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        new, old = results[name]['median'], baseline[name]['median']
+        if results[name]['unit'] == 's':
+            change = old / new if new else float('inf')
+        else:
+            change = new / old if old else float('inf')
+        print('%-24s %12.6g -> %12.6g %-5s (%.2fx %s)' % (name, old, new, results[name]['unit'], change,
+                                                          'better' if change >= 1 else 'worse'))
+
+
+def main():
+    """ Run benchmarks """
+    parser = argparse.ArgumentParser(description='Stitches benchmarks')
+    parser.add_argument('-o', '--output', help='write JSON results to file')
+    parser.add_argument('-c', '--compare', help='compare to JSON results of a previous run')
+    parser.add_argument('-n', '--count', type=int, default=50, help='iterations per case')
+    parser.add_argument('--only', help='comma separated list of cases to run')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='stitches-bench-key-')
+    key_filename = os.path.join(tmpdir, 'id_rsa')
+    paramiko.RSAKey.generate(2048).write_private_key_file(key_filename)
+    server = SSHServer()
+    benchmarks = Benchmarks(server, key_filename, args.count)
+    only = args.only.split(',') if args.only else None
+    results = {}
+    try:
+        for name in sorted(dir(benchmarks)):
+            if not name.startswith('bench_') or (only and name[6:] not in only):
+                continue
+            result = getattr(benchmarks, name)()
+            if 'unit' in result:
+                result = {name[6:]: result}
+            for case, stats in sorted(result.items()):
+                print('%-24s median %12.6g %s' % (case, stats['median'], stats['unit']))
+            results.update(result)
+    finally:
+        benchmarks.close()
+        server.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    output = {'meta': {'python': platform.python_version(),
+                       'paramiko': paramiko.__version__,
+                       'platform': platform.platform(),
+                       'count': args.count,
+                       'time': time.time()},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(output, fd, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(results, json.load(fd)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Local in-process SSH server stand-in for benchmarks
+
+Accepts any user and key, runs exec requests with /bin/sh, shell requests
+with an interactive /bin/sh on a pty (prompt is 'username@localhost$ ') and
+serves the local filesystem over SFTP.
+"""
+
+import fcntl
+import os
+import pty
+import select
+import socket
+import subprocess
+import termios
+import threading
+
+import paramiko
+
+from stitches.mux import ServerTransport
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    """ SFTP handle backed by a local file """
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    """ SFTP server serving local filesystem """
+    def list_folder(self, path):
+        try:
+            out = []
+            for fname in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, fname)))
+                attr.filename = fname
+                out.append(attr)
+            return out
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            binary_flag = getattr(os, 'O_BINARY', 0)
+            flags |= binary_flag
+            mode = getattr(attr, 'st_mode', None) or 0o666
+            fd = os.open(path, flags, mode)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        if flags & os.O_WRONLY:
+            fstr = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fstr = 'rb'
+        fobj = os.fdopen(fd, fstr)
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = fobj
+        handle.writefile = fobj
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+
+class _Interface(paramiko.ServerInterface):
+    """ Accept everybody, run everything locally """
+    def __init__(self):
+        self.username = None
+        self.pty = {}
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        self.username = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        self.username = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        self.pty[channel.get_id()] = True
+        return True
+
+    def check_channel_window_change_request(self, channel, width, height,
+                                            pixelwidth, pixelheight):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self._spawn(channel, ['/bin/sh', '-c', command.decode()])
+        return True
+
+    def check_channel_shell_request(self, channel):
+        env = dict(os.environ, PS1='%s@localhost$ ' % self.username)
+        self._spawn(channel, ['/bin/sh', '-i'], env=env, use_pty=True)
+        return True
+
+    def _spawn(self, channel, argv, env=None, use_pty=False):
+        """ Start a local process attached to the channel """
+        channel.stitches_replied = threading.Event()
+        if use_pty or self.pty.get(channel.get_id()):
+            master, slave = pty.openpty()
+            proc = subprocess.Popen(argv, stdin=slave, stdout=slave,
+                                    stderr=slave, env=env,
+                                    preexec_fn=_controlling_tty, close_fds=True)
+            os.close(slave)
+            outputs = [(master, channel.sendall)]
+            write, close = (lambda data: os.write(master, data)), None
+        else:
+            proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, env=env)
+            outputs = [(proc.stdout.fileno(), channel.sendall),
+                       (proc.stderr.fileno(), channel.sendall_stderr)]
+            write, close = proc.stdin.write, proc.stdin.close
+            master = None
+        thread = threading.Thread(target=_pump,
+                                  args=(channel, proc, outputs, write, close, master))
+        thread.daemon = True
+        thread.start()
+
+
+def _controlling_tty():
+    """ Make the pty the controlling terminal (Ctrl-C interrupts like with sshd) """
+    os.setsid()
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+def _pump(channel, proc, outputs, write, close, master):
+    """ Copy data between the channel and the local process """
+    channel.stitches_replied.wait(10)
+    fds = dict(outputs)
+    watch_channel = True
+    while fds and not channel.closed:
+        readable, _, _ = select.select(list(fds) + ([channel] if watch_channel else []), [], [], 1.0)
+        for fd in readable:
+            if fd is channel:
+                if channel.recv_ready():
+                    try:
+                        write(channel.recv(65536))
+                        if close is not None:
+                            proc.stdin.flush()
+                    except (OSError, IOError, ValueError):
+                        pass
+                elif channel.eof_received or channel.closed:
+                    # stop watching the channel, it stays readable after EOF
+                    watch_channel = False
+                    if close is not None:
+                        try:
+                            close()
+                        except (OSError, IOError):
+                            pass
+                continue
+            try:
+                data = os.read(fd, 65536)
+            except OSError:
+                data = b''
+            if not data:
+                del fds[fd]
+                continue
+            try:
+                fds[fd](data)
+            except (socket.error, EOFError):
+                fds = {}
+                break
+    status = proc.wait()
+    if master is not None:
+        os.close(master)
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        if pipe is not None:
+            try:
+                pipe.close()
+            except (OSError, IOError):
+                pass
+    try:
+        channel.send_exit_status(status)
+        channel.shutdown_write()
+        channel.close()
+    except (socket.error, EOFError):
+        pass
+
+
+class SSHServer(object):
+    """
+    SSH server listening on localhost
+    """
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        """ Accept loop """
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = ServerTransport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            _SFTPServer)
+            transport.start_server(server=_Interface())
+            self.transports.append(transport)
+
+    def close(self):
+        """ Stop the server """
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
@@ -1,11 +1,17 @@
 """ Stitches module """
 
-from stitches.connection import Connection
+import logging
+import sys
+
+from stitches.connection import Connection, CommandResult
 from stitches.expect import ExpectFailed, Expect
 from stitches.structure import Structure
+from stitches.pool import TransportPool
+from stitches.procpool import ProcessPool
+from stitches.replay import ReplayConnection
 
-import logging
-import sys
+if sys.version_info >= (3, 6):
+    from stitches.aio import AsyncConnection, AsyncExpect, AsyncStructure
 
 if __name__ == "__main__":
     logging.error("What do you think I am? A program?")
@@ -0,0 +1,259 @@
+"""
+Persistent remote command agent
+
+A small Python program is started on the host over a single exec channel.
+It reads newline-delimited JSON requests from the channel, runs every
+command in its own process concurrently, streams output chunks back as JSON
+frames while commands run and writes a final frame with the exit status.
+Running a command through the agent costs one message each way instead of
+a channel open and a remote shell startup.
+"""
+
+import base64
+import io
+import itertools
+import json
+import logging
+import socket
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from stitches.connection import StitchesConnectionException, TailBuffer
+
+AGENT_VERSION = 2
+
+# runs on the remote host, must work with python 2.6+ and 3.x
+AGENT_SCRIPT = r"""
+import base64, json, os, select, signal, subprocess, sys, threading
+lock = threading.Lock()
+procs = set()
+devnull = open(os.devnull)
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+def reply(message):
+    data = (json.dumps(message) + '\n').encode('utf-8')
+    lock.acquire()
+    try:
+        out.write(data)
+        out.flush()
+    finally:
+        lock.release()
+def kill(proc, expired):
+    expired.append(True)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+def run(request):
+    try:
+        proc = subprocess.Popen(request['command'], shell=True, stdin=devnull,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                close_fds=True, preexec_fn=os.setsid)
+    except Exception:
+        reply({'id': request['id'], 'stream': 'stderr',
+               'data': base64.b64encode(str(sys.exc_info()[1]).encode('utf-8')).decode('ascii')})
+        reply({'id': request['id'], 'status': 127})
+        return
+    procs.add(proc)
+    expired = []
+    timer = None
+    if request.get('timeout') is not None:
+        timer = threading.Timer(request['timeout'], kill, (proc, expired))
+        timer.start()
+    streams = {proc.stdout.fileno(): 'stdout', proc.stderr.fileno(): 'stderr'}
+    while streams:
+        for fd in select.select(list(streams), [], [])[0]:
+            data = os.read(fd, 65536)
+            if not data:
+                del streams[fd]
+                continue
+            reply({'id': request['id'], 'stream': streams[fd],
+                   'data': base64.b64encode(data).decode('ascii')})
+    proc.wait()
+    proc.stdout.close()
+    proc.stderr.close()
+    procs.discard(proc)
+    if timer is not None:
+        timer.cancel()
+    if expired:
+        status = None
+    elif proc.returncode < 0:
+        status = -1
+    else:
+        status = proc.returncode
+    reply({'id': request['id'], 'status': status})
+reply({'ready': %(version)i})
+inp = getattr(sys.stdin, 'buffer', sys.stdin)
+for line in iter(inp.readline, ''.encode()):
+    thread = threading.Thread(target=run, args=(json.loads(line.decode('utf-8')),))
+    thread.daemon = True
+    thread.start()
+for proc in list(procs):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+""" % {'version': AGENT_VERSION}
+
+_BOOTSTRAP = ("for python in python3 python2 python; do "
+              "command -v $python >/dev/null 2>&1 && exec $python -c %s; done; exit 127" % quote(AGENT_SCRIPT))
+
+# extra time for a response to arrive after the command timeout
+_RESPONSE_GRACE = 30
+
+
+class Agent(object):
+    """
+    Client side of the remote command agent
+    """
+    def __init__(self, connection, timeout=10):
+        """
+        Start the agent on the host
+
+        @param connection: connection to the host
+        @type connection: L{Connection}
+
+        @param timeout: agent startup timeout
+        @type timeout: int or float
+
+        @raises StitchesConnectionException: if the agent doesn't start
+        """
+        self.logger = logging.getLogger('stitches.agent')
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.counter = itertools.count()
+        self.closed = False
+        self.ready = threading.Event()
+        start = time.time()
+        # the files are kept: closing stdin would stop the agent
+        self.files = connection.cli.exec_command(_BOOTSTRAP)
+        self.channel = self.files[1].channel
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+        self.ready.wait(timeout)
+        if not self.ready.is_set() or self.closed:
+            self.close()
+            raise StitchesConnectionException("Agent failed to start on %s" % connection.hostname)
+        connection.metrics.observe('agent_start_seconds', time.time() - start)
+
+    @property
+    def alive(self):
+        """ True if the agent can take requests """
+        return not self.closed and not self.channel.closed
+
+    def _dispatch(self, line):
+        """ Handle one message from the agent """
+        message = json.loads(line.decode('utf-8'))
+        if 'ready' in message:
+            if message['ready'] == AGENT_VERSION:
+                self.ready.set()
+            return
+        with self.lock:
+            if 'stream' in message:
+                frames = self.requests.get(message['id'])
+            else:
+                frames = self.requests.pop(message['id'], None)
+        if frames is not None:
+            frames.put(message)
+
+    def _read(self):
+        """ Read responses until the channel is closed """
+        pending = []
+        try:
+            while True:
+                data = self.channel.recv(65536)
+                if not data:
+                    break
+                self.connection.metrics.inc('bytes_received', len(data))
+                parts = data.split(b'\n')
+                for part in parts[:-1]:
+                    pending.append(part)
+                    self._dispatch(b''.join(pending))
+                    pending = []
+                pending.append(parts[-1])
+        except Exception as err:
+            self.logger.debug('Agent on %s failed: %s', self.connection.hostname, err)
+        finally:
+            with self.lock:
+                self.closed = True
+                waiters, self.requests = list(self.requests.values()), {}
+            for frames in waiters:
+                frames.put(None)
+            self.ready.set()
+
+    def run(self, command, timeout=10, tail_size=None, callback=None):
+        """
+        Run command on the host
+
+        @param command: command to execute
+        @type command: str
+
+        @param timeout: command execution timeout (seconds), the command is
+                        killed when it expires
+        @type timeout: int or float
+
+        @param tail_size: number of output bytes to return (everything if
+                          None)
+        @type tail_size: int
+
+        @param callback: function called with ('stdout' or 'stderr', data)
+                         for every chunk of output as it arrives
+        @type callback: callable
+
+        @return: (exit status or None in case of timeout, stdout, stderr)
+        @rtype: tuple
+
+        @raises StitchesConnectionException: if the agent exits
+        """
+        frames = queue.Queue()
+        with self.lock:
+            if self.closed:
+                raise StitchesConnectionException("Agent on %s is not running" %
+                                                  self.connection.hostname)
+            request_id = next(self.counter)
+            self.requests[request_id] = frames
+            data = (json.dumps({'id': request_id, 'command': command, 'timeout': timeout}) +
+                    '\n').encode('utf-8')
+            try:
+                self.channel.sendall(data)
+            except socket.error as err:
+                del self.requests[request_id]
+                raise StitchesConnectionException("Agent on %s is not running: %s" %
+                                                  (self.connection.hostname, err))
+        self.connection.metrics.inc('bytes_sent', len(data))
+        tails = {'stdout': TailBuffer(tail_size) if tail_size else io.BytesIO(),
+                 'stderr': TailBuffer(tail_size) if tail_size else io.BytesIO()}
+        deadline = None if timeout is None else time.time() + timeout + _RESPONSE_GRACE
+        while True:
+            try:
+                message = frames.get(timeout=None if deadline is None else max(0, deadline - time.time()))
+            except queue.Empty:
+                with self.lock:
+                    self.requests.pop(request_id, None)
+                return None, tails['stdout'].getvalue(), tails['stderr'].getvalue()
+            if message is None:
+                raise StitchesConnectionException("Agent on %s exited while running '%s'" %
+                                                  (self.connection.hostname, command))
+            if 'stream' not in message:
+                return message['status'], tails['stdout'].getvalue(), tails['stderr'].getvalue()
+            chunk = base64.b64decode(message['data'])
+            tails[message['stream']].write(chunk)
+            if callback is not None:
+                callback(message['stream'], chunk)
+
+    def close(self):
+        """
+        Stop the agent (commands still running are killed)
+        """
+        self.channel.close()
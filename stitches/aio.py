@@ -0,0 +1,394 @@
+"""
+asyncio front-end for L{Connection}, L{Expect} and L{Structure}
+
+Waiting for command output, exit statuses and expected expressions happens
+on the event loop. paramiko performs handshakes and channel requests
+synchronously, these short calls are run in the loop's default executor.
+"""
+
+import asyncio
+import re
+import sys
+import time
+import logging
+
+from stitches.connection import Connection, CommandResult, TailBuffer
+from stitches.expect import ExpectFailed, _Matcher
+from stitches.structure import Structure
+
+
+# longest time an executor thread blocks waiting for an exit status
+STATUS_POLL = 1
+
+
+def _loop():
+    """ Event loop of the running coroutine """
+    # python < 3.7 has no get_running_loop
+    return getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+
+
+async def _readable(channel, timeout=None):
+    """
+    Wait until the channel has data (or EOF) or timeout expires
+
+    @return: False on timeout
+    @rtype: bool
+    """
+    loop = _loop()
+    future = loop.create_future()
+    fileno = channel.fileno()
+
+    def ready():
+        """ Reader callback """
+        if not future.done():
+            future.set_result(True)
+
+    loop.add_reader(fileno, ready)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(fileno)
+
+
+class AsyncConnection(object):
+    """
+    Connection to the host with coroutine-based command execution
+
+    Accepts the same arguments as L{Connection}, attributes not defined here
+    are taken from the underlying connection.
+    """
+    def __init__(self, *args, **kwargs):
+        self.connection = Connection(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    @staticmethod
+    async def _call(func, *args):
+        """ Run blocking paramiko call in the executor """
+        return await _loop().run_in_executor(None, func, *args)
+
+    async def connect(self, timeout=None):
+        """
+        Establish ssh connection
+
+        @param timeout: timeout for creating ssh connection (connection's
+                        timeout by default)
+        @type timeout: int or float
+
+        @return: connected client
+        @rtype: L{paramiko.SSHClient}
+        """
+        return await self._call(self.connection.connect, timeout)
+
+    async def get_channel(self):
+        """
+        Get interactive shell channel (see L{Connection.channel})
+
+        @return: shell channel
+        @rtype: L{paramiko.Channel}
+        """
+        return await self._call(lambda: self.connection.channel)
+
+    async def exec_command(self, command, bufsize=-1, get_pty=False):
+        """
+        Execute a command in the connection
+
+        @param command: command to execute
+        @type command: str
+
+        @param bufsize: buffer size
+        @type bufsize: int
+
+        @param get_pty: get pty
+        @type get_pty: bool
+
+        @return: the stdin, stdout, and stderr of the executing command
+        @rtype: tuple(L{paramiko.ChannelFile}, L{paramiko.ChannelFile},
+                      L{paramiko.ChannelFile})
+        """
+        await self.connect()
+        return await self._call(self.connection.exec_command, command,
+                                bufsize, get_pty)
+
+    async def _drain(self, channel, tails, callback):
+        """ Read stdout and stderr until exit status is received """
+        while True:
+            while channel.recv_ready():
+                data = channel.recv(32768)
+                self.metrics.inc('bytes_received', len(data))
+                tails['stdout'].write(data)
+                if callback is not None:
+                    callback('stdout', data)
+            while channel.recv_stderr_ready():
+                data = channel.recv_stderr(32768)
+                self.metrics.inc('bytes_received', len(data))
+                tails['stderr'].write(data)
+                if callback is not None:
+                    callback('stderr', data)
+            if channel.exit_status_ready():
+                if not channel.recv_ready() and not channel.recv_stderr_ready():
+                    return channel.recv_exit_status()
+                continue
+            if channel.eof_received:
+                # no more data, the status arrives without making the channel
+                # readable
+                await self._call(channel.status_event.wait, STATUS_POLL)
+            else:
+                await _readable(channel)
+
+    async def recv_exit_status(self, command, timeout=10, get_pty=False,
+                               callback=None):
+        """
+        Execute a command and get its return value
+
+        Cancelling the coroutine closes the command's channel.
+
+        @param command: command to execute
+        @type command: str
+
+        @param timeout: command execution timeout (seconds)
+        @type timeout: int or float
+
+        @param get_pty: get pty
+        @type get_pty: bool
+
+        @param callback: function called with ('stdout' or 'stderr', data)
+                         for every chunk of output as it arrives
+        @type callback: callable
+
+        @return: the exit code of the process or None in case of timeout
+        @rtype: int or None
+        """
+        tails = {'stdout': TailBuffer(self.connection.tail_size),
+                 'stderr': TailBuffer(self.connection.tail_size)}
+        start = time.time()
+        stdin, stdout, stderr = await self.exec_command(command,
+                                                        get_pty=get_pty)
+        channel = stdout.channel
+        status = None
+        try:
+            status = await asyncio.wait_for(self._drain(channel, tails,
+                                                        callback), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.metrics.observe('command_seconds', time.time() - start)
+            self.connection.last_status = status
+            self.connection.last_stdout = tails['stdout'].getvalue()
+            self.connection.last_stderr = tails['stderr'].getvalue()
+            stdin.close()
+            stdout.close()
+            stderr.close()
+            channel.close()
+        return status
+
+    async def run(self, command, timeout=10, get_pty=False):
+        """
+        Execute a command and collect its result
+
+        @param command: command to execute
+        @type command: str
+
+        @param timeout: command execution timeout (seconds)
+        @type timeout: int or float
+
+        @param get_pty: get pty
+        @type get_pty: bool
+
+        @return: command result
+        @rtype: L{CommandResult}
+        """
+        start = time.time()
+        status = await self.recv_exit_status(command, timeout, get_pty)
+        if status is None:
+            stdout, stderr = b"", b""
+        else:
+            stdout, stderr = self.last_stdout, self.last_stderr
+        return CommandResult(self.hostname, command, status, stdout, stderr,
+                             time.time() - start)
+
+
+class AsyncExpect(object):
+    '''
+    Coroutine versions of L{Expect} methods, for L{AsyncConnection}
+    '''
+    @staticmethod
+    async def _wait(connection, matcher, timeout):
+        '''
+        Read from the connection's channel until matcher succeeds
+
+        @raises ExpectFailed
+        '''
+        channel = await connection.get_channel()
+        start = time.time()
+        deadline = start + timeout
+        try:
+            while True:
+                result = matcher.match()
+                if result is not None:
+                    return result
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if channel.recv_ready():
+                    data = channel.recv(32768)
+                    connection.metrics.inc('bytes_received', len(data))
+                    recv_part = matcher.feed(data)
+                    logging.getLogger('stitches.expect').debug("RCV: " + recv_part)
+                    if connection.output_shell:
+                        sys.stdout.write(recv_part)
+                elif channel.closed or channel.eof_received:
+                    break
+                else:
+                    await _readable(channel, remaining)
+        finally:
+            connection.metrics.observe('expect_wait_seconds', time.time() - start)
+        raise ExpectFailed(matcher.transcript)
+
+    @staticmethod
+    async def expect_list(connection, regexp_list, timeout=10):
+        '''
+        Expect a list of expressions (see L{Expect.expect_list})
+
+        @raises ExpectFailed
+        '''
+        result = await AsyncExpect._wait(connection, _Matcher(regexp_list),
+                                         timeout)
+        return result[1]
+
+    @staticmethod
+    async def expect(connection, strexp, timeout=10):
+        '''
+        Expect one expression (see L{Expect.expect})
+
+        @raises ExpectFailed
+        '''
+        matcher = _Matcher([(re.compile(strexp, re.DOTALL), True)],
+                           search=True)
+        result = await AsyncExpect._wait(connection, matcher, timeout)
+        return result[1]
+
+    @staticmethod
+    async def match(connection, regexp, grouplist=[1], timeout=10):
+        '''
+        Match against an expression (see L{Expect.match})
+
+        @raises ExpectFailed
+        '''
+        result = await AsyncExpect._wait(connection, _Matcher([(regexp, None)]),
+                                         timeout)
+        return [result[0].group(group) for group in grouplist]
+
+    @staticmethod
+    async def enter(connection, command):
+        '''
+        Enter a command to the channel (with '\\n' appended)
+
+        @return: number of bytes actually sent
+        @rtype: int
+        '''
+        channel = await connection.get_channel()
+        connection.invalidate_facts(command)
+        connection.metrics.inc('bytes_sent', len(command) + 1)
+        return channel.send(command + "\n")
+
+    @staticmethod
+    async def ping_pong(connection, command, strexp, timeout=10):
+        '''
+        Enter a command and wait for something to happen (see
+        L{Expect.ping_pong})
+
+        @raises ExpectFailed
+        '''
+        await AsyncExpect.enter(connection, command)
+        return await AsyncExpect.expect(connection, strexp, timeout)
+
+    @staticmethod
+    async def expect_retval(connection, command, expected_status=0, timeout=10):
+        '''
+        Run command and expect specified return value (see
+        L{Expect.expect_retval})
+
+        @raises ExpectFailed
+        '''
+        retval = await connection.recv_exit_status(command, timeout)
+        if retval is None:
+            raise ExpectFailed("Got timeout (%s seconds) while executing '%s'"
+                               % (timeout, command))
+        elif retval != expected_status:
+            raise ExpectFailed("Got %s exit status (%s expected)\ncmd: %s\nstdout: %s\nstderr: %s"
+                               % (retval, expected_status, connection.last_command,
+                                  connection.last_stdout, connection.last_stderr))
+        if connection.output_shell:
+            sys.stdout.write("Run '%s', got %i return value\n"
+                             % (command, retval))
+        return retval
+
+
+class AsyncStructure(Structure):
+    """
+    L{Structure} of L{AsyncConnection} objects
+    """
+    connection_class = AsyncConnection
+
+    @staticmethod
+    def _connect(connection, timeout):
+        """ Connect instance from a worker thread (no event loop there) """
+        return connection.connection.connect(timeout)
+
+    @staticmethod
+    def _reconnect(connection, timeout):
+        """ Reconnect instance from a worker thread (no event loop there) """
+        return connection.connection.reconnect(timeout)
+
+    async def run(self, commands, roles=None, timeout=10, workers=256,
+                  fail_fast=False, max_failures=None, get_pty=False):
+        """
+        Run command(s) on all instances concurrently (see L{Structure.run})
+
+        @return: asynchronous generator of command results in order of
+                 completion
+        @rtype: async generator of L{CommandResult}
+        """
+        if not isinstance(commands, (list, tuple)):
+            commands = [commands]
+        if fail_fast:
+            max_failures = 1
+        semaphore = asyncio.Semaphore(workers)
+
+        async def run_instance(role, connection):
+            """ Run all commands on one instance """
+            results = []
+            async with semaphore:
+                for command in commands:
+                    try:
+                        result = await connection.run(command, timeout, get_pty)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as err:
+                        result = CommandResult(connection.hostname, command,
+                                               error=err)
+                    result.role = role
+                    results.append(result)
+                    if result.failed:
+                        break
+            return results
+
+        tasks = [asyncio.ensure_future(run_instance(role, connection))
+                 for role, connection in self.connections(roles)]
+        failures = 0
+        try:
+            for future in asyncio.as_completed(tasks):
+                for result in await future:
+                    yield result
+                    if result.failed:
+                        failures += 1
+                if max_failures is not None and failures >= max_failures:
+                    self.logger.debug('Stopping after %s failure(s)', failures)
+                    return
+        finally:
+            for task in tasks:
+                task.cancel()
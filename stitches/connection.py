@@ -4,13 +4,26 @@ L{Connection}.
 
 import paramiko
 import time
-import subprocess
 import os
 import sys
 import random
 import string
 import logging
 import socket
+import select
+import collections
+import threading
+import hashlib
+import tarfile
+import io
+import re
+import contextlib
+
+from stitches.pool import DEFAULT_POOL
+from stitches.metrics import Metrics
+from stitches.facts import FACTS, FactCache
+from stitches.profiles import get_profile
+from stitches.keys import DEFAULT_KEY_CACHE, DEFAULT_KEY_FILES
 
 class StitchesConnectionException(Exception):
     """ StitchesConnection Exception """
@@ -28,12 +41,205 @@ def lazyprop(func):
     return _lazyprop
 
 
+def connprop(func):
+    """
+    Create lazy property depending on the ssh transport: the connection is
+    reopened (dropping stale channels) if the transport died
+    """
+    lazy = lazyprop(func)
+    @property
+    def _connprop(self):
+        """ Create lazy property, reconnect first if needed """
+        if self.state == 'dead':
+            self.ensure_connected()
+        return lazy.fget(self)
+    return _connprop
+
+
+_RPYC_PORT_MARKER = "STITCHES_RPYC_PORT="
+
+# in-memory rpyc bundles: package directory -> (content hash, tar.gz data)
+_RPYC_BUNDLES = {}
+_RPYC_BUNDLES_LOCK = threading.Lock()
+
+# private per-user cache of rpyc bundles on the host, the bundle is only put
+# on PYTHONPATH if the cache is ours, not writable by others and its contents
+# hash to the digest of the local package
+_RPYC_CACHE = '"$HOME/.cache/stitches"'
+_RPYC_PREPARE = ('{ [ -d %(cache)s ] || mkdir -p -m 700 %(cache)s; } && [ -O %(cache)s ] && '
+                 '[ -z "$(find %(cache)s -maxdepth 0 -perm /022)" ]')
+_RPYC_VERIFY = ('[ -O %(dir)s ] && [ -z "$(find %(dir)s -maxdepth 0 -perm /022)" ] && '
+                '[ "$(cd %(dir)s && find rpyc -type f ! -name \'*.py[co]\' | LC_ALL=C sort | '
+                'xargs sha256sum | sha256sum)" = "%(digest)s  -" ]')
+
+
+def _rpyc_bundle(rpyc_dirname):
+    """
+    Pack local rpyc package into an in-memory tarball (once per process)
+
+    The digest is the sha256 of the package's sha256sum listing (sorted by
+    path), so that it can be checked on the host with coreutils.
+
+    @param rpyc_dirname: rpyc package directory
+    @type rpyc_dirname: str
+
+    @return: (sha256 of package contents, tar.gz data)
+    @rtype: tuple
+    """
+    with _RPYC_BUNDLES_LOCK:
+        if rpyc_dirname not in _RPYC_BUNDLES:
+            files = []
+            for dirpath, dirnames, filenames in os.walk(rpyc_dirname):
+                dirnames[:] = [d for d in dirnames if d != "__pycache__"]
+                for filename in filenames:
+                    if filename.endswith((".pyc", ".pyo")):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    files.append(("rpyc/" + os.path.relpath(path, rpyc_dirname).replace(os.sep, "/"), path))
+            listing = []
+            data = io.BytesIO()
+            tar = tarfile.open(fileobj=data, mode="w:gz")
+            for arcname, path in sorted(files):
+                with open(path, "rb") as fd:
+                    listing.append("%s  %s\n" % (hashlib.sha256(fd.read()).hexdigest(), arcname))
+                tar.add(path, arcname=arcname)
+            tar.close()
+            digest = hashlib.sha256("".join(listing).encode()).hexdigest()
+            _RPYC_BUNDLES[rpyc_dirname] = (digest, data.getvalue())
+        return _RPYC_BUNDLES[rpyc_dirname]
+
+
+class TailBuffer(object):
+    """
+    Buffer keeping only the last bytes written to it
+    """
+    def __init__(self, size):
+        """
+        Create tail buffer
+
+        @param size: number of bytes to keep
+        @type size: int
+        """
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+
+    def write(self, data):
+        """ Append data to the buffer, dropping the oldest data """
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.chunks and self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        """ Get buffer contents """
+        return b''.join(self.chunks)[-self.size:]
+
+
+def _text(data):
+    """ Decode command output """
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+
+def _split_lines(chunks):
+    """ Re-split (stream, data) chunks into (stream, line) tuples """
+    partial = {}
+    for name, data in chunks:
+        data = partial.pop(name, b'') + data
+        lines = data.splitlines(True)
+        if lines and not lines[-1].endswith(b'\n'):
+            partial[name] = lines.pop()
+        for line in lines:
+            yield name, line
+    for name, data in partial.items():
+        yield name, data
+
+
+def _split_batch(data, token):
+    """
+    Split framed output of L{Connection.run_batch}
+
+    @return: command index -> (output, exit status or None)
+    @rtype: dict
+    """
+    result = {}
+    framing = re.compile(('%s:([0-9]+):B\n' % token).encode())
+    for begin in framing.finditer(data):
+        idx = int(begin.group(1))
+        end = re.compile(('\n%s:%i:E:([0-9]+)\n' % (token, idx)).encode())
+        match = end.search(data, begin.end())
+        if match is None:
+            result[idx] = (data[begin.end():], None)
+            break
+        result[idx] = (data[begin.end():match.start()], int(match.group(1)))
+    return result
+
+
+class CommandResult(object):
+    """
+    Result of a command executed on the host
+    """
+    def __init__(self, hostname, command, status=None, stdout=b"", stderr=b"",
+                 duration=None, error=None, role=None):
+        """
+        Create command result
+
+        @param hostname: host the command was executed on
+        @type hostname: str
+
+        @param command: executed command
+        @type command: str
+
+        @param status: exit status or None in case of timeout
+        @type status: int or None
+
+        @param stdout: command's standard output
+        @type stdout: bytes
+
+        @param stderr: command's standard error
+        @type stderr: bytes
+
+        @param duration: wall time of command execution (seconds)
+        @type duration: float
+
+        @param error: exception raised while executing the command
+        @type error: Exception
+
+        @param role: instance's role (when executed across L{Structure})
+        @type role: str
+        """
+        self.hostname = hostname
+        self.command = command
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.error = error
+        self.role = role
+
+    @property
+    def failed(self):
+        """ True if command timed out, errored or returned non-zero """
+        return self.error is not None or self.status != 0
+
+    def __repr__(self):
+        return "<CommandResult %s %r status=%s>" % (self.hostname,
+                                                    self.command,
+                                                    self.status)
+
+
 class Connection(object):
     """
     Stateful object to represent connection to the host
     """
     def __init__(self, instance, username="root", key_filename=None,
-                 timeout=10, output_shell=False, disable_rpyc=False):
+                 timeout=10, output_shell=False, disable_rpyc=False,
+                 tail_size=1048576, port=22, pool=None, use_agent=False,
+                 mux=None, keepalive=3, dead_timeout=30, prompt=None,
+                 facts_ttl=300, facts_size=256, profile=None, record=None,
+                 key_cache=True):
         """
         Create connection object
 
@@ -53,6 +259,64 @@ class Connection(object):
         @param output_shell: write output from this connection to standard
                              output
         @type output_shell: bool
+
+        @param tail_size: number of output bytes to keep in last_stdout and
+                          last_stderr
+        @type tail_size: int
+
+        @param port: ssh port
+        @type port: int
+
+        @param pool: share ssh transport with other connections to the same
+                     host using this pool (True for the process-wide pool)
+        @type pool: L{TransportPool} or bool
+
+        @param use_agent: run commands through a persistent agent on the
+                          host (see L{agent}) when possible
+        @type use_agent: bool
+
+        @param mux: multiplexing daemon socket (see L{mux}); None to attach
+                    to the daemon at $STITCHES_MUX or the default socket when
+                    it runs (sockets other users could have created are
+                    ignored, see L{mux.trusted}), False to always connect
+                    directly
+        @type mux: str or None or bool
+
+        @param keepalive: interval of ssh and TCP keepalive probes (seconds)
+        @type keepalive: int
+
+        @param dead_timeout: consider the transport dead when the host
+                             doesn't acknowledge data for this number of
+                             seconds (where the platform supports it)
+        @type dead_timeout: int
+
+        @param prompt: regular expression found in the shell prompt of
+                       interactive sessions ('username@' by default)
+        @type prompt: str or compiled regexp
+
+        @param facts_ttl: number of seconds results of L{cached_run} and
+                          L{fact} are valid for (None for no expiration)
+        @type facts_ttl: int or float
+
+        @param facts_size: maximum number of cached results
+        @type facts_size: int
+
+        @param profile: transport tuning profile or its name (see
+                        L{profiles.PROFILES})
+        @type profile: L{profiles.Profile} or str
+
+        @param record: save commands, channel data and SFTP reads to this
+                       session file for L{replay.ReplayConnection} (commands
+                       are not run through the agent then)
+        @type record: str
+
+        @param key_cache: parse private keys once and offer the key which
+                          worked for the host (or user) first, see L{keys}
+                          (True for the process-wide cache, False to let
+                          paramiko load keys on every connect)
+        @type key_cache: L{keys.KeyCache} or bool
+
+        @raises ValueError: if there is no such profile
         """
         self.logger = logging.getLogger('stitches.connection')
 
@@ -91,13 +355,36 @@ class Connection(object):
             self.key_filename = self.parameters['key_filename']
         else:
             self.key_filename = key_filename
+        if 'port' in self.parameters:
+            self.port = int(self.parameters['port'])
+        else:
+            self.port = port
+        if 'profile' in self.parameters:
+            profile = self.parameters['profile']
+        self.profile = get_profile(profile)
+        if pool is True:
+            pool = DEFAULT_POOL
+        self.pool = pool or None
+        if key_cache is True:
+            key_cache = DEFAULT_KEY_CACHE
+        self.key_cache = key_cache or None
         self.disable_rpyc = disable_rpyc
+        self.use_agent = use_agent
+        self.mux = mux
+        self.keepalive = keepalive
+        self.dead_timeout = dead_timeout
+        self.prompt = prompt
+        # idle interactive sessions for reuse
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
         self.timeout = timeout
+        self.tail_size = tail_size
 
         # debugging buffers
         self.last_command = ""
-        self.last_stdout = ""
-        self.last_stderr = ""
+        self.last_status = None
+        self.last_stdout = b""
+        self.last_stderr = b""
 
         if self.key_filename:
             self.look_for_keys = False
@@ -106,51 +393,300 @@ class Connection(object):
 
         self.stdin_rpyc, self.stdout_rpyc, self.stderr_rpyc = None, None, None
 
+        self.metrics = Metrics()
+        self.facts = FactCache(facts_ttl, facts_size)
+
+        self.recorder = None
+        if record is not None:
+            from stitches.replay import Recorder
+            self.recorder = Recorder(record, self)
+            self.use_agent = False
+
         logging.getLogger("paramiko").setLevel(logging.WARNING)
 
-    @lazyprop
-    def cli(self):
-        """ cli lazy property """
+    def _connect(self, timeout=None):
+        """ Create new ssh client """
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-        client.connect(hostname=self.private_hostname,
-                       username=self.username,
-                       key_filename=self.key_filename,
-                       timeout=self.timeout,
-                       look_for_keys=self.look_for_keys)
+        with self.metrics.timer('connect_seconds'):
+            sock = self._attach_mux(timeout or self.timeout)
+            if sock is not None:
+                # the daemon holds the authenticated transport
+                client.connect(hostname=self.private_hostname,
+                               port=self.port,
+                               username=self.username,
+                               password='',
+                               sock=sock,
+                               timeout=timeout or self.timeout,
+                               allow_agent=False,
+                               look_for_keys=False)
+            else:
+                self._authenticate(client, timeout or self.timeout)
         # set keepalive
         transport = client.get_transport()
-        transport.set_keepalive(3)
+        transport.set_keepalive(self.keepalive)
+        self._set_socket_options(transport.sock)
         return client
 
+    def _authenticate(self, client, timeout):
+        """ Connect client directly, offering cached keys first """
+        kwargs = dict(hostname=self.private_hostname,
+                      port=self.port,
+                      username=self.username,
+                      key_filename=self.key_filename,
+                      timeout=timeout,
+                      look_for_keys=self.look_for_keys)
+        kwargs.update(self.profile.connect_kwargs())
+        if self.key_cache is None:
+            client.connect(**kwargs)
+            return
+        single = bool(self.key_filename) and not isinstance(self.key_filename, (list, tuple))
+        if self.key_filename:
+            candidates = [self.key_filename] if single else list(self.key_filename)
+        elif self.look_for_keys:
+            candidates = DEFAULT_KEY_FILES
+        else:
+            candidates = []
+        if single:
+            path = self.key_filename
+        else:
+            # the key which worked before goes ahead of the search, a key
+            # which worked elsewhere only if this connection offers it anyway
+            path = self.key_cache.credential(self.private_hostname, self.port, self.username,
+                                             candidates)
+        if path is not None:
+            try:
+                kwargs['pkey'] = self.key_cache.load(path)
+                if single:
+                    kwargs['key_filename'] = None
+            except (IOError, OSError, paramiko.SSHException) as err:
+                # e.g. encrypted key, paramiko reports it
+                self.logger.debug("Failed to load key %s: %s" % (path, err))
+                if not single:
+                    self.key_cache.forget(self.private_hostname, self.port, self.username, path)
+        try:
+            client.connect(**kwargs)
+        except paramiko.AuthenticationException:
+            if not single:
+                self.key_cache.forget(self.private_hostname, self.port, self.username, path)
+            raise
+        if single:
+            return
+        handler = client.get_transport().auth_handler
+        key = getattr(handler, 'private_key', None)
+        if key is None or isinstance(key, paramiko.AgentKey):
+            return
+        if key is kwargs.get('pkey'):
+            found = path
+        else:
+            if path is not None and 'pkey' in kwargs:
+                # the cached key was offered and refused
+                self.key_cache.forget(self.private_hostname, self.port, self.username, path)
+            found = self.key_cache.identify(key, candidates)
+        if found is not None:
+            self.key_cache.remember(self.private_hostname, self.port, self.username, found)
+
+    def _set_socket_options(self, sock):
+        """ Bound the time it takes to notice a dead transport """
+        if getattr(sock, 'family', None) not in (socket.AF_INET, socket.AF_INET6):
+            return
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                probes = max(1, int(self.dead_timeout // max(self.keepalive, 1)))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.keepalive)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, probes)
+            if sys.platform.startswith('linux'):
+                # unacknowledged data (e.g. ssh keepalives) times out
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, 'TCP_USER_TIMEOUT', 18),
+                                int(self.dead_timeout * 1000))
+            self.profile.tune_socket(sock)
+        except (socket.error, OSError) as err:
+            self.logger.debug("Failed to set socket options: %s" % err)
+
+    def _attach_mux(self, timeout):
+        """ Attach to multiplexing daemon if it runs """
+        if self.mux is False:
+            return None
+        from stitches import mux
+        path = mux.socket_path(self.mux)
+        try:
+            if not mux.trusted(path):
+                return None
+        except StitchesConnectionException as err:
+            self.logger.warning("Not attaching to multiplexer: %s" % err)
+            return None
+        try:
+            return mux.attach(path, self.private_hostname, self.port,
+                              self.username, self.key_filename, timeout,
+                              self.profile.name)
+        except Exception as err:
+            self.logger.debug("Failed to attach to multiplexer %s: %s" % (path, err))
+            return None
+
+    def _open(self, timeout=None):
+        """ Get ssh client, from the pool if configured """
+        if self.pool is not None:
+            key_filename = self.key_filename
+            if isinstance(key_filename, list):
+                # paramiko takes lists of key files, pool keys are hashed
+                key_filename = tuple(key_filename)
+            return self.pool.acquire((self.private_hostname, self.port,
+                                      self.username, key_filename,
+                                      self.profile.name),
+                                     lambda: self._connect(timeout))
+        return self._connect(timeout)
+
     @lazyprop
+    def cli(self):
+        """ cli lazy property """
+        if self.recorder is not None:
+            return self.recorder.wrap(self._open())
+        return self._open()
+
+    @property
+    def state(self):
+        """
+        Connection state: 'disconnected' (not connected yet or closed),
+        'connected' or 'dead' (the transport dropped)
+        """
+        if not hasattr(self, '_lazy_cli'):
+            return 'disconnected'
+        transport = self._lazy_cli.get_transport()
+        if transport is None or not transport.is_active():
+            return 'dead'
+        return 'connected'
+
+    def is_alive(self, timeout=5):
+        """
+        Check the host responds by opening a channel
+
+        @param timeout: probe timeout (seconds)
+        @type timeout: int or float
+
+        @return: True if the host responded in time
+        @rtype: bool
+        """
+        if self.state != 'connected':
+            return False
+        try:
+            self._lazy_cli.get_transport().open_session(timeout=timeout).close()
+            return True
+        except (paramiko.SSHException, socket.error, EOFError) as err:
+            self.logger.debug("Connection to %s is dead: %s" % (self.hostname, err))
+            return False
+
+    def ensure_connected(self, timeout=None):
+        """
+        Reconnect if the connection is dead or closed
+
+        @param timeout: timeout for creating ssh connection (connection's
+                        timeout by default)
+        @type timeout: int or float
+
+        @return: ssh client
+        @rtype: L{paramiko.SSHClient}
+        """
+        if self.state == 'dead':
+            self.reconnect(timeout)
+        return self.connect(timeout)
+
+    def connect(self, timeout=None):
+        """
+        Establish ssh connection now instead of on first use
+
+        @param timeout: timeout for creating ssh connection (connection's
+                        timeout by default)
+        @type timeout: int or float
+
+        @return: ssh client
+        @rtype: L{paramiko.SSHClient}
+        """
+        if not hasattr(self, '_lazy_cli'):
+            self._lazy_cli = self._open(timeout)
+        return self._lazy_cli
+
+    @connprop
+    def shell(self):
+        """ Default interactive session lazy property """
+        from stitches.session import ShellSession
+        return ShellSession(self, self.prompt)
+
+    @connprop
     def channel(self):
-        """ channel lazy property """
-        # start shell, non-blocking channel
-        chan = self.cli.invoke_shell(width=360, height=80)
-        chan.setblocking(0)
-        # set channel timeout
-        chan.settimeout(10)
-        # now waiting for shell prompt ('username@')
-        result = ""
-        count = 0
-        while count < 10:
+        """ channel lazy property (channel of the default session) """
+        return self.shell.channel
+
+    def open_session(self, prompt=None, timeout=10):
+        """
+        Get an interactive shell session, reusing an idle one if possible
+
+        @param prompt: regular expression found in the shell prompt
+                       (connection's prompt by default)
+        @type prompt: str or compiled regexp
+
+        @param timeout: timeout for the prompt to appear
+        @type timeout: int or float
+
+        @return: shell session, give it back with L{release_session}
+        @rtype: L{session.ShellSession}
+
+        @raises StitchesConnectionException: if the prompt doesn't appear
+        """
+        from stitches.session import ShellSession
+        prompt = prompt or self.prompt
+        # idle sessions of a dead transport are dropped by reconnecting
+        self.ensure_connected()
+        with self.sessions_lock:
+            for session in self.sessions:
+                if session.requested_prompt == prompt:
+                    self.sessions.remove(session)
+                    if session.alive:
+                        return session
+                    session.close()
+                    break
+        return ShellSession(self, prompt, timeout)
+
+    def release_session(self, session, reset=True, timeout=10):
+        """
+        Return a session for reuse
+
+        @param session: session obtained with L{open_session}
+        @type session: L{session.ShellSession}
+
+        @param reset: interrupt whatever runs in the session and wait for a
+                      fresh prompt (sessions which fail to reset are closed)
+        @type reset: bool
+
+        @param timeout: reset timeout
+        @type timeout: int or float
+        """
+        if session.alive and reset:
             try:
-                recv_part = chan.recv(16384).decode()
-                result += recv_part
-            except socket.timeout:
-                # socket.timeout here means 'no more data'
-                pass
-
-            if result.find('%s@' % self.username) != -1:
-                return chan
-            time.sleep(1)
-            count += 1
-        # failed to get shell prompt on channel :-(
-        raise StitchesConnectionException("Failed to get shell prompt")
+                session.reset(timeout)
+            except Exception as err:
+                self.logger.debug("Failed to reset session: %s" % err)
+                session.close()
+        if not session.alive:
+            return
+        with self.sessions_lock:
+            self.sessions.append(session)
 
-    @lazyprop
+    @contextlib.contextmanager
+    def session(self, prompt=None, timeout=10):
+        """
+        Context manager providing an interactive session (see
+        L{open_session}), the session is released when the block ends
+        """
+        session = self.open_session(prompt, timeout)
+        try:
+            yield session
+        finally:
+            self.release_session(session)
+
+    @connprop
     def sftp(self):
         """ sftp lazy property """
         return self.cli.open_sftp()
@@ -161,7 +697,7 @@ class Connection(object):
         if not self.disable_rpyc:
             from plumbum import SshMachine
             return SshMachine(host=self.private_hostname, user=self.username,
-                              keyfile=self.key_filename,
+                              port=self.port, keyfile=self.key_filename,
                               ssh_opts=["-o", "UserKnownHostsFile=/dev/null",
                                         "-o", "StrictHostKeyChecking=no"])
         else:
@@ -174,34 +710,12 @@ class Connection(object):
             try:
                 import rpyc
 
-                devnull_fd = open("/dev/null", "w")
-                rpyc_dirname = os.path.dirname(rpyc.__file__)
-                rnd_id = ''.join(random.choice(string.ascii_lowercase) for x in range(10))
-                pid_filename = "/tmp/%s.pid" % rnd_id
-                pid_dest_filename = "/tmp/%s%s.pid" % (rnd_id, rnd_id)
-                rnd_filename = "/tmp/" + rnd_id + ".tar.gz"
-                rnd_dest_filename = "/tmp/" + rnd_id + rnd_id + ".tar.gz"
-                subprocess.check_call(["tar", "-cz", "--exclude", "*.pyc", "--exclude", "*.pyo", "--transform",
-                                       "s,%s,%s," % (rpyc_dirname[1:][:-5], rnd_id), rpyc_dirname, "-f", rnd_filename],
-                                      stdout=devnull_fd, stderr=devnull_fd)
-                devnull_fd.close()
-
-                self.sftp.put(rnd_filename, rnd_dest_filename)
-                os.remove(rnd_filename)
-                self.recv_exit_status("tar -zxvf %s -C /tmp" % rnd_dest_filename, 10)
+                start = time.time()
+                digest, bundle = _rpyc_bundle(os.path.dirname(rpyc.__file__))
+                names = {'cache': _RPYC_CACHE, 'dir': '"$HOME/.cache/stitches/rpyc-%s"' % digest,
+                         'digest': digest}
+                verify = _RPYC_VERIFY % names
 
-                server_script = r"""
-import os
-print(os.environ)
-from rpyc.utils.server import ThreadedServer
-from rpyc import ClassicService
-import sys
-t = ThreadedServer(ClassicService, hostname = 'localhost', port = 0, reuse_addr = True)
-fd = open('""" + pid_filename + r"""', 'w')
-fd.write(str(t.port))
-fd.close()
-t.start()
-"""
                 if sys.version.startswith("3"):
                     python_ver = "python3"
                 elif sys.version.startswith("2"):
@@ -209,22 +723,58 @@ t.start()
                 else:
                     python_ver = "python"
 
-                ret = self.recv_exit_status(python_ver + " -V")
-                if ret != 0:
+                # one round-trip to check for python, the cache directory
+                # and an already uploaded bundle
+                ret = self.recv_exit_status(("%s -V >/dev/null 2>&1 || exit 2; " % python_ver) +
+                                            ("{ %s; } || exit 3; %s" % (_RPYC_PREPARE % names, verify)), 10)
+                if ret == 2 or ret is None:
                     self.logger.debug("%s not found on remote! ret:%s", python_ver, ret)
                     return None
+                if ret == 3:
+                    self.logger.warning("Not using rpyc on %s: ~/.cache/stitches is not private",
+                                        self.hostname)
+                    return None
+                if ret != 0:
+                    # concurrent uploads are fine: the bundle is unpacked
+                    # aside and moved in place unless a valid one is there
+                    stdin, stdout, stderr = self.exec_command(
+                        'tmp=$(mktemp -d %(cache)s/rpyc.XXXXXXXXXX) && tar -zxf - -C "$tmp" && '
+                        '{ %(verify)s || { rm -rf %(dir)s; mv "$tmp" %(dir)s; }; }; rm -rf "$tmp"' %
+                        dict(names, verify=verify))
+                    stdin.write(bundle)
+                    stdin.close()
+                    stdout.channel.status_event.wait(30)
+                    stdout.channel.close()
 
-                command = "echo \"%s\" | PYTHONPATH=\"/tmp/%s\" %s " % (server_script, rnd_id, python_ver)
+                server_script = r"""
+from rpyc.utils.server import ThreadedServer
+from rpyc import ClassicService
+import sys
+t = ThreadedServer(ClassicService, hostname = 'localhost', port = 0, reuse_addr = True)
+print('""" + _RPYC_PORT_MARKER + r"""%i' % t.port)
+sys.stdout.flush()
+t.start()
+"""
+                # checked again right before use
+                command = "%s || exit 3; echo \"%s\" | PYTHONPATH=%s %s " % (verify, server_script,
+                                                                              names['dir'], python_ver)
 
                 self.stdin_rpyc, self.stdout_rpyc, self.stderr_rpyc = self.exec_command(command, get_pty=True)
-                self.recv_exit_status("while [ ! -f %s ]; do sleep 1; done" % (pid_filename), 10)
-                self.sftp.get(pid_filename, pid_dest_filename)
-                pid_fd = open(pid_dest_filename, 'r')
-                port = int(pid_fd.read())
-                pid_fd.close()
-                os.remove(pid_dest_filename)
+                # the server reports its port over the channel
+                self.stdout_rpyc.channel.settimeout(10)
+                port = None
+                while port is None:
+                    line = self.stdout_rpyc.readline()
+                    if isinstance(line, bytes):
+                        line = line.decode('utf-8', 'replace')
+                    if not line:
+                        raise StitchesConnectionException("rpyc server exited")
+                    if line.startswith(_RPYC_PORT_MARKER):
+                        port = int(line[len(_RPYC_PORT_MARKER):])
 
-                return rpyc.classic.ssh_connect(self.pbm, port)
+                conn = rpyc.classic.ssh_connect(self.pbm, port)
+                self.metrics.observe('rpyc_bootstrap_seconds', time.time() - start)
+                return conn
 
             except Exception as err:
                 self.logger.debug("Failed to setup rpyc: %s" % err)
@@ -232,27 +782,57 @@ t.start()
         else:
             return None
 
-    def reconnect(self):
+    @lazyprop
+    def agent(self):
+        """ Remote command agent lazy property (None if it can't be started) """
+        from stitches.agent import Agent
+        try:
+            return Agent(self)
+        except Exception as err:
+            self.logger.debug("Failed to start agent: %s" % err)
+            return None
+
+    def reconnect(self, timeout=None):
         """
         Close the connection and open a new one
+
+        @param timeout: timeout for creating ssh connection (connection's
+                        timeout by default)
+        @type timeout: int or float
         """
+        self.logger.debug("Reconnecting to %s" % self.hostname)
         self.disconnect()
+        self.metrics.inc('reconnects')
+        self.connect(timeout)
 
     def disconnect(self):
         """
         Close the connection
         """
+        # not through the properties, they would reconnect a dead transport
         if hasattr(self, '_lazy_sftp'):
-            if self.sftp is not None:
-                self.sftp.close()
+            if self._lazy_sftp is not None:
+                self._lazy_sftp.close()
             delattr(self, '_lazy_sftp')
         if hasattr(self, '_lazy_channel'):
-            if self.channel is not None:
-                self.channel.close()
             delattr(self, '_lazy_channel')
+        if hasattr(self, '_lazy_shell'):
+            self._lazy_shell.close()
+            delattr(self, '_lazy_shell')
+        with self.sessions_lock:
+            sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            session.close()
+        if hasattr(self, '_lazy_agent'):
+            if self.agent is not None:
+                self.agent.close()
+            delattr(self, '_lazy_agent')
         if hasattr(self, '_lazy_cli'):
             if self.cli is not None:
-                self.cli.close()
+                if self.pool is not None:
+                    self.pool.release(getattr(self.cli, 'wrapped', self.cli))
+                else:
+                    self.cli.close()
             delattr(self, '_lazy_cli')
         if hasattr(self, '_lazy_pbm'):
             if self.pbm is not None:
@@ -262,6 +842,8 @@ t.start()
             if self.rpyc is not None:
                 self.rpyc.close()
             delattr(self, '_lazy_rpyc')
+        if self.recorder is not None:
+            self.recorder.flush()
 
     def exec_command(self, command, bufsize=-1, get_pty=False):
         """
@@ -283,37 +865,490 @@ t.start()
         @raise SSHException: if the server fails to execute the command
         """
         self.last_command = command
-        return self.cli.exec_command(command, bufsize, get_pty=get_pty)
+        self.invalidate_facts(command)
+        if self.state == 'dead':
+            self.reconnect()
+        self.metrics.inc('bytes_sent', len(command))
+        with self.metrics.timer('channel_open_seconds'):
+            return self.cli.exec_command(command, bufsize, get_pty=get_pty)
+
+    def _drain(self, channel, timeout):
+        """
+        Read stdout and stderr from the channel as data arrives
+
+        @return: generator of ('stdout' or 'stderr', data) tuples; stops
+                 when the exit status is received or on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            while channel.recv_ready():
+                yield 'stdout', channel.recv(32768)
+            while channel.recv_stderr_ready():
+                yield 'stderr', channel.recv_stderr(32768)
+            if channel.exit_status_ready():
+                if not channel.recv_ready() and not channel.recv_stderr_ready():
+                    return
+                continue
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+            if channel.eof_received:
+                # no more data, just the exit status is missing
+                channel.status_event.wait(remaining)
+            else:
+                select.select([channel], [], [], remaining)
+
+    def stream(self, command, timeout=10, get_pty=False, lines=False):
+        """
+        Execute a command and stream its output while it runs
+
+        Only the last tail_size bytes of output are kept in last_stdout and
+        last_stderr, exit status is stored in last_status (None in case of
+        timeout) once the generator is exhausted.
+
+        @param command: command to execute
+        @type command: str
+
+        @param timeout: command execution timeout (seconds)
+        @type timeout: int or float
+
+        @param get_pty: get pty
+        @type get_pty: bool
+
+        @param lines: yield whole lines instead of chunks
+        @type lines: bool
+
+        @return: generator of ('stdout' or 'stderr', data) tuples
+        @rtype: generator
+        """
+        self.last_command = command
+        self.last_status = None
+        tails = {'stdout': TailBuffer(self.tail_size),
+                 'stderr': TailBuffer(self.tail_size)}
+        start = time.time()
+        stdin, stdout, stderr = self.exec_command(command, get_pty=get_pty)
+        channel = stdout.channel
+        try:
+            chunks = self._drain(channel, timeout)
+            if lines:
+                chunks = _split_lines(chunks)
+            for name, data in chunks:
+                tails[name].write(data)
+                self.metrics.inc('bytes_received', len(data))
+                yield name, data
+            if channel.exit_status_ready():
+                self.last_status = channel.recv_exit_status()
+        finally:
+            self.metrics.observe('command_seconds', time.time() - start)
+            self.last_stdout = tails['stdout'].getvalue()
+            self.last_stderr = tails['stderr'].getvalue()
+            stdin.close()
+            stdout.close()
+            stderr.close()
+            channel.close()
 
-    def recv_exit_status(self, command, timeout=10, get_pty=False):
+    def recv_exit_status(self, command, timeout=10, get_pty=False,
+                         callback=None, retries=0, backoff=1):
         """
         Execute a command and get its return value
 
         @param command: command to execute
         @type command: str
 
-        @param timeout: command execution timeout
-        @type timeout: int
+        @param timeout: command execution timeout (seconds)
+        @type timeout: int or float
 
         @param get_pty: get pty
         @type get_pty: bool
 
+        @param callback: function called with ('stdout' or 'stderr', data)
+                         for every chunk of output as it arrives
+        @type callback: callable
+
+        @param retries: number of times the command is run again after
+                        the connection failed or dropped (use for idempotent
+                        commands only, callback gets output of all attempts)
+        @type retries: int
+
+        @param backoff: delay before the first retry (seconds), doubled for
+                        every next one
+        @type backoff: int or float
+
         @return: the exit code of the process or None in case of timeout
         @rtype: int or None
         """
-        status = None
+        attempt = 0
+        while True:
+            try:
+                status = self._recv_exit_status(command, timeout, get_pty, callback)
+                # channels of a dropped transport report -1, a timeout with a
+                # healthy transport is not retried
+                if status not in (None, -1) or attempt >= retries or self.state == 'connected':
+                    return status
+                self.logger.debug("Connection to %s lost while running '%s'" % (self.hostname, command))
+            except (paramiko.SSHException, socket.error, EOFError, StitchesConnectionException) as err:
+                if attempt >= retries:
+                    raise
+                self.logger.debug("Running '%s' on %s failed: %s" % (command, self.hostname, err))
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+
+    def _recv_exit_status(self, command, timeout, get_pty, callback):
+        """ Execute a command once """
+        if self.state == 'dead':
+            self.reconnect()
+        if self.use_agent and not get_pty:
+            if hasattr(self, '_lazy_agent') and self.agent is not None and not self.agent.alive:
+                # the agent died, start a new one
+                delattr(self, '_lazy_agent')
+            if self.agent is not None:
+                return self._agent_exit_status(command, timeout, callback)
+        for name, data in self.stream(command, timeout, get_pty):
+            if callback is not None:
+                callback(name, data)
+        return self.last_status
+
+    def _agent_exit_status(self, command, timeout, callback=None):
+        """ Execute a command through the agent """
         self.last_command = command
-        stdin, stdout, stderr = self.cli.exec_command(command, get_pty=get_pty)
-        if stdout and stderr and stdin:
-            for _ in range(timeout):
-                if stdout.channel.exit_status_ready():
-                    status = stdout.channel.recv_exit_status()
-                    self.last_stdout = stdout.read()
-                    self.last_stderr = stderr.read()
-                    break
-                time.sleep(1)
+        self.invalidate_facts(command)
+        self.last_status = None
+        start = time.time()
+        try:
+            self.last_status, self.last_stdout, self.last_stderr = \
+                self.agent.run(command, timeout, self.tail_size, callback)
+        finally:
+            self.metrics.observe('command_seconds', time.time() - start)
+        return self.last_status
 
-            stdin.close()
-            stdout.close()
-            stderr.close()
-        return status
+    def run(self, command, timeout=10, get_pty=False, retries=0, backoff=1):
+        """
+        Execute a command and collect its result
+
+        @param command: command to execute
+        @type command: str
+
+        @param timeout: command execution timeout (seconds)
+        @type timeout: int or float
+
+        @param get_pty: get pty
+        @type get_pty: bool
+
+        @param retries: number of times the command is run again after
+                        the connection failed or dropped (use for idempotent
+                        commands only)
+        @type retries: int
+
+        @param backoff: delay before the first retry (seconds), doubled for
+                        every next one
+        @type backoff: int or float
+
+        @return: command result
+        @rtype: L{CommandResult}
+        """
+        start = time.time()
+        status = self.recv_exit_status(command, timeout, get_pty, retries=retries,
+                                       backoff=backoff)
+        if status is None:
+            stdout, stderr = b"", b""
+        else:
+            stdout, stderr = self.last_stdout, self.last_stderr
+        return CommandResult(self.hostname, command, status, stdout, stderr,
+                             time.time() - start)
+
+    def cached_run(self, command, timeout=10, ttl=None, refresh=False):
+        """
+        Execute an idempotent command, reusing its result while cached
+
+        Results are kept for ttl seconds unless another command (one which
+        may change the host, see L{facts}) is executed on the connection in
+        the meantime, the last_* attributes are set as if the command was
+        executed. Timed out commands are not cached.
+
+        @param command: command to execute
+        @type command: str
+
+        @param timeout: command execution timeout (seconds)
+        @type timeout: int or float
+
+        @param ttl: number of seconds the result is valid for (facts_ttl by
+                    default)
+        @type ttl: int or float
+
+        @param refresh: execute the command even if its result is cached
+        @type refresh: bool
+
+        @return: command result
+        @rtype: L{CommandResult}
+        """
+        result = None if refresh else self.facts.get(command)
+        if result is None:
+            self.metrics.inc('facts_misses')
+            with self.facts.probing():
+                result = self.run(command, timeout)
+            if result.status is not None:
+                self.facts.put(command, result, ttl)
+        else:
+            self.metrics.inc('facts_hits')
+            self.last_command = command
+            self.last_status = result.status
+            self.last_stdout, self.last_stderr = result.stdout, result.stderr
+        return result
+
+    def fact(self, name, timeout=10, ttl=None, refresh=False):
+        """
+        Get host fact (see L{facts.FACTS})
+
+        @param name: fact name, e.g. 'release' or 'kernel'
+        @type name: str
+
+        @param timeout: command execution timeout (seconds)
+        @type timeout: int or float
+
+        @param ttl: number of seconds the fact is valid for (facts_ttl by
+                    default)
+        @type ttl: int or float
+
+        @param refresh: execute the command even if the fact is cached
+        @type refresh: bool
+
+        @return: stripped output of the fact's command or None if it failed
+        @rtype: str or None
+        """
+        result = self.cached_run(FACTS[name], timeout, ttl, refresh)
+        if result.failed:
+            return None
+        return _text(result.stdout).strip()
+
+    def prefetch_facts(self, names=None, timeout=30, ttl=None):
+        """
+        Get several facts in one remote session (see L{run_batch}) and cache
+        them
+
+        @param names: fact names (all of L{facts.FACTS} if None)
+        @type names: list of str
+
+        @param timeout: timeout for the whole batch (seconds)
+        @type timeout: int or float
+
+        @param ttl: number of seconds the facts are valid for (facts_ttl by
+                    default)
+        @type ttl: int or float
+
+        @return: fact name -> value or None if its command failed
+        @rtype: dict
+        """
+        if names is None:
+            names = sorted(FACTS)
+        commands = [FACTS[name] for name in names]
+        facts = dict((name, None) for name in names)
+        with self.facts.probing():
+            results = self.run_batch(commands, timeout)
+        for name, result in zip(names, results):
+            if result.status is None:
+                continue
+            self.facts.put(result.command, result, ttl)
+            if result.status == 0:
+                facts[name] = _text(result.stdout).strip()
+        return facts
+
+    def invalidate_facts(self, command=None):
+        """
+        Drop cached facts and command results
+
+        @param command: drop everything only if this command may change the
+                        host (see L{facts.FactCache}); None to drop
+                        unconditionally
+        @type command: str
+        """
+        if command is None:
+            self.facts.invalidate()
+        elif self.facts.observe(command):
+            self.logger.debug("Facts of %s invalidated by '%s'" % (self.hostname, command))
+            self.metrics.inc('facts_invalidations')
+
+    def put_tree(self, local_dir, remote_dir, workers=4, skip='size'):
+        """
+        Copy local directory tree to the host (see L{transfer.put_tree})
+
+        @param local_dir: local directory
+        @type local_dir: str
+
+        @param remote_dir: remote directory (created if missing)
+        @type remote_dir: str
+
+        @param workers: number of files uploaded concurrently
+        @type workers: int
+
+        @param skip: skip files whose 'size' or 'checksum' already matches,
+                     None to copy everything
+        @type skip: str or None
+
+        @return: transfer summary
+        @rtype: L{transfer.TransferResult}
+        """
+        from stitches import transfer
+        return transfer.put_tree(self, local_dir, remote_dir, workers, skip)
+
+    def get_tree(self, remote_dir, local_dir, workers=4, skip='size'):
+        """
+        Copy directory tree from the host (see L{transfer.get_tree})
+
+        @param remote_dir: remote directory
+        @type remote_dir: str
+
+        @param local_dir: local directory (created if missing)
+        @type local_dir: str
+
+        @param workers: number of files downloaded concurrently
+        @type workers: int
+
+        @param skip: skip files whose 'size' or 'checksum' already matches,
+                     None to copy everything
+        @type skip: str or None
+
+        @return: transfer summary
+        @rtype: L{transfer.TransferResult}
+        """
+        from stitches import transfer
+        return transfer.get_tree(self, remote_dir, local_dir, workers, skip)
+
+    def grep(self, path, pattern, context=0, before=None, after=None,
+             fixed=False, ignore_case=False, max_count=None, timeout=60):
+        """
+        Find lines matching pattern in remote file, on the host (see
+        L{remotefile.grep})
+
+        @param path: remote file
+        @type path: str
+
+        @param pattern: extended regular expression (or string if fixed)
+        @type pattern: str
+
+        @param context: number of lines around matches to return
+        @type context: int
+
+        @param max_count: stop reading the file after this number of matches
+        @type max_count: int
+
+        @return: matches in file order
+        @rtype: list of L{remotefile.GrepMatch}
+        """
+        from stitches import remotefile
+        return remotefile.grep(self, path, pattern, context, before, after,
+                               fixed, ignore_case, max_count, timeout)
+
+    def tail(self, path, lines=10, timeout=60):
+        """
+        Get last lines of remote file (see L{remotefile.tail})
+
+        @rtype: list of str
+        """
+        from stitches import remotefile
+        return remotefile.tail(self, path, lines, timeout)
+
+    def read_range(self, path, offset, length, timeout=60):
+        """
+        Read part of remote file (see L{remotefile.read_range})
+
+        @param offset: first byte to read
+        @type offset: int
+
+        @param length: maximum number of bytes to read
+        @type length: int
+
+        @rtype: bytes
+        """
+        from stitches import remotefile
+        return remotefile.read_range(self, path, offset, length, timeout)
+
+    def checksum(self, path, algorithm='sha256', timeout=600):
+        """
+        Compute checksum of remote file on the host (see
+        L{remotefile.checksum})
+
+        @return: hex digest
+        @rtype: str
+        """
+        from stitches import remotefile
+        return remotefile.checksum(self, path, algorithm, timeout)
+
+    def stat_many(self, paths, follow=True, timeout=60):
+        """
+        Stat remote paths in one round-trip (see L{remotefile.stat_many})
+
+        @return: path -> attributes (None if the path doesn't exist)
+        @rtype: dict of L{paramiko.SFTPAttributes}
+        """
+        from stitches import remotefile
+        return remotefile.stat_many(self, paths, follow, timeout)
+
+    def wait_for_pattern(self, path, pattern, timeout=60, offset=None,
+                         fixed=False, ignore_case=False):
+        """
+        Wait until a line matching pattern appears in remote file (see
+        L{remotefile.wait_for_pattern})
+
+        @param offset: byte offset to search from (None for lines appended
+                       after the call only)
+        @type offset: int
+
+        @return: matching line
+        @rtype: str
+
+        @raises ExpectFailed: if no such line appears within timeout
+        """
+        from stitches import remotefile
+        return remotefile.wait_for_pattern(self, path, pattern, timeout, offset,
+                                           fixed, ignore_case)
+
+    def run_batch(self, commands, timeout=10, stop_on_error=False):
+        """
+        Execute a list of commands in one remote session
+
+        Commands are run one after another in subshells (so e.g. 'cd' doesn't
+        affect following commands) with stdin redirected from /dev/null.
+        Output of each command is framed with unique markers to get separate
+        exit status, stdout and stderr for every command. Durations of
+        individual commands are not measured.
+
+        @param commands: commands to execute
+        @type commands: list of str
+
+        @param timeout: timeout for the whole batch (seconds)
+        @type timeout: int or float
+
+        @param stop_on_error: don't run commands following the first failed
+                              one
+        @type stop_on_error: bool
+
+        @return: results of executed commands, the last one has None status
+                 in case of timeout
+        @rtype: list of L{CommandResult}
+        """
+        token = 'STITCHES_' + ''.join(random.choice(string.ascii_uppercase) for x in range(16))
+        script = []
+        for idx, command in enumerate(commands):
+            script.append("printf '%s:%i:B\\n'; printf '%s:%i:B\\n' >&2" % (token, idx, token, idx))
+            script.append("(\n%s\n) </dev/null" % command)
+            script.append("__stitches_rc=$?")
+            script.append("printf '\\n%s:%i:E:%%s\\n' $__stitches_rc; "
+                          "printf '\\n%s:%i:E:%%s\\n' $__stitches_rc >&2" % (token, idx, token, idx))
+            if stop_on_error:
+                script.append("[ $__stitches_rc -eq 0 ] || exit $__stitches_rc")
+        output = {'stdout': [], 'stderr': []}
+        for name, data in self.stream("\n".join(script), timeout):
+            output[name].append(data)
+        self.last_command = "\n".join(commands)
+        stdout = _split_batch(b''.join(output['stdout']), token)
+        stderr = _split_batch(b''.join(output['stderr']), token)
+        results = []
+        for idx, command in enumerate(commands):
+            if idx not in stdout:
+                break
+            out, status = stdout[idx]
+            err = stderr.get(idx, (b'', None))[0]
+            results.append(CommandResult(self.hostname, command, status, out, err))
+        return results
@@ -0,0 +1,338 @@
+"""
+One-to-many artifact distribution across a L{Structure}
+
+By default the controller uploads the artifact to every host itself,
+'seeds' hosts at a time. With relay=True it uploads to a few seed hosts
+only, and every host holding a verified copy then relays it to other hosts
+with ssh over their private network, so the controller's uplink carries the
+artifact just 'seeds' times regardless of the number of hosts.
+
+Relaying uses an ephemeral key pair created for the distribution: the
+private key is copied to the hosts over SFTP and the public key is added to
+their authorized_keys, both are removed when the distribution finishes. The
+authorized_keys entry only accepts connections from the other hosts of the
+distribution and only runs the command receiving this host's partial copy,
+so an entry left behind by a killed controller grants nothing else. Hosts
+must be able to reach each other's private_hostname and port with ssh.
+"""
+
+import collections
+import logging
+import os
+import posixpath
+import random
+import string
+import threading
+
+import io
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import paramiko
+
+from stitches.connection import StitchesConnectionException
+from stitches.structure import _imap_unordered
+from stitches.transfer import _sha256, quote
+
+# authorized_keys options of the relay key (what 'restrict' stands for, which
+# older sshd versions don't know)
+_KEY_OPTIONS = "no-agent-forwarding,no-port-forwarding,no-pty,no-user-rc,no-X11-forwarding"
+
+_SSH_OPTIONS = ("-o BatchMode=yes -o StrictHostKeyChecking=no "
+                "-o UserKnownHostsFile=/dev/null -o LogLevel=ERROR")
+
+CONTROLLER = 'controller'
+
+
+class StitchesDistributionException(StitchesConnectionException):
+    """
+    Artifact couldn't be delivered to some instances
+    """
+    def __init__(self, failures):
+        """
+        @param failures: hostname -> exception
+        @type failures: dict
+        """
+        StitchesConnectionException.__init__(
+            self, "Failed to distribute to %i instance(s): %s" %
+            (len(failures), ", ".join("%s (%s)" % (hostname, failures[hostname])
+                                      for hostname in sorted(failures))))
+        self.failures = failures
+
+
+class _Distribution(object):
+    """
+    State of one distribution
+    """
+    def __init__(self, local_path, remote_path, timeout, progress, relay=False):
+        self.logger = logging.getLogger('stitches.distribute')
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.timeout = timeout
+        self.progress = progress
+        self.relay_copies = relay
+        self.digest = _sha256(local_path)
+        self.size = os.path.getsize(local_path)
+        self.token = ''.join(random.choice(string.ascii_lowercase + string.digits)
+                             for _ in range(16))
+        self.workdir = '/tmp/stitches-distribute-' + self.token
+        self.private_key, self.public_key = None, None
+        if relay:
+            key = paramiko.RSAKey.generate(2048)
+            private = StringIO()
+            key.write_private_key(private)
+            self.private_key = private.getvalue()
+            self.public_key = '%s %s stitches-distribute-%s' % (key.get_name(), key.get_base64(),
+                                                                self.token)
+        # partial copies are named per target: hosts may share a filesystem
+        self.parts = {}
+        # addresses relaying hosts connect from
+        self.sources = set()
+
+    @staticmethod
+    def output_digest(output):
+        """ Get checksum from sha256sum output """
+        words = output.decode('utf-8', 'replace').split()
+        return words[0] if words else None
+
+    def report(self, connection, state, detail=None):
+        """ Call progress callback """
+        if self.progress is not None:
+            self.progress(connection.hostname, state, detail)
+
+    def check(self, connection, command):
+        """ Run command, raise on failure """
+        if connection.recv_exit_status(command, self.timeout) != 0:
+            raise StitchesConnectionException("Command '%s' failed on %s: %s" %
+                                              (command.split(' ', 1)[0], connection.hostname,
+                                               connection.last_stderr or connection.last_status))
+
+    def receive_command(self, connection):
+        """ Command writing relayed data to the partial copy on connection """
+        # the receiving side checksums what it actually wrote
+        return "tee %s | sha256sum" % quote(self.parts[connection])
+
+    def add_source(self, connection):
+        """ Allow relaying from the host of connection """
+        self.sources.add(connection.private_hostname)
+        # the address the host is reached at on its network
+        self.sources.add(connection.cli.get_transport().getpeername()[0])
+
+    def authorized_key(self, connection):
+        """ authorized_keys entry of the relay key on connection """
+        command = self.receive_command(connection).replace('\\', '\\\\').replace('"', '\\"')
+        return 'from="%s",command="%s",%s %s' % (",".join(sorted(self.sources)), command,
+                                                 _KEY_OPTIONS, self.public_key)
+
+    def prepare(self, connection):
+        """ Create target directory, install ephemeral key when relaying """
+        dirname = quote(posixpath.dirname(self.remote_path) or '.')
+        if not self.relay_copies:
+            self.check(connection, "mkdir -p %s" % dirname)
+            return
+        self.check(connection, "umask 077 && mkdir -p %s && mkdir -p %s" % (quote(self.workdir), dirname))
+        # keys never appear in command lines
+        sftp = connection.sftp
+        with sftp.open(self.workdir + '/key', 'w') as key:
+            key.chmod(0o600)
+            key.write(self.private_key)
+        entry = io.BytesIO((self.authorized_key(connection) + '\n').encode('utf-8'))
+        sftp.putfo(entry, self.workdir + '/authorized_key')
+        self.check(connection, "umask 077 && mkdir -p ~/.ssh && cat %s >> ~/.ssh/authorized_keys" %
+                   quote(self.workdir + '/authorized_key'))
+
+    def cleanup(self, connection):
+        """ Remove ephemeral key and partial copy """
+        command = "rm -rf %s %s" % (quote(self.workdir), quote(self.parts[connection]))
+        if self.relay_copies:
+            command += "; sed -i '/ stitches-distribute-%s$/d' ~/.ssh/authorized_keys" % self.token
+        try:
+            connection.recv_exit_status(command, self.timeout)
+        except Exception as err:
+            self.logger.debug('Cleanup failed on %s: %s', connection.hostname, err)
+
+    def commit(self, connection, digest):
+        """ Move verified partial copy to its place """
+        part = self.parts[connection]
+        if digest != self.digest:
+            connection.recv_exit_status("rm -f %s" % quote(part), self.timeout)
+            raise StitchesConnectionException("Checksum mismatch on %s: %s (%s expected)" %
+                                              (connection.hostname, digest, self.digest))
+        self.check(connection, "mv -f %s %s" % (quote(part), quote(self.remote_path)))
+
+    def upload(self, connection):
+        """ Upload artifact from the controller """
+        part = self.parts[connection]
+        connection.sftp.put(self.local_path, part)
+        connection.metrics.inc('bytes_sent', self.size)
+        self.check(connection, "sha256sum %s" % quote(part))
+        self.commit(connection, self.output_digest(connection.last_stdout))
+
+    def relay(self, source, target):
+        """ Copy artifact from source host to target host """
+        # the target runs the command forced by its authorized_keys entry
+        self.check(source, "ssh -i %s -p %i %s %s %s < %s" %
+                   (quote(self.workdir + '/key'), target.port, _SSH_OPTIONS,
+                    quote('%s@%s' % (target.username, target.private_hostname)),
+                    quote(self.receive_command(target)), quote(self.remote_path)))
+        self.commit(target, self.output_digest(source.last_stdout))
+
+    def copy(self, source, target):
+        """
+        Deliver artifact to target, falling back to an upload from the
+        controller when relaying fails
+
+        @return: hostname of the host the copy came from or L{CONTROLLER}
+        @rtype: str
+        """
+        if source is not None:
+            self.report(target, 'copying', source.hostname)
+            try:
+                self.relay(source, target)
+                return source.hostname
+            except Exception as err:
+                self.logger.debug('Relay %s -> %s failed, uploading from controller: %s',
+                                  source.hostname, target.hostname, err)
+        self.report(target, 'copying', CONTROLLER)
+        self.upload(target)
+        return CONTROLLER
+
+    def run(self, connections, seeds, fanout):
+        """
+        Deliver artifact to all connections
+
+        @return: (hostname -> origin, hostname -> exception)
+        @rtype: tuple
+        """
+        pending = collections.deque(connections)
+        # free transfer slots: None stands for the controller
+        slots = collections.deque([None] * max(1, seeds))
+        results = queue.Queue()
+        delivered, failures = {}, {}
+        running = 0
+
+        def worker(source, target):
+            """ Copy thread """
+            try:
+                results.put((source, target, self.copy(source, target), None))
+            except Exception as err:
+                results.put((source, target, None, err))
+
+        while pending or running:
+            if not slots and not running:
+                # nobody holds a copy yet, the controller retries
+                slots.append(None)
+            while slots and pending:
+                thread = threading.Thread(target=worker, args=(slots.popleft(), pending.popleft()))
+                thread.daemon = True
+                thread.start()
+                running += 1
+            source, target, origin, error = results.get()
+            running -= 1
+            if error is None:
+                delivered[target.hostname] = origin
+                self.report(target, 'done', origin)
+                if self.relay_copies:
+                    slots.extend([target] * fanout)
+            else:
+                failures[target.hostname] = error
+                self.report(target, 'failed', error)
+            # controller slots are used for seeding only when relaying
+            if source is not None or not self.relay_copies:
+                slots.append(source)
+        return delivered, failures
+
+
+def distribute(connections, local_path, remote_path, seeds=2, fanout=2,
+               timeout=3600, progress=None, workers=32,
+               raise_on_failure=True, relay=False):
+    """
+    Copy local file to all connections, relaying it between hosts if
+    allowed
+
+    @param connections: connections to copy the file to
+    @type connections: list of L{Connection}
+
+    @param local_path: local file
+    @type local_path: str
+
+    @param remote_path: remote file (parent directory is created if
+                        missing)
+    @type remote_path: str
+
+    @param seeds: number of hosts the controller uploads to (concurrently
+                  when not relaying)
+    @type seeds: int
+
+    @param fanout: number of hosts every holder of a copy relays to
+                   concurrently
+    @type fanout: int
+
+    @param timeout: timeout for a single copy (seconds)
+    @type timeout: int or float
+
+    @param progress: function called with (hostname, state, detail), state
+                     is 'copying' (detail is the source hostname or
+                     L{CONTROLLER}), 'done' (detail is the source) or 'failed'
+                     (detail is the exception)
+    @type progress: callable
+
+    @param workers: maximum number of hosts prepared and cleaned up
+                    concurrently
+    @type workers: int
+
+    @param raise_on_failure: raise an exception listing all instances the
+                             file couldn't be delivered to
+    @type raise_on_failure: bool
+
+    @param relay: let hosts holding a copy relay it to other hosts over ssh,
+                  which needs an ephemeral key accepted by all hosts (see
+                  L{distribute}); otherwise the controller uploads to every
+                  host
+    @type relay: bool
+
+    @return: hostname -> source hostname or L{CONTROLLER}
+    @rtype: dict
+
+    @raises StitchesDistributionException
+    """
+    distribution = _Distribution(local_path, remote_path, timeout, progress, relay)
+    targets, seen = [], set()
+    for connection in connections:
+        # the same host may be listed in several roles
+        if (connection.private_hostname, connection.port) not in seen:
+            seen.add((connection.private_hostname, connection.port))
+            distribution.parts[connection] = '%s.stitches-%s-%i' % (remote_path, distribution.token,
+                                                                    len(targets))
+            targets.append(connection)
+
+    prepared, failures = [], {}
+    if relay:
+        for connection, _, error in _imap_unordered(distribution.add_source, targets, workers):
+            if error is not None:
+                distribution.logger.debug('No peer address of %s: %s', connection.hostname, error)
+    try:
+        for connection, _, error in _imap_unordered(distribution.prepare, targets, workers):
+            if error is None:
+                prepared.append(connection)
+            else:
+                failures[connection.hostname] = error
+                distribution.report(connection, 'failed', error)
+        # keep the order of connections: the first ones become seeds
+        prepared.sort(key=targets.index)
+        delivered, copy_failures = distribution.run(prepared, seeds, fanout)
+        failures.update(copy_failures)
+    finally:
+        for _ in _imap_unordered(distribution.cleanup, prepared, workers):
+            pass
+    if failures and raise_on_failure:
+        raise StitchesDistributionException(failures)
+    return delivered
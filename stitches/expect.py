@@ -5,11 +5,24 @@ Expect-like stuff
 import re
 import time
 import logging
-import socket
+import select
+import codecs
 import sys
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 CTRL_C = '\x03'
 
+# maximum number of characters kept in the transcript while expecting
+TRANSCRIPT_LIMIT = 1048576
+
+# substring expectations whose matches are at most this long are only
+# searched for near newly received data, others in the whole transcript
+SEARCH_WINDOW = 4096
+
 
 class ExpectFailed(AssertionError):
     '''
@@ -18,10 +31,175 @@ class ExpectFailed(AssertionError):
     pass
 
 
+def _merge(patterns):
+    '''
+    Merge compiled patterns into one alternation
+
+    @return: compiled pattern with every alternative in a named group or
+             None if patterns can't be merged safely
+    '''
+    if len(patterns) < 2:
+        return None
+    flags = set(pattern.flags for pattern in patterns)
+    if len(flags) != 1:
+        return None
+    for pattern in patterns:
+        # group numbers get shifted by merging, back references would break
+        if pattern.groups and re.search(r'\\[1-9]|\(\?P=', pattern.pattern):
+            return None
+    try:
+        return re.compile('|'.join('(?P<_stitches_%i>%s)' % (idx, pattern.pattern)
+                                   for idx, pattern in enumerate(patterns)),
+                          flags.pop())
+    except re.error:
+        return None
+
+
+def _max_width(patterns):
+    '''
+    Get length of the longest possible match of patterns
+
+    @return: number of characters or None if unbounded (e.g. 'START.*END')
+             or longer than SEARCH_WINDOW
+    @rtype: int or None
+    '''
+    width = 0
+    for pattern in patterns:
+        try:
+            width = max(width, sre_parse.parse(pattern.pattern, pattern.flags).getwidth()[1])
+        except Exception:
+            return None
+    if width > SEARCH_WINDOW:
+        return None
+    return width
+
+
+class _Matcher(object):
+    '''
+    Incremental matcher of channel output against a list of expressions
+    '''
+    def __init__(self, regexp_list, search=False, limit=TRANSCRIPT_LIMIT):
+        '''
+        Create matcher
+
+        @param regexp_list: regular expressions and associated return values
+        @type regexp_list: list of (regexp, return value)
+
+        @param search: search for expressions anywhere in the output instead
+                       of matching the whole output
+        @type search: bool
+
+        @param limit: maximum number of characters kept in the transcript
+        @type limit: int
+        '''
+        self.patterns = [re.compile(regexp) if not hasattr(regexp, 'match') else regexp
+                         for (regexp, _) in regexp_list]
+        self.values = [retvalue for (_, retvalue) in regexp_list]
+        self.merged = _merge(self.patterns)
+        self.search = search
+        # matches of bounded length can't start earlier before new data
+        self.window = _max_width(self.patterns) if search else None
+        self.limit = limit
+        self.transcript = ""
+        self.scanned = 0
+        self.changed = True
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def feed(self, data):
+        '''
+        Add received data to the transcript
+
+        @return: decoded data
+        @rtype: str
+        '''
+        text = self.decoder.decode(data)
+        self.transcript += text
+        if len(self.transcript) > self.limit:
+            dropped = len(self.transcript) - self.limit
+            self.transcript = self.transcript[dropped:]
+            self.scanned = max(0, self.scanned - dropped)
+        self.changed = True
+        return text
+
+    def match(self):
+        '''
+        Match the transcript against expressions
+
+        @return: (match object, return value) of the first matching
+                 expression or None
+        @rtype: tuple or None
+        '''
+        if not self.changed:
+            return None
+        self.changed = False
+        if self.search:
+            start = 0
+            if self.window is not None:
+                start = max(0, self.scanned - self.window)
+            self.scanned = len(self.transcript)
+            attempt = lambda pattern: pattern.search(self.transcript, start)
+        else:
+            attempt = lambda pattern: pattern.match(self.transcript)
+        if self.merged is not None:
+            match = attempt(self.merged)
+            if match is None:
+                return None
+            for idx in range(len(self.patterns)):
+                if match.group('_stitches_%i' % idx) is not None:
+                    return match, self.values[idx]
+        for idx, pattern in enumerate(self.patterns):
+            # search for the first matching regexp and return desired value
+            match = attempt(pattern)
+            if match:
+                return match, self.values[idx]
+        return None
+
+
 class Expect(object):
     '''
     Stateless class to do expect-ike stuff over connections
+
+    Methods work with the connection's default shell; an interactive session
+    from L{Connection.open_session} can be passed instead of the connection
+    to use that session's shell.
     '''
+    @staticmethod
+    def _wait(connection, matcher, timeout):
+        '''
+        Read from the connection's channel until matcher succeeds
+
+        @return: (match object, return value)
+        @rtype: tuple
+
+        @raises ExpectFailed
+        '''
+        channel = connection.channel
+        start = time.time()
+        deadline = start + timeout
+        try:
+            while True:
+                result = matcher.match()
+                if result is not None:
+                    return result
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if channel.recv_ready():
+                    data = channel.recv(32768)
+                    connection.metrics.inc('bytes_received', len(data))
+                    recv_part = matcher.feed(data)
+                    logging.getLogger('stitches.expect').debug("RCV: " + recv_part)
+                    if connection.output_shell:
+                        sys.stdout.write(recv_part)
+                elif channel.closed or channel.eof_received:
+                    break
+                else:
+                    # wake up as soon as the channel becomes readable
+                    select.select([channel], [], [], remaining)
+        finally:
+            connection.metrics.observe('expect_wait_seconds', time.time() - start)
+        raise ExpectFailed(matcher.transcript)
+
     @staticmethod
     def expect_list(connection, regexp_list, timeout=10):
         '''
@@ -34,33 +212,14 @@ class Expect(object):
         @type regexp_list: list of (regexp, return value)
 
         @param timeout: timeout for performing expect operation
-        @type timeout: int
+        @type timeout: int or float
 
         @return: propper return value from regexp_list
         @rtype: return value
 
         @raises ExpectFailed
         '''
-        result = ""
-        count = 0
-        while count < timeout:
-            try:
-                recv_part = connection.channel.recv(32768).decode()
-                logging.getLogger('stitches.expect').debug("RCV: " + recv_part)
-                if connection.output_shell:
-                    sys.stdout.write(recv_part)
-                result += recv_part
-            except socket.timeout:
-                # socket.timeout here means 'no more data'
-                pass
-
-            for (regexp, retvalue) in regexp_list:
-                # search for the first matching regexp and return desired value
-                if re.match(regexp, result):
-                    return retvalue
-            time.sleep(1)
-            count += 1
-        raise ExpectFailed(result)
+        return Expect._wait(connection, _Matcher(regexp_list), timeout)[1]
 
     @staticmethod
     def expect(connection, strexp, timeout=10):
@@ -74,17 +233,18 @@ class Expect(object):
         @type strexp: str
 
         @param timeout: timeout for performing expect operation
-        @type timeout: int
+        @type timeout: int or float
 
         @return: True if succeeded
         @rtype: bool
 
         @raises ExpectFailed
         '''
-        return Expect.expect_list(connection,
-                                  [(re.compile(".*" + strexp + ".*",
-                                               re.DOTALL), True)],
-                                  timeout)
+        # searching for strexp is equivalent to matching .*strexp.*, strings
+        # of bounded length are only searched for near new output
+        matcher = _Matcher([(re.compile(strexp, re.DOTALL), True)],
+                           search=True)
+        return Expect._wait(connection, matcher, timeout)[1]
 
     @staticmethod
     def match(connection, regexp, grouplist=[1], timeout=10):
@@ -101,7 +261,7 @@ class Expect(object):
         @type group: list of int
 
         @param timeout: timeout for performing expect operation
-        @type timeout: int
+        @type timeout: int or float
 
         @return: matched string
         @rtype: str
@@ -109,29 +269,124 @@ class Expect(object):
         @raises ExpectFailed
         '''
         logging.getLogger('stitches.expect').debug("MATCHING: " + regexp.pattern)
-        result = ""
-        count = 0
-        while count < timeout:
-            try:
-                recv_part = connection.channel.recv(32768).decode()
-                logging.getLogger('stitches.expect').debug("RCV: " + recv_part)
-                if connection.output_shell:
-                    sys.stdout.write(recv_part)
-                result += recv_part
-            except socket.timeout:
-                # socket.timeout here means 'no more data'
-                pass
-
-            match = regexp.match(result)
-            if match:
-                ret_list = []
-                for group in grouplist:
-                    logging.getLogger('stitches.expect').debug("matched: " + match.group(group))
-                    ret_list.append(match.group(group))
-                return ret_list
-            time.sleep(1)
-            count += 1
-        raise ExpectFailed(result)
+        match = Expect._wait(connection, _Matcher([(regexp, None)]), timeout)[0]
+        ret_list = []
+        for group in grouplist:
+            logging.getLogger('stitches.expect').debug("matched: " + match.group(group))
+            ret_list.append(match.group(group))
+        return ret_list
+
+    @staticmethod
+    def iter_many(targets, timeout=10):
+        '''
+        Expect expressions on many connections at once
+
+        All channels are watched with one select() call, output of every
+        channel is searched for its own expressions (like L{expect}).
+
+        @param targets: (connection, expressions) tuples, expressions are
+                        either a string or a list of (regexp, return value)
+        @type targets: list of tuple
+
+        @param timeout: overall timeout
+        @type timeout: int or float
+
+        @return: generator of (connection, return value) tuples in order of
+                 matching
+        @rtype: generator
+
+        @raises ExpectFailed: when timeout expires or channels close before
+                              all expressions matched
+        '''
+        entries = []
+        for connection, regexp_list in targets:
+            if not isinstance(regexp_list, (list, tuple)):
+                regexp_list = [(re.compile(regexp_list, re.DOTALL), True)]
+            entries.append((connection, connection.channel, _Matcher(regexp_list, search=True)))
+        failed = []
+        start = time.time()
+        deadline = start + timeout
+        try:
+            while entries:
+                for entry in list(entries):
+                    result = entry[2].match()
+                    if result is not None:
+                        entries.remove(entry)
+                        yield entry[0], result[1]
+                channels = []
+                for connection, channel, matcher in entries:
+                    if channel not in channels:
+                        channels.append(channel)
+                remaining = deadline - time.time()
+                if not channels or remaining <= 0:
+                    break
+                ready = [channel for channel in channels if channel.recv_ready()]
+                for channel in ready:
+                    data = channel.recv(32768)
+                    for connection, entry_channel, matcher in entries:
+                        if entry_channel is channel:
+                            connection.metrics.inc('bytes_received', len(data))
+                            recv_part = matcher.feed(data)
+                            if connection.output_shell:
+                                sys.stdout.write(recv_part)
+                if ready:
+                    continue
+                for entry in list(entries):
+                    if entry[1].closed or entry[1].eof_received:
+                        entries.remove(entry)
+                        failed.append(entry)
+                # wake up as soon as any channel becomes readable
+                select.select([channel for channel in channels
+                               if not channel.closed and not channel.eof_received], [], [], remaining)
+        finally:
+            for connection, _ in targets:
+                connection.metrics.observe('expect_wait_seconds', time.time() - start)
+        if entries or failed:
+            raise ExpectFailed("\n".join("%s:\n%s" % (connection.hostname, matcher.transcript)
+                                         for connection, _, matcher in failed + entries))
+
+    @staticmethod
+    def expect_many(targets, timeout=10, mode='all'):
+        '''
+        Expect expressions on many connections at once (see L{iter_many})
+
+        @param targets: (connection, expressions) tuples, expressions are
+                        either a string or a list of (regexp, return value)
+        @type targets: list of tuple
+
+        @param timeout: overall timeout
+        @type timeout: int or float
+
+        @param mode: 'all' to wait for all connections, 'first' for the
+                     first match or number of matches to wait for
+        @type mode: str or int
+
+        @return: (connection, return value) tuples in order of matching
+        @rtype: list
+
+        @raises ExpectFailed: if fewer connections than required matched
+        '''
+        if mode == 'all':
+            required = len(targets)
+        elif mode == 'first':
+            required = 1
+        else:
+            required = int(mode)
+        matches = []
+        if required <= 0:
+            return matches
+        results = Expect.iter_many(targets, timeout)
+        try:
+            for result in results:
+                matches.append(result)
+                if len(matches) >= required:
+                    break
+        except ExpectFailed as err:
+            raise ExpectFailed("%i of %i required matches, unmatched output:\n%s"
+                               % (len(matches), required, err))
+        finally:
+            results.close()
+        return matches
 
     @staticmethod
     def enter(connection, command):
@@ -147,6 +402,8 @@ class Expect(object):
         @return: number of bytes actually sent
         @rtype: int
         '''
+        connection.invalidate_facts(command)
+        connection.metrics.inc('bytes_sent', len(command) + 1)
         return connection.channel.send(command + "\n")
 
     @staticmethod
@@ -165,7 +422,7 @@ class Expect(object):
         @type strexp: str
 
         @param timeout: timeout for performing expect operation
-        @type  timeout: int
+        @type  timeout: int or float
 
         @return: True if succeeded
         @rtype: bool
@@ -190,7 +447,7 @@ class Expect(object):
         @type expected_status: int
 
         @param timeout: timeout for performing expect operation
-        @type  timeout: int
+        @type  timeout: int or float
 
         @return: return value
         @rtype: int
@@ -199,7 +456,7 @@ class Expect(object):
         '''
         retval = connection.recv_exit_status(command, timeout)
         if retval is None:
-            raise ExpectFailed("Got timeout (%i seconds) while executing '%s'"
+            raise ExpectFailed("Got timeout (%s seconds) while executing '%s'"
                                % (timeout, command))
         elif retval != expected_status:
             raise ExpectFailed("Got %s exit status (%s expected)\ncmd: %s\nstdout: %s\nstderr: %s"
@@ -209,3 +466,53 @@ class Expect(object):
             sys.stdout.write("Run '%s', got %i return value\n"
                              % (command, retval))
         return retval
+
+    @staticmethod
+    def expect_batch(connection, commands, expected_status=0, timeout=10,
+                     stop_on_error=True):
+        '''
+        Run commands in one remote session and expect specified return
+        values (see L{Connection.run_batch})
+
+        @param connection: connection to the host
+        @type connection: L{Connection}
+
+        @param commands: commands to execute
+        @type commands: list of str
+
+        @param expected_status: expected return value for all commands or a
+                                list of return values (one per command)
+        @type expected_status: int or list of int
+
+        @param timeout: timeout for executing the whole batch
+        @type  timeout: int or float
+
+        @param stop_on_error: don't run commands following the first failed
+                              one (when all expected statuses are 0)
+        @type stop_on_error: bool
+
+        @return: command results
+        @rtype: list of L{CommandResult}
+
+        @raises ExpectFailed
+        '''
+        if not isinstance(expected_status, (list, tuple)):
+            expected_status = [expected_status] * len(commands)
+        # remote side can only stop on non-zero statuses
+        results = connection.run_batch(commands, timeout,
+                                       stop_on_error and not any(expected_status))
+        for result, expected in zip(results, expected_status):
+            if result.status is None:
+                raise ExpectFailed("Got timeout (%s seconds) while executing '%s'"
+                                   % (timeout, result.command))
+            elif result.status != expected:
+                raise ExpectFailed("Got %s exit status (%s expected)\ncmd: %s\nstdout: %s\nstderr: %s"
+                                   % (result.status, expected, result.command,
+                                      result.stdout, result.stderr))
+            if connection.output_shell:
+                sys.stdout.write("Run '%s', got %i return value\n"
+                                 % (result.command, result.status))
+        if len(results) < len(commands):
+            raise ExpectFailed("Batch stopped after '%s'" % results[-1].command
+                               if results else "Batch failed to start")
+        return results
@@ -0,0 +1,170 @@
+"""
+Cache of host facts and results of idempotent commands
+
+Probes like 'cat /etc/redhat-release' or 'uname -r' return the same output
+until something changes the host. L{Connection.cached_run} and
+L{Connection.fact} keep their results in a per-connection L{FactCache} for
+ttl seconds. Whether an arbitrary command changes the host can't be told
+from its text, so the cache is emptied whenever any other command is
+executed on the connection; only the probes in L{FACTS} and commands run
+through L{Connection.cached_run} keep it. A cache created with the
+L{MUTATING} regexp is emptied by commands matching it only, which is
+best-effort: commands it doesn't recognize (scripts, tools not listed) leave
+stale results in place until they expire.
+"""
+
+import collections
+import contextlib
+import re
+import threading
+import time
+
+# named facts and commands producing them
+FACTS = {
+    'release': 'cat /etc/redhat-release',
+    'os_release': 'cat /etc/os-release',
+    'kernel': 'uname -r',
+    'arch': 'uname -m',
+    'hostname': 'hostname',
+    'packages': 'rpm -qa | sort',
+}
+
+# commands which don't invalidate the cache
+PROBES = frozenset(FACTS.values())
+
+# best-effort list of commands invalidating the cache: package management,
+# reboots, host configuration, processes, file modifications, scripts and
+# redirections to files other than /dev/null
+MUTATING = re.compile(
+    r'(?:^|[\s;&|(`])(?:(?:yum|dnf|apt-get|apt|zypper|subscription-manager|pip|pip3|reboot|'
+    r'shutdown|kexec|hostnamectl|setenforce|mount|umount|cp|mv|rm|rmdir|mkdir|touch|'
+    r'truncate|ln|dd|install|tee|chmod|chown|useradd|userdel|usermod|passwd|chpasswd|'
+    r'systemctl|service|kill|pkill|killall|modprobe|insmod|rmmod|firewall-cmd|iptables|'
+    r'ip6tables|nft|sh|bash|source)\b|rpm\s+-[iUFe]|hostname\s+[^\s;&|-]|sysctl\s+-w|'
+    r'sed\s+-i|\.{0,2}/[^\s;&|]*\.sh\b|\.\s)'
+    r'|(?<![0-9&>])>>?\s*(?!/dev/null|&)')
+
+
+class FactCache(object):
+    """
+    Least recently used cache of command results expiring after ttl seconds
+    """
+    def __init__(self, ttl=300, size=256, mutating=None):
+        """
+        Create cache
+
+        @param ttl: default number of seconds results are valid for (None
+                    for no expiration)
+        @type ttl: int or float
+
+        @param size: maximum number of cached results
+        @type size: int
+
+        @param mutating: commands emptying the cache when executed: None for
+                         every command but L{PROBES} and cached ones, a
+                         regexp (e.g. L{MUTATING}) for matching commands only
+                         (a regexp matching nothing, e.g. '(?!)', to
+                         invalidate explicitly only)
+        @type mutating: str or compiled regexp or None
+        """
+        self.ttl = ttl
+        self.size = size
+        if mutating is not None and not hasattr(mutating, 'search'):
+            mutating = re.compile(mutating)
+        self.mutating = mutating
+        self.lock = threading.Lock()
+        # probing depth of threads (see probing())
+        self.local = threading.local()
+        # command -> (expiration time, result)
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, command):
+        """
+        Get cached result
+
+        @param command: executed command
+        @type command: str
+
+        @return: result or None if not cached or expired
+        @rtype: L{CommandResult} or None
+        """
+        with self.lock:
+            entry = self.entries.pop(command, None)
+            if entry is None:
+                return None
+            expires, result = entry
+            if expires is not None and expires < time.time():
+                return None
+            # most recently used entries go last
+            self.entries[command] = entry
+            return result
+
+    def put(self, command, result, ttl=None):
+        """
+        Cache result
+
+        @param command: executed command
+        @type command: str
+
+        @param result: command result
+        @type result: L{CommandResult}
+
+        @param ttl: number of seconds the result is valid for (cache's ttl
+                    by default)
+        @type ttl: int or float
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.entries.pop(command, None)
+            self.entries[command] = (None if ttl is None else time.time() + ttl, result)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, command=None):
+        """
+        Drop cached result(s)
+
+        @param command: command to forget (everything if None)
+        @type command: str
+        """
+        with self.lock:
+            if command is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(command, None)
+
+    @contextlib.contextmanager
+    def probing(self):
+        """
+        Context manager for executing probes: commands executed by the
+        current thread within the block don't invalidate the cache
+        """
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+
+    def observe(self, command):
+        """
+        Invalidate the cache if command may change the host
+
+        @param command: command about to be executed
+        @type command: str
+
+        @return: True if the cache was invalidated
+        @rtype: bool
+        """
+        if not self.entries or getattr(self.local, 'depth', 0):
+            return False
+        if command in PROBES or command in self.entries:
+            return False
+        if self.mutating is not None and not self.mutating.search(command):
+            return False
+        self.invalidate()
+        return True
@@ -0,0 +1,431 @@
+"""
+Host inventory behind L{Structure}
+
+Every instance is kept as a small L{HostRecord} holding the parameters it
+was added with; its L{Connection} is only created when the instance is
+used. Records are indexed by role, hostname and labels (the 'labels'
+mapping of an instance entry) so that hosts can be found without scanning
+the whole setup.
+
+Selectors are comma separated terms which all have to match:
+ - key=value: role, hostname or label equals value (value1|value2 for
+   alternatives, boolean labels are 'true' or 'false')
+ - key!=value: role, hostname or label doesn't equal value
+ - key: label is set
+ - !key: label is not set
+"""
+
+import threading
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+import yaml
+
+# C parser is used when libyaml is available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# first characters of plain scalars which may resolve to something else than
+# a string
+_RESOLVED_FIRST = frozenset(yaml.resolver.Resolver.yaml_implicit_resolvers)
+_STR_TAG = 'tag:yaml.org,2002:str'
+_MAP_TAGS = (None, '!', 'tag:yaml.org,2002:map')
+_SEQ_TAGS = (None, '!', 'tag:yaml.org,2002:seq')
+_MERGE_TAG = 'tag:yaml.org,2002:merge'
+
+# connections are created under this lock so that concurrent first uses get
+# the same object
+_LOCK = threading.Lock()
+
+
+class _Unsupported(Exception):
+    """ Document needs the regular loader """
+    pass
+
+
+class _EventLoader(object):
+    """
+    Build the first document straight from parser events
+
+    Unlike yaml.load no node tree is composed and plain scalars which can
+    only be strings (e.g. hostnames) skip implicit tag resolution, which is
+    what dominates loading of large inventories.
+    """
+    def __init__(self, stream):
+        self.events = yaml.parse(stream, Loader=YAML_LOADER)
+        self.anchors = {}
+        # resolves and constructs the remaining scalars
+        self.constructor = yaml.SafeLoader('')
+        self.scalars = {}
+
+    def load(self):
+        """ Build document (None for an empty stream) """
+        document = None
+        for event in self.events:
+            if isinstance(event, yaml.DocumentStartEvent):
+                if document is not None:
+                    # let the regular loader complain
+                    raise _Unsupported()
+                document = self._build(next(self.events))
+        return document
+
+    def _build(self, event):
+        """ Build object starting with event """
+        if isinstance(event, yaml.AliasEvent):
+            if event.anchor not in self.anchors:
+                raise _Unsupported()
+            return self.anchors[event.anchor]
+        if isinstance(event, yaml.ScalarEvent):
+            value = self._scalar(event)
+        elif isinstance(event, yaml.MappingStartEvent):
+            if event.tag not in _MAP_TAGS:
+                raise _Unsupported()
+            value = {}
+            if event.anchor is not None:
+                self.anchors[event.anchor] = value
+            while True:
+                item = next(self.events)
+                if isinstance(item, yaml.MappingEndEvent):
+                    break
+                key = self._build(item)
+                try:
+                    value[key] = self._build(next(self.events))
+                except TypeError:
+                    # unhashable key
+                    raise _Unsupported()
+        elif isinstance(event, yaml.SequenceStartEvent):
+            if event.tag not in _SEQ_TAGS:
+                raise _Unsupported()
+            value = []
+            if event.anchor is not None:
+                self.anchors[event.anchor] = value
+            while True:
+                item = next(self.events)
+                if isinstance(item, yaml.SequenceEndEvent):
+                    break
+                value.append(self._build(item))
+        else:
+            raise _Unsupported()
+        if event.anchor is not None:
+            self.anchors[event.anchor] = value
+        return value
+
+    def _scalar(self, event):
+        """ Construct scalar """
+        value = event.value
+        if event.tag not in (None, '!'):
+            tag = event.tag
+        elif event.implicit[0]:
+            if value and value[0] not in _RESOLVED_FIRST:
+                return value
+            tag = self.constructor.resolve(yaml.ScalarNode, value, (True, False))
+        else:
+            # quoted
+            return value
+        if tag == _STR_TAG:
+            return value
+        if tag == _MERGE_TAG:
+            raise _Unsupported()
+        key = (tag, value)
+        if key not in self.scalars:
+            node = yaml.ScalarNode(tag, value)
+            self.scalars[key] = self.constructor.construct_object(node)
+            self.constructor.constructed_objects.pop(node, None)
+        return self.scalars[key]
+
+
+def load_yaml(stream):
+    """
+    Parse YAML config
+
+    Documents are built from parser events directly; documents with
+    features this doesn't cover (custom tags, merge keys) are loaded with
+    the regular safe loader. Both use libyaml when available.
+
+    @param stream: open file or string
+    @type stream: file or str
+
+    @rtype: dict
+    """
+    try:
+        return _EventLoader(stream).load()
+    except _Unsupported:
+        if hasattr(stream, 'seek'):
+            stream.seek(0)
+        return yaml.load(stream, Loader=YAML_LOADER)
+
+
+def _label(value):
+    """ Label value as matched by selectors (YAML booleans as true/false) """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _hostname(parameters):
+    """ Hostname a connection created from the parameters will have """
+    if 'private_hostname' in parameters:
+        return parameters['private_hostname']
+    return parameters.get('public_dns_name') or parameters.get('private_ip_address')
+
+
+class HostRecord(object):
+    """
+    Instance of a L{Structure} whose connection is created on first use
+    """
+    __slots__ = ('role', 'parameters', 'hostname', 'factory', 'username',
+                 'key_filename', 'output_shell', 'pool', 'position', '_connection')
+
+    def __init__(self, role, parameters, factory, username='root',
+                 key_filename=None, output_shell=False, pool=None):
+        """
+        Create record
+
+        @param role: instance's role
+        @type role: str
+
+        @param parameters: host parameters (see L{Connection})
+        @type parameters: dict or str
+
+        @param factory: class creating the connection
+        @type factory: class
+        """
+        self.role = role
+        self.parameters = parameters
+        if isinstance(parameters, dict):
+            self.hostname = _hostname(parameters)
+        else:
+            self.hostname = parameters
+        self.factory = factory
+        self.username = username
+        self.key_filename = key_filename
+        self.output_shell = output_shell
+        self.pool = pool
+        # order in the inventory
+        self.position = None
+        self._connection = None
+
+    def __repr__(self):
+        return "<HostRecord %s %s>" % (self.role, self.hostname)
+
+    @property
+    def labels(self):
+        """ Instance's labels """
+        if isinstance(self.parameters, dict):
+            return self.parameters.get('labels') or {}
+        return {}
+
+    @property
+    def created(self):
+        """ True if the connection object exists """
+        return self._connection is not None
+
+    @property
+    def connection(self):
+        """ Connection to the instance, created on first use """
+        if self._connection is None:
+            with _LOCK:
+                if self._connection is None:
+                    self._connection = self.factory(self.parameters, self.username,
+                                                    self.key_filename,
+                                                    output_shell=self.output_shell,
+                                                    pool=self.pool)
+        return self._connection
+
+    def get(self, key):
+        """
+        Get role, hostname or label
+
+        @return: value or None if not set
+        """
+        if key == 'role':
+            return self.role
+        if key == 'hostname':
+            return self.hostname
+        return _label(self.labels.get(key))
+
+
+class LazyConnections(Sequence):
+    """
+    List of connections of a role, backed by host records
+
+    Items may be L{HostRecord} objects (their connections are created when
+    accessed) or connection objects appended directly.
+    """
+    def __init__(self, items=None):
+        self.items = list(items or [])
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_connection(item) for item in self.items[index]]
+        return _connection(self.items[index])
+
+    def __repr__(self):
+        return "<LazyConnections %i>" % len(self.items)
+
+    def append(self, item):
+        """
+        Add connection or host record
+        """
+        self.items.append(item)
+
+    def remove(self, connection):
+        """
+        Remove connection
+        """
+        for idx, item in enumerate(self.items):
+            if item is connection or (isinstance(item, HostRecord) and item._connection is connection):
+                del self.items[idx]
+                return
+        raise ValueError("Connection not in list")
+
+    def created(self):
+        """
+        Get connections which were created already
+
+        @rtype: list
+        """
+        return [_connection(item) for item in self.items
+                if not isinstance(item, HostRecord) or item.created]
+
+
+def _connection(item):
+    """ Connection of a host record or the connection itself """
+    if isinstance(item, HostRecord):
+        return item.connection
+    return item
+
+
+def _parse_selector(selector):
+    """
+    Parse selector
+
+    @return: list of (key, operator, values) tuples, operator is '=', '!=',
+             'exists' or 'missing'
+    @rtype: list
+
+    @raises ValueError: if a term is empty
+    """
+    terms = []
+    for term in selector.split(','):
+        term = term.strip()
+        if not term:
+            raise ValueError("Empty term in selector '%s'" % selector)
+        if '!=' in term:
+            key, value = term.split('!=', 1)
+            terms.append((key.strip(), '!=', set(val.strip() for val in value.split('|'))))
+        elif '=' in term:
+            key, value = term.split('=', 1)
+            terms.append((key.strip(), '=', set(val.strip() for val in value.split('|'))))
+        elif term.startswith('!'):
+            terms.append((term[1:].strip(), 'missing', None))
+        else:
+            terms.append((term, 'exists', None))
+    return terms
+
+
+class Inventory(object):
+    """
+    Host records indexed by role, hostname and labels
+    """
+    def __init__(self):
+        self.records = []
+        self.by_role = {}
+        self.by_hostname = {}
+        # (label, value) -> records
+        self.by_label = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record):
+        """
+        Add and index host record
+
+        @param record: host record
+        @type record: L{HostRecord}
+        """
+        record.position = len(self.records)
+        self.records.append(record)
+        self.by_role.setdefault(record.role, []).append(record)
+        self.by_hostname.setdefault(record.hostname, []).append(record)
+        for key, value in record.labels.items():
+            self.by_label.setdefault((key, _label(value)), []).append(record)
+
+    def host(self, hostname, role=None):
+        """
+        Find host record by hostname
+
+        @param role: role the host has to have (any role if None)
+        @type role: str
+
+        @rtype: L{HostRecord}
+
+        @raises KeyError: if there is no such host
+        """
+        for record in self.by_hostname.get(hostname, []):
+            if role is None or record.role == role:
+                return record
+        raise KeyError(hostname)
+
+    def _candidates(self, key, values):
+        """ Records whose key is one of values according to the indexes """
+        if key == 'role':
+            index = self.by_role
+        elif key == 'hostname':
+            index = self.by_hostname
+        else:
+            return [record for value in sorted(values)
+                    for record in self.by_label.get((key, value), [])]
+        return [record for value in sorted(values) for record in index.get(value, [])]
+
+    def select(self, selector):
+        """
+        Find host records matching selector
+
+        @param selector: selector (see L{inventory}), e.g.
+                         'role=WEB,region=eu-west-1|eu-central-1,!canary'
+        @type selector: str
+
+        @return: records in order they were added
+        @rtype: list of L{HostRecord}
+
+        @raises ValueError: if selector is malformed
+        """
+        terms = _parse_selector(selector)
+        # start from the smallest indexed set, filter with the other terms
+        indexed = [term for term in terms if term[1] == '=']
+        if indexed:
+            candidates = min((self._candidates(key, values) for key, _, values in indexed), key=len)
+        else:
+            candidates = self.records
+        result = []
+        seen = set()
+        for record in candidates:
+            if id(record) in seen:
+                continue
+            seen.add(id(record))
+            if all(self._matches(record, key, operator, values) for key, operator, values in terms):
+                result.append(record)
+        if indexed:
+            result.sort(key=lambda record: record.position)
+        return result
+
+    @staticmethod
+    def _matches(record, key, operator, values):
+        """ Check one selector term """
+        value = record.get(key)
+        if operator == '=':
+            return value in values
+        if operator == '!=':
+            return value not in values
+        if operator == 'exists':
+            return value is not None
+        return value is None
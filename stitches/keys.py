@@ -0,0 +1,155 @@
+"""
+Process-wide cache of private keys and of keys which worked for hosts
+
+L{Connection} parses key files through a L{KeyCache} (once per file
+version rather than once per connection) and remembers which key
+authenticated it. The next connection to the same host and user offers that
+key first, so the usual search through key_filename, agent keys and ~/.ssh
+doesn't cost failed authentication round-trips. A key which worked for the
+user on another host goes first only if the connection would offer it anyway
+(it is in key_filename, or a default key with look_for_keys); a key which
+gets refused is forgotten. Keys offered by an SSH agent are not remembered.
+"""
+
+import os
+import threading
+
+import paramiko
+
+# keys paramiko looks for when look_for_keys is set
+DEFAULT_KEY_FILES = ['~/.ssh/id_rsa', '~/.ssh/id_ecdsa', '~/.ssh/id_ed25519', '~/.ssh/id_dsa']
+
+
+def _parse(path):
+    """ Parse private key file of any supported type """
+    if hasattr(paramiko.PKey, 'from_path'):
+        return paramiko.PKey.from_path(path)
+    error = None
+    for name in ('RSAKey', 'ECDSAKey', 'Ed25519Key', 'DSSKey'):
+        if not hasattr(paramiko, name):
+            continue
+        try:
+            return getattr(paramiko, name).from_private_key_file(path)
+        except paramiko.PasswordRequiredException:
+            raise
+        except paramiko.SSHException as err:
+            error = err
+    raise error or paramiko.SSHException("Can't parse %s" % path)
+
+
+def _normpath(path):
+    """ Absolute key file path """
+    return os.path.abspath(os.path.expanduser(path))
+
+
+class KeyCache(object):
+    """
+    Parsed private keys and credentials which worked
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> ((mtime, size), key)
+        self.keys = {}
+        # (host, port, username) or (username,) -> path
+        self.credentials = {}
+
+    def load(self, path):
+        """
+        Get parsed private key, parsing the file when it changed
+
+        @param path: key file
+        @type path: str
+
+        @rtype: L{paramiko.PKey}
+
+        @raises IOError: if the file can't be read
+        @raises SSHException: if the file can't be parsed (e.g. it is
+                              encrypted)
+        """
+        path = _normpath(path)
+        stat = os.stat(path)
+        signature = (stat.st_mtime, stat.st_size)
+        with self.lock:
+            cached = self.keys.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        key = _parse(path)
+        with self.lock:
+            self.keys[path] = (signature, key)
+        return key
+
+    def identify(self, key, paths):
+        """
+        Find file the key was loaded from
+
+        @param key: key which authenticated
+        @type key: L{paramiko.PKey}
+
+        @param paths: candidate key files
+        @type paths: list of str
+
+        @return: path or None
+        @rtype: str
+        """
+        blob = key.asbytes()
+        for path in paths:
+            try:
+                if self.load(path).asbytes() == blob:
+                    return path
+            except (IOError, OSError, paramiko.SSHException):
+                continue
+        return None
+
+    def credential(self, hostname, port, username, candidates=None):
+        """
+        Get key file which worked for the host, or for the user elsewhere
+
+        @param candidates: key files the connection is configured to offer;
+                           a key which worked for the user on another host
+                           is only returned if it is one of them
+        @type candidates: list of str
+
+        @return: path or None
+        @rtype: str
+        """
+        with self.lock:
+            path = self.credentials.get((hostname, port, username))
+            if path is not None:
+                return path
+            path = self.credentials.get((username,))
+        if path is not None and path in [_normpath(candidate) for candidate in candidates or []]:
+            return path
+        return None
+
+    def remember(self, hostname, port, username, path):
+        """
+        Remember key file which authenticated user on host
+        """
+        path = _normpath(path)
+        with self.lock:
+            self.credentials[(hostname, port, username)] = path
+            self.credentials[(username,)] = path
+
+    def forget(self, hostname, port, username, path=None):
+        """
+        Forget key file remembered for the host
+
+        @param path: key file which failed, it is forgotten for the user on
+                     all hosts too
+        @type path: str
+        """
+        with self.lock:
+            self.credentials.pop((hostname, port, username), None)
+            if path is not None and self.credentials.get((username,)) == _normpath(path):
+                del self.credentials[(username,)]
+
+    def clear(self):
+        """
+        Drop all parsed keys and credentials
+        """
+        with self.lock:
+            self.keys.clear()
+            self.credentials.clear()
+
+
+DEFAULT_KEY_CACHE = KeyCache()
@@ -0,0 +1,248 @@
+"""
+Performance metrics of connections
+"""
+
+import threading
+import time
+
+# default histogram buckets (seconds)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """
+    Running histogram of observed values
+    """
+    def __init__(self, buckets=BUCKETS):
+        """
+        Create histogram
+
+        @param buckets: upper bounds of buckets
+        @type buckets: tuple of float
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        """ Add observed value """
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+
+    def merge(self, other):
+        """ Add values observed by other histogram with the same buckets """
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self):
+        """
+        Get histogram state
+
+        @return: count, sum, min, max, mean and cumulative bucket counts
+        @rtype: dict
+        """
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'count': self.count,
+                'sum': self.sum,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'buckets': cumulative}
+
+
+def _labels(labels, extra=None):
+    """ Format prometheus labels """
+    pairs = sorted((labels or {}).items()) + (extra or [])
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in pairs)
+
+
+class Metrics(object):
+    """
+    Collection of histograms and counters
+
+    Names used by stitches:
+     - connect_seconds: ssh connection (handshake and authentication) time
+     - channel_open_seconds: time to open a channel and start a command
+     - command_seconds: command wall time
+     - expect_wait_seconds: time spent waiting in L{Expect}
+     - rpyc_bootstrap_seconds: rpyc setup time
+     - agent_start_seconds: remote command agent startup time
+     - shell_open_seconds: time to start an interactive shell and get its prompt
+     - bytes_sent, bytes_received: bytes sent to/received from the host
+     - reconnects: number of reconnections
+     - facts_hits, facts_misses: lookups of cached command results
+     - facts_invalidations: cached results dropped after mutating commands
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.hooks = []
+
+    def add_hook(self, hook):
+        """
+        Register a function called on every observation
+
+        @param hook: function called with (name, value)
+        @type hook: callable
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """ Unregister a hook """
+        self.hooks.remove(hook)
+
+    def observe(self, name, value):
+        """
+        Add value to histogram
+
+        @param name: histogram name
+        @type name: str
+
+        @param value: observed value
+        @type value: float
+        """
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+        for hook in self.hooks:
+            hook(name, value)
+
+    def inc(self, name, value=1):
+        """
+        Increase counter
+
+        @param name: counter name
+        @type name: str
+
+        @param value: increment
+        @type value: int
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        for hook in self.hooks:
+            hook(name, value)
+
+    def timer(self, name):
+        """
+        Context manager observing duration of its block
+
+        @param name: histogram name
+        @type name: str
+        """
+        return _Timer(self, name)
+
+    def merge(self, other):
+        """ Add observations of other metrics """
+        with other.lock:
+            histograms = dict(other.histograms)
+            counters = dict(other.counters)
+        with self.lock:
+            for name, histogram in histograms.items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(histogram.buckets)
+                self.histograms[name].merge(histogram)
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        Get metrics state
+
+        @return: {'histograms': {name: histogram snapshot},
+                  'counters': {name: value}}
+        @rtype: dict
+        """
+        with self.lock:
+            return {'histograms': dict((name, histogram.snapshot())
+                                       for name, histogram in self.histograms.items()),
+                    'counters': dict(self.counters)}
+
+    def to_prometheus(self, labels=None, prefix='stitches_'):
+        """
+        Export metrics in prometheus text format
+
+        @param labels: labels added to all samples
+        @type labels: dict
+
+        @param prefix: metric name prefix
+        @type prefix: str
+
+        @return: prometheus text exposition
+        @rtype: str
+        """
+        return to_prometheus([(labels, self)], prefix)
+
+
+def to_prometheus(series, prefix='stitches_'):
+    """
+    Export several metrics in prometheus text format
+
+    @param series: (labels, metrics) tuples
+    @type series: list of (dict, L{Metrics})
+
+    @param prefix: metric name prefix
+    @type prefix: str
+
+    @return: prometheus text exposition
+    @rtype: str
+    """
+    snapshots = [(labels, metrics.snapshot()) for labels, metrics in series]
+    lines = []
+    for name in sorted(set(name for _, snapshot in snapshots for name in snapshot['histograms'])):
+        metric = prefix + name
+        lines.append('# TYPE %s histogram' % metric)
+        for labels, snapshot in snapshots:
+            histogram = snapshot['histograms'].get(name)
+            if histogram is None:
+                continue
+            for bound, count in histogram['buckets']:
+                lines.append('%s_bucket%s %i' % (metric, _labels(labels, [('le', repr(float(bound)))]), count))
+            lines.append('%s_bucket%s %i' % (metric, _labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('%s_sum%s %r' % (metric, _labels(labels), histogram['sum']))
+            lines.append('%s_count%s %i' % (metric, _labels(labels), histogram['count']))
+    for name in sorted(set(name for _, snapshot in snapshots for name in snapshot['counters'])):
+        metric = prefix + name + '_total'
+        lines.append('# TYPE %s counter' % metric)
+        for labels, snapshot in snapshots:
+            if name in snapshot['counters']:
+                lines.append('%s%s %i' % (metric, _labels(labels), snapshot['counters'][name]))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+class _Timer(object):
+    """
+    Context manager observing elapsed time
+    """
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.time() - self.start)
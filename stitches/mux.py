@@ -0,0 +1,433 @@
+"""
+Local multiplexing daemon sharing SSH transports across processes
+
+The daemon (python -m stitches.mux) listens on a Unix socket and keeps
+authenticated transports to the hosts in a L{TransportPool}. A process
+attaching to it sends the host parameters as a JSON line and then speaks
+SSH over the socket; every channel it opens is forwarded to a channel over
+the shared upstream transport. L{Connection} attaches automatically when
+the socket exists, so worker processes of parallel test runners don't
+repeat handshakes to the same hosts.
+
+The socket and its directory are only accessible to the user running the
+daemon, which is what authenticates attaching processes. Processes only
+attach to a socket owned by their user in a directory nobody else can
+access (and, where the platform tells, served by a process of their user),
+so another local user can't pose as the daemon.
+"""
+
+import argparse
+import json
+import logging
+import os
+import select
+import socket
+import stat
+import struct
+import tempfile
+import threading
+
+import paramiko
+
+from stitches.connection import Connection, StitchesConnectionException
+from stitches.pool import TransportPool
+
+# socket used when neither the path nor STITCHES_MUX is given
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'stitches-mux-%i' % os.getuid(), 'mux.sock')
+
+
+def socket_path(path=None):
+    """
+    Get daemon socket path
+
+    @param path: explicit path
+    @type path: str
+
+    @return: path, STITCHES_MUX environment variable or L{DEFAULT_SOCKET}
+    @rtype: str
+    """
+    return path or os.environ.get('STITCHES_MUX') or DEFAULT_SOCKET
+
+
+def _private_dir(dirname):
+    """
+    Check directory belongs to the current user only
+
+    @raises StitchesConnectionException: if it is not a directory (e.g. a
+                                         symlink), belongs to someone else or
+                                         is accessible to group or others
+    """
+    info = os.lstat(dirname)
+    if not stat.S_ISDIR(info.st_mode):
+        raise StitchesConnectionException("%s is not a directory" % dirname)
+    if info.st_uid != os.getuid():
+        raise StitchesConnectionException("%s belongs to uid %i" % (dirname, info.st_uid))
+    if info.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise StitchesConnectionException("%s is accessible to other users (mode %o)" %
+                                          (dirname, stat.S_IMODE(info.st_mode)))
+
+
+def trusted(path):
+    """
+    Check daemon socket can be attached to safely
+
+    @param path: daemon socket path
+    @type path: str
+
+    @return: False if there is no socket
+    @rtype: bool
+
+    @raises StitchesConnectionException: if the socket or its directory
+                                         belongs to another user or is
+                                         accessible to other users
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    _private_dir(os.path.dirname(os.path.abspath(path)))
+    if not stat.S_ISSOCK(info.st_mode):
+        raise StitchesConnectionException("%s is not a socket" % path)
+    if info.st_uid != os.getuid():
+        raise StitchesConnectionException("%s belongs to uid %i" % (path, info.st_uid))
+    return True
+
+
+def _check_peer(sock):
+    """
+    Check the daemon runs as the current user (Linux only)
+
+    @raises StitchesConnectionException: if it runs as another user
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', credentials)
+    if uid != os.getuid():
+        raise StitchesConnectionException("Multiplexer runs as uid %i" % uid)
+
+
+def _readline(sock, limit=65536):
+    """ Read one line from socket without reading past it """
+    data = []
+    while len(data) < limit:
+        char = sock.recv(1)
+        if not char or char == b'\n':
+            break
+        data.append(char)
+    return b''.join(data).decode('utf-8')
+
+
+def attach(path, hostname, port, username, key_filename, timeout=10,
+           profile=None):
+    """
+    Attach to the daemon
+
+    @param path: daemon socket path
+    @type path: str
+
+    @param profile: name of the transport profile the daemon connects with
+                    (see L{profiles.PROFILES})
+    @type profile: str
+
+    @return: socket ready for SSH client handshake (authentication with an
+             empty password)
+    @rtype: socket.socket
+
+    @raises StitchesConnectionException: if the daemon can't connect to the
+                                         host or the socket is not trusted
+                                         (see L{trusted})
+    """
+    if not trusted(path):
+        raise StitchesConnectionException("Multiplexer socket %s doesn't exist" % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        _check_peer(sock)
+        sock.sendall((json.dumps({'hostname': hostname, 'port': port, 'username': username,
+                                  'key_filename': key_filename, 'timeout': timeout,
+                                  'profile': profile}) +
+                      '\n').encode('utf-8'))
+        reply = json.loads(_readline(sock) or '{}')
+        if not reply.get('ok'):
+            raise StitchesConnectionException("Multiplexer failed to connect to %s: %s" %
+                                              (hostname, reply.get('error')))
+        sock.settimeout(None)
+        return sock
+    except Exception:
+        sock.close()
+        raise
+
+
+def _handle_request(channel, msg):
+    """ Let the channel's owner know the channel request reply has been sent """
+    paramiko.Channel._handle_request(channel, msg)
+    replied = getattr(channel, 'stitches_replied', None)
+    if replied is not None:
+        replied.set()
+
+
+class ServerTransport(paramiko.Transport):
+    """
+    Server transport notifying about sent channel request replies
+
+    paramiko calls the server interface's check_channel_*_request before
+    the reply is sent; output written or channels closed before that fail
+    the request. Channels with a threading.Event in 'stitches_replied' get
+    it set once the reply is out. The benchmark server uses it too.
+    """
+    _channel_handler_table = dict(paramiko.Transport._channel_handler_table)
+    _channel_handler_table[paramiko.common.MSG_CHANNEL_REQUEST] = _handle_request
+
+
+def _splice(down, up):
+    """ Copy data, EOF and exit status between client and host channels """
+    # closing before the request reply is sent fails the request
+    down.stitches_replied.wait(10)
+    eof_up, eof_down = False, False
+    try:
+        # upstream may be closed already with output still buffered
+        while not down.closed:
+            while up.recv_ready():
+                down.sendall(up.recv(65536))
+            while up.recv_stderr_ready():
+                down.sendall_stderr(up.recv_stderr(65536))
+            while down.recv_ready():
+                up.sendall(down.recv(65536))
+            if down.eof_received and not eof_up:
+                up.shutdown_write()
+                eof_up = True
+            if up.recv_ready() or up.recv_stderr_ready():
+                continue
+            if up.eof_received and not eof_down:
+                down.shutdown_write()
+                eof_down = True
+            if up.exit_status_ready():
+                status = up.recv_exit_status()
+                if status >= 0:
+                    down.send_exit_status(status)
+                break
+            if up.closed:
+                break
+            # channels stay readable after EOF
+            waiting = [channel for channel, done in ((up, eof_down), (down, eof_up)) if not done]
+            if waiting:
+                select.select(waiting, [], [], 1)
+            else:
+                up.status_event.wait(1)
+    except (socket.error, EOFError, paramiko.SSHException):
+        pass
+    finally:
+        up.close()
+        down.close()
+
+
+class _Proxy(paramiko.ServerInterface):
+    """
+    Server side of an attached process, forwarding channels upstream
+    """
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.channels = {}
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind != 'session':
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_FAILED
+        try:
+            self.channels[chanid] = self.upstream.open_session(timeout=30)
+        except (socket.error, EOFError, paramiko.SSHException):
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        return paramiko.OPEN_SUCCEEDED
+
+    def _start(self, channel, func, *args):
+        """ Issue request upstream and splice the channels on success """
+        chanid = channel.get_id()
+        upstream = self.channels.get(chanid)
+        if upstream is None:
+            return False
+        try:
+            func(upstream, *args)
+        except (socket.error, EOFError, paramiko.SSHException):
+            self.channels.pop(chanid, None)
+            upstream.close()
+            return False
+        channel.stitches_replied = threading.Event()
+
+        def splice():
+            """ Splice thread """
+            _splice(channel, upstream)
+            self.channels.pop(chanid, None)
+        thread = threading.Thread(target=splice)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        return self._start(channel, paramiko.Channel.exec_command, command)
+
+    def check_channel_shell_request(self, channel):
+        return self._start(channel, paramiko.Channel.invoke_shell)
+
+    def check_channel_subsystem_request(self, channel, name):
+        return self._start(channel, paramiko.Channel.invoke_subsystem, name)
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        upstream = self.channels.get(channel.get_id())
+        try:
+            upstream.get_pty(term, width, height, pixelwidth, pixelheight)
+        except (AttributeError, socket.error, EOFError, paramiko.SSHException):
+            return False
+        return True
+
+    def check_channel_env_request(self, channel, name, value):
+        upstream = self.channels.get(channel.get_id())
+        if upstream is None:
+            return False
+        upstream.set_environment_variable(name, value)
+        return True
+
+    def check_channel_window_change_request(self, channel, width, height,
+                                            pixelwidth, pixelheight):
+        upstream = self.channels.get(channel.get_id())
+        try:
+            upstream.resize_pty(width, height, pixelwidth, pixelheight)
+        except (AttributeError, socket.error, EOFError, paramiko.SSHException):
+            return False
+        return True
+
+
+class MuxServer(object):
+    """
+    Multiplexing daemon
+    """
+    def __init__(self, path=None, pool=None):
+        """
+        Create daemon listening on Unix socket
+
+        @param path: socket path (see L{socket_path})
+        @type path: str
+
+        @param pool: pool of upstream transports
+        @type pool: L{TransportPool}
+
+        @raises StitchesConnectionException: if the socket directory exists
+                                             and isn't private to the user
+        """
+        self.logger = logging.getLogger('stitches.mux')
+        self.path = socket_path(path)
+        self.pool = pool or TransportPool()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.lexists(dirname):
+            parent = os.path.dirname(dirname)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            os.mkdir(dirname, stat.S_IRWXU)
+        # never bind in a directory someone else controls
+        _private_dir(dirname)
+        if os.path.lexists(self.path):
+            # stale socket of a previous daemon
+            if not trusted(self.path):
+                raise StitchesConnectionException("%s exists" % self.path)
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, stat.S_IRUSR | stat.S_IWUSR)
+        self.sock.listen(128)
+
+    def serve_forever(self):
+        """
+        Accept attaching processes until closed
+        """
+        self.logger.info('Listening on %s', self.path)
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            thread = threading.Thread(target=self._attach, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def _attach(self, client):
+        """ Connect upstream and serve SSH to the attached process """
+        try:
+            client.settimeout(10)
+            request = json.loads(_readline(client))
+            connection = Connection({'private_hostname': request['hostname'],
+                                     'public_hostname': request['hostname']},
+                                    request['username'], request['key_filename'],
+                                    timeout=request.get('timeout') or 10, port=request['port'],
+                                    pool=self.pool, mux=False, profile=request.get('profile'))
+            upstream = connection.connect().get_transport()
+        except Exception as err:
+            self.logger.debug('Attach failed: %s', err)
+            try:
+                client.sendall((json.dumps({'ok': False, 'error': str(err)}) + '\n').encode('utf-8'))
+            except (socket.error, OSError):
+                pass
+            client.close()
+            return
+        self.logger.debug('Attached to %s@%s:%s', request['username'], request['hostname'],
+                          request['port'])
+        try:
+            client.sendall((json.dumps({'ok': True}) + '\n').encode('utf-8'))
+            client.settimeout(None)
+            transport = ServerTransport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_Proxy(upstream))
+            transport.join()
+        except Exception as err:
+            self.logger.debug('Attached process failed: %s', err)
+        finally:
+            client.close()
+            connection.disconnect()
+
+    def close(self):
+        """
+        Stop accepting processes and close upstream transports
+        """
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.pool.close()
+
+
+def main():
+    """ Run the daemon """
+    parser = argparse.ArgumentParser(description='Stitches SSH multiplexing daemon')
+    parser.add_argument('-s', '--socket', help='socket path (default: $STITCHES_MUX or %s)' % DEFAULT_SOCKET)
+    parser.add_argument('--max-sessions', type=int, default=3,
+                        help='processes sharing one transport')
+    parser.add_argument('--idle-timeout', type=float, default=600,
+                        help='close transports unused for this number of seconds')
+    parser.add_argument('-v', '--verbose', action='store_true', help='debug logging')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    server = MuxServer(args.socket, TransportPool(args.max_sessions, args.idle_timeout))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Pool of SSH transports shared by L{Connection} objects
+"""
+
+import logging
+import threading
+import time
+
+
+class _PoolEntry(object):
+    """
+    Pooled SSH client and its users
+    """
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.users = 0
+        self.idle_since = time.time()
+
+    @property
+    def active(self):
+        """ True if the underlying transport is still usable """
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    @property
+    def channels(self):
+        """ Number of channels open over the transport """
+        channels = getattr(self.client.get_transport(), '_channels', None)
+        return 0 if channels is None else len(channels)
+
+
+class TransportPool(object):
+    """
+    Process-wide pool of authenticated SSH clients
+
+    Connections to the same (host, port, username, key, profile) share one SSH
+    transport and open their own channels over it. When a transport already
+    serves max_sessions connections or has max_channels channels open, a new
+    transport is created for the next one. Transports which are not used by
+    any connection are closed by a background timer after idle_timeout
+    seconds.
+
+    Channels are counted when a connection acquires a transport only:
+    channels the sharing connections open later (e.g. parallel SFTP workers
+    of put_tree) can still exceed sshd's MaxSessions, the channel open then
+    fails. Lower max_sessions for such workloads.
+    """
+    def __init__(self, max_sessions=3, idle_timeout=60, max_channels=8):
+        """
+        Create transport pool
+
+        @param max_sessions: maximum number of connections sharing one
+                             transport (each connection may keep its shell,
+                             sftp and exec channels open)
+        @type max_sessions: int
+
+        @param idle_timeout: close unused transports after this number of
+                             seconds
+        @type idle_timeout: int or float
+
+        @param max_channels: don't add connections to a transport with this
+                             many open channels (sshd allows 10 sessions per
+                             transport by default, see MaxSessions)
+        @type max_channels: int
+        """
+        self.logger = logging.getLogger('stitches.pool')
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_channels = max_channels
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.connecting = {}
+        self.reaper = None
+
+    def acquire(self, key, connect):
+        """
+        Get an SSH client for the key, creating one if needed
+
+        @param key: pool key, (host, port, username, key_filename,
+                    profile name)
+        @type key: tuple
+
+        @param connect: function creating new L{paramiko.SSHClient}
+        @type connect: callable
+
+        @return: shared SSH client
+        @rtype: L{paramiko.SSHClient}
+        """
+        with self.lock:
+            key_lock = self.connecting.setdefault(key, threading.Lock())
+        # handshakes for the same key are serialized, the waiting connections
+        # will likely reuse the freshly created transport
+        with key_lock:
+            with self.lock:
+                self._evict()
+                for entry in self.entries.get(key, []):
+                    if (entry.users < self.max_sessions and entry.channels < self.max_channels and
+                            entry.active):
+                        entry.users += 1
+                        return entry.client
+            client = connect()
+            entry = _PoolEntry(key, client)
+            entry.users = 1
+            with self.lock:
+                self.entries.setdefault(key, []).append(entry)
+            self.logger.debug('New transport for %s', key)
+            return client
+
+    def release(self, client):
+        """
+        Return an SSH client to the pool
+
+        @param client: client obtained with L{acquire}
+        @type client: L{paramiko.SSHClient}
+        """
+        with self.lock:
+            for entries in self.entries.values():
+                for entry in entries:
+                    if entry.client is client:
+                        entry.users = max(0, entry.users - 1)
+                        if entry.users == 0:
+                            entry.idle_since = time.time()
+            self._evict()
+            self._schedule()
+
+    def evict_idle(self):
+        """
+        Close transports idle for longer than idle_timeout and dead ones
+        """
+        with self.lock:
+            self._evict()
+
+    def _reap(self):
+        """ Timer callback closing idle transports """
+        with self.lock:
+            self.reaper = None
+            self._evict()
+            self._schedule()
+
+    def _schedule(self):
+        """ Start timer for the next idle transport expiration, the lock must be held """
+        if self.reaper is not None:
+            return
+        idle = [entry.idle_since for entries in self.entries.values()
+                for entry in entries if entry.users == 0]
+        if not idle:
+            return
+        delay = max(0, min(idle) + self.idle_timeout - time.time())
+        self.reaper = threading.Timer(delay, self._reap)
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def _evict(self):
+        """ Evict idle transports, the lock must be held """
+        now = time.time()
+        for key in list(self.entries.keys()):
+            keep = []
+            for entry in self.entries[key]:
+                if not entry.active or (entry.users == 0 and
+                                        now - entry.idle_since >= self.idle_timeout):
+                    self.logger.debug('Closing transport for %s', key)
+                    entry.client.close()
+                else:
+                    keep.append(entry)
+            if keep:
+                self.entries[key] = keep
+            else:
+                del self.entries[key]
+
+    def close(self):
+        """
+        Close all pooled transports
+        """
+        with self.lock:
+            if self.reaper is not None:
+                self.reaper.cancel()
+                self.reaper = None
+            for entries in self.entries.values():
+                for entry in entries:
+                    entry.client.close()
+            self.entries = {}
+
+
+DEFAULT_POOL = TransportPool()
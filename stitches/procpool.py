@@ -0,0 +1,293 @@
+"""
+Process-pool backend for L{Structure} operations
+
+Connections of a structure are sharded across worker processes. Every
+worker owns its own L{Connection} objects (and SSH transports) for its
+shard, keeps them open between operations and sends results back to the
+parent, so encryption and protocol work of many concurrent transfers is
+spread over all cores instead of one interpreter holding the GIL.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from stitches.connection import Connection, StitchesConnectionException
+from stitches.structure import Structure, _imap_unordered
+
+
+def _worker_record(path):
+    """
+    Session file of a connection recreated in a worker: the parent's
+    connection keeps writing its own file
+    """
+    base, ext = path, ''
+    for suffix in ('.gz', '.jsonl'):
+        if base.endswith(suffix):
+            base, ext = base[:-len(suffix)], suffix + ext
+    return '%s.worker%s' % (base, ext)
+
+
+def _connection_args(connection):
+    """ Constructor arguments recreating the connection in a worker """
+    recorder = getattr(connection, 'recorder', None)
+    return {'instance': connection.parameters,
+            'username': connection.username,
+            'key_filename': connection.key_filename,
+            'timeout': connection.timeout,
+            'output_shell': connection.output_shell,
+            'disable_rpyc': connection.disable_rpyc,
+            'tail_size': connection.tail_size,
+            'port': connection.port,
+            # transport pools can't be shared between processes
+            'pool': connection.pool is not None,
+            'use_agent': getattr(connection, 'use_agent', False),
+            'mux': getattr(connection, 'mux', None),
+            'keepalive': connection.keepalive,
+            'dead_timeout': connection.dead_timeout,
+            'prompt': connection.prompt,
+            'facts_ttl': connection.facts.ttl,
+            'facts_size': connection.facts.size,
+            'profile': connection.profile,
+            'record': None if recorder is None else _worker_record(recorder.path),
+            # parsed keys stay in the process which loaded them
+            'key_cache': getattr(connection, 'key_cache', None) is not None}
+
+
+def _portable(error):
+    """ Make sure exception can be sent to the parent """
+    if error is None:
+        return None
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return StitchesConnectionException("%s: %s" % (type(error).__name__, error))
+
+
+def _map(structure, roles, workers, func):
+    """ Apply func to connections, yield (role, hostname, result, error) """
+    for (role, connection), result, error in _imap_unordered(lambda target: func(target[1]),
+                                                              structure.connections(roles), workers):
+        yield role, connection.hostname, result, _portable(error)
+
+
+def _op_run(structure, commands, roles, timeout, workers, get_pty):
+    """ Structure.run in a worker """
+    for result in structure.run(commands, roles, timeout, workers, get_pty=get_pty):
+        result.error = _portable(result.error)
+        yield result
+
+
+def _op_put_tree(structure, local_dir, remote_dir, roles, workers, skip, host_workers):
+    """ Connection.put_tree on all connections of a worker """
+    return _map(structure, roles, host_workers,
+                lambda connection: connection.put_tree(local_dir, remote_dir, workers, skip))
+
+
+def _op_get_tree(structure, remote_dir, local_dir, roles, workers, skip, host_workers):
+    """ Connection.get_tree on all connections of a worker """
+    return _map(structure, roles, host_workers,
+                lambda connection: connection.get_tree(remote_dir,
+                                                       os.path.join(local_dir, connection.hostname),
+                                                       workers, skip))
+
+
+_OPERATIONS = {'run': _op_run, 'put_tree': _op_put_tree, 'get_tree': _op_get_tree}
+
+
+def _worker(shard, tasks, results, cancelled):
+    """
+    Worker process: serve operations on a shard of connections
+
+    @param shard: (role, connection arguments) tuples
+    @type shard: list
+    """
+    structure = Structure()
+    for role, kwargs in shard:
+        structure.Instances.setdefault(role, []).append(Connection(**kwargs))
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            call_id, operation, args = task
+            items = _OPERATIONS[operation](structure, *args)
+            try:
+                for item in items:
+                    results.put((call_id, item))
+                    if cancelled.value >= call_id:
+                        break
+            except Exception as err:
+                logging.getLogger('stitches.procpool').debug('Operation %s failed: %s', operation, err)
+            finally:
+                items.close()
+                results.put((call_id, None))
+    finally:
+        structure.disconnect_all()
+
+
+class ProcessPool(object):
+    """
+    Worker processes running L{Structure} operations on shards of its
+    connections
+    """
+    def __init__(self, structure, processes=None, roles=None):
+        """
+        Start worker processes
+
+        @param structure: structure whose connections are sharded
+        @type structure: L{Structure}
+
+        @param processes: number of worker processes (number of CPUs by
+                          default)
+        @type processes: int
+
+        @param roles: roles to include (all roles if None)
+        @type roles: list of str or str
+        """
+        self.logger = logging.getLogger('stitches.procpool')
+        targets = structure.connections(roles)
+        processes = max(1, min(processes or multiprocessing.cpu_count(), len(targets)))
+        shards = [[] for _ in range(processes)]
+        for idx, (role, connection) in enumerate(targets):
+            shards[idx % processes].append((role, _connection_args(connection)))
+        self.counter = itertools.count(1)
+        self.cancelled = multiprocessing.Value('i', 0)
+        self.results = multiprocessing.Queue()
+        self.tasks = []
+        self.processes = []
+        for shard in shards:
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_worker,
+                                              args=(shard, tasks, self.results, self.cancelled))
+            process.daemon = True
+            process.start()
+            self.tasks.append(tasks)
+            self.processes.append(process)
+        self.logger.debug('Started %i worker(s) for %i connection(s)', processes, len(targets))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _call(self, operation, *args):
+        """
+        Run operation in all workers
+
+        @return: generator of items in order of completion; closing it
+                 stops the operation in the workers
+        """
+        call_id = next(self.counter)
+        for tasks in self.tasks:
+            tasks.put((call_id, operation, args))
+        running = len(self.processes)
+        try:
+            while running:
+                try:
+                    message_id, item = self.results.get(timeout=1)
+                except queue.Empty:
+                    if not all(process.is_alive() for process in self.processes):
+                        raise StitchesConnectionException("Worker process exited")
+                    continue
+                if message_id != call_id:
+                    # left over from a stopped operation
+                    continue
+                if item is None:
+                    running -= 1
+                else:
+                    yield item
+        finally:
+            if running:
+                self.cancelled.value = call_id
+
+    def run(self, commands, roles=None, timeout=10, workers=16,
+            fail_fast=False, max_failures=None, get_pty=False):
+        """
+        Run command(s) on all instances (see L{Structure.run})
+
+        @param workers: maximum number of instances handled concurrently by
+                        every worker process
+        @type workers: int
+
+        @return: generator of command results in order of completion
+        @rtype: generator of L{CommandResult}
+        """
+        if not isinstance(commands, (list, tuple)):
+            commands = [commands]
+        if fail_fast:
+            max_failures = 1
+        failures = 0
+        results = self._call('run', commands, roles, timeout, workers, get_pty)
+        try:
+            for result in results:
+                yield result
+                if result.failed:
+                    failures += 1
+                    if max_failures is not None and failures >= max_failures:
+                        self.logger.debug('Stopping after %s failure(s)', failures)
+                        return
+        finally:
+            results.close()
+
+    def put_tree(self, local_dir, remote_dir, roles=None, workers=4,
+                 skip='size', host_workers=16):
+        """
+        Copy local directory tree to all instances (see
+        L{Connection.put_tree})
+
+        @param workers: number of files uploaded concurrently to an instance
+        @type workers: int
+
+        @param host_workers: maximum number of instances handled
+                             concurrently by every worker process
+        @type host_workers: int
+
+        @return: generator of (role, hostname, L{transfer.TransferResult} or
+                 None, exception or None) tuples in order of completion
+        @rtype: generator
+        """
+        return self._call('put_tree', local_dir, remote_dir, roles, workers, skip,
+                          host_workers)
+
+    def get_tree(self, remote_dir, local_dir, roles=None, workers=4,
+                 skip='size', host_workers=16):
+        """
+        Copy directory tree from all instances to local_dir/hostname (see
+        L{Connection.get_tree})
+
+        @param workers: number of files downloaded concurrently from an
+                        instance
+        @type workers: int
+
+        @param host_workers: maximum number of instances handled
+                             concurrently by every worker process
+        @type host_workers: int
+
+        @return: generator of (role, hostname, L{transfer.TransferResult} or
+                 None, exception or None) tuples in order of completion
+        @rtype: generator
+        """
+        return self._call('get_tree', remote_dir, local_dir, roles, workers, skip,
+                          host_workers)
+
+    def close(self):
+        """
+        Stop worker processes (their connections are closed)
+        """
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(30)
+            if process.is_alive():
+                process.terminate()
+        self.tasks, self.processes = [], []
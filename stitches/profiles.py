@@ -0,0 +1,188 @@
+"""
+SSH transport tuning profiles
+
+A profile sets cipher and MAC preference, compression, channel window and
+maximum packet size of the transports a L{Connection} creates, TCP_NODELAY
+on their sockets and SFTP read-ahead of L{transfer} downloads. Profiles are
+selected by name per connection (Connection(..., profile='high-rtt')) or
+with the 'profile' key of an instance entry in the L{Structure} YAML.
+
+Cipher and window settings need paramiko >= 3.2 (SSHClient.connect taking
+transport_factory); with older versions only compression is applied.
+"""
+
+import inspect
+import socket
+
+import paramiko
+
+try:
+    _CONNECT_ARGS = inspect.signature(paramiko.SSHClient.connect).parameters
+    _GET_ARGS = inspect.signature(paramiko.SFTPClient.get).parameters
+except AttributeError:
+    # python 2
+    _CONNECT_ARGS = inspect.getargspec(paramiko.SSHClient.connect).args
+    _GET_ARGS = inspect.getargspec(paramiko.SFTPClient.get).args
+
+
+class Profile(object):
+    """
+    Set of transport settings
+    """
+    def __init__(self, name, ciphers=None, macs=None, compress=False,
+                 window_size=None, max_packet_size=None, nodelay=False,
+                 sftp_prefetch=True, sftp_prefetch_requests=None):
+        """
+        Create profile
+
+        @param name: profile name
+        @type name: str
+
+        @param ciphers: preferred ciphers, most preferred first (ciphers not
+                        supported by paramiko are skipped, paramiko's order
+                        if None)
+        @type ciphers: list of str
+
+        @param macs: preferred MACs, most preferred first
+        @type macs: list of str
+
+        @param compress: enable zlib compression
+        @type compress: bool
+
+        @param window_size: channel window size (bytes in flight before the
+                            sender waits for acknowledgement, paramiko's
+                            default if None)
+        @type window_size: int
+
+        @param max_packet_size: maximum channel packet size
+        @type max_packet_size: int
+
+        @param nodelay: disable Nagle's algorithm so that small writes
+                        (commands, expect input) are sent right away
+        @type nodelay: bool
+
+        @param sftp_prefetch: read ahead when downloading files over SFTP
+        @type sftp_prefetch: bool
+
+        @param sftp_prefetch_requests: maximum number of outstanding
+                                       read-ahead requests (unlimited if
+                                       None)
+        @type sftp_prefetch_requests: int
+        """
+        self.name = name
+        self.ciphers = ciphers
+        self.macs = macs
+        self.compress = compress
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.nodelay = nodelay
+        self.sftp_prefetch = sftp_prefetch
+        self.sftp_prefetch_requests = sftp_prefetch_requests
+
+    def __repr__(self):
+        return "<Profile %s>" % self.name
+
+    @property
+    def tunes_transport(self):
+        """ True if transports have to be created by the profile """
+        return bool(self.ciphers or self.macs or self.window_size or self.max_packet_size)
+
+    def transport(self, sock, **kwargs):
+        """
+        Create client transport (transport_factory of
+        L{paramiko.SSHClient.connect})
+
+        @rtype: L{paramiko.Transport}
+        """
+        if self.window_size:
+            kwargs['default_window_size'] = self.window_size
+        if self.max_packet_size:
+            kwargs['default_max_packet_size'] = self.max_packet_size
+        transport = paramiko.Transport(sock, **kwargs)
+        options = transport.get_security_options()
+        for attr, preferred in (('ciphers', self.ciphers), ('digests', self.macs)):
+            if not preferred:
+                continue
+            supported = getattr(options, attr)
+            preferred = [name for name in preferred if name in supported]
+            # the rest stays available in paramiko's order
+            setattr(options, attr, preferred + [name for name in supported if name not in preferred])
+        return transport
+
+    def connect_kwargs(self):
+        """
+        Get extra arguments of L{paramiko.SSHClient.connect}
+
+        @rtype: dict
+        """
+        kwargs = {}
+        if self.compress:
+            kwargs['compress'] = True
+        if self.tunes_transport and 'transport_factory' in _CONNECT_ARGS:
+            kwargs['transport_factory'] = self.transport
+        return kwargs
+
+    def sftp_get_kwargs(self):
+        """
+        Get extra arguments of L{paramiko.SFTPClient.get}
+
+        @rtype: dict
+        """
+        kwargs = {}
+        if not self.sftp_prefetch:
+            kwargs['prefetch'] = False
+        elif self.sftp_prefetch_requests and 'max_concurrent_prefetch_requests' in _GET_ARGS:
+            kwargs['max_concurrent_prefetch_requests'] = self.sftp_prefetch_requests
+        return kwargs
+
+    def tune_socket(self, sock):
+        """
+        Set socket options of the profile
+
+        @raises socket.error
+        """
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+# ciphers with hardware acceleration on common CPUs and cheap MACs
+_FAST_CIPHERS = ['aes128-gcm@openssh.com', 'aes256-gcm@openssh.com', 'aes128-ctr', 'aes256-ctr']
+_FAST_MACS = ['hmac-sha2-256-etm@openssh.com', 'hmac-sha2-256']
+
+PROFILES = {
+    # paramiko defaults
+    'default': Profile('default'),
+    # large transfers on fast links: big windows, no compression; SFTP
+    # requests are small writes too
+    'bulk-throughput': Profile('bulk-throughput', _FAST_CIPHERS, _FAST_MACS,
+                               window_size=16 * 1048576, max_packet_size=32768, nodelay=True,
+                               sftp_prefetch_requests=64),
+    # many short commands and interactive sessions
+    'low-latency': Profile('low-latency', _FAST_CIPHERS, _FAST_MACS, nodelay=True),
+    # WAN links: windows covering the bandwidth-delay product, compressed
+    # (mostly textual) data
+    'high-rtt': Profile('high-rtt', _FAST_CIPHERS, _FAST_MACS, compress=True,
+                        window_size=64 * 1048576, max_packet_size=32768, nodelay=True,
+                        sftp_prefetch_requests=256),
+}
+
+
+def get_profile(profile=None):
+    """
+    Get profile
+
+    @param profile: profile or its name in L{PROFILES} ('default' if None)
+    @type profile: L{Profile} or str
+
+    @rtype: L{Profile}
+
+    @raises ValueError: if there is no such profile
+    """
+    if profile is None:
+        profile = 'default'
+    if isinstance(profile, Profile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown transport profile '%s' (%s)" % (profile, ", ".join(sorted(PROFILES))))
@@ -0,0 +1,289 @@
+"""
+Inspect remote files without transferring them
+
+Helpers behind L{Connection.grep}, L{Connection.tail},
+L{Connection.read_range}, L{Connection.checksum}, L{Connection.stat_many}
+and L{Connection.wait_for_pattern}. Work is done by coreutils and grep on the
+host in one command each, only the result is sent back (no rpyc or SFTP
+needed).
+"""
+
+import re
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+import paramiko
+
+from stitches.connection import StitchesConnectionException, _text
+from stitches.expect import ExpectFailed
+
+CHECKSUMS = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+
+# stat --printf format, the name goes last as it may contain anything but NUL
+_STAT_FORMAT = r'%s\t%f\t%u\t%g\t%X\t%Y\t%n\0'
+
+# grep -n output: 'number:line' for matches, 'number-line' for context
+_GREP_LINE = re.compile(r'^([0-9]+)([:-])(.*)$')
+
+
+class GrepMatch(object):
+    """
+    Matching line with its context
+    """
+    def __init__(self, line_number, line, before=None, after=None):
+        """
+        Create match
+
+        @param line_number: number of the matching line (1-based)
+        @type line_number: int
+
+        @param line: matching line
+        @type line: str
+
+        @param before: (line number, line) tuples preceding the match
+        @type before: list
+
+        @param after: (line number, line) tuples following the match
+        @type after: list
+        """
+        self.line_number = line_number
+        self.line = line
+        self.before = before or []
+        self.after = after or []
+
+    def __repr__(self):
+        return "<GrepMatch %i %r>" % (self.line_number, self.line)
+
+
+def _run(connection, command, timeout, statuses=(0,)):
+    """
+    Run command and collect its whole standard output
+
+    @return: (status, stdout) tuple
+    @rtype: tuple
+
+    @raises StitchesConnectionException: if the command times out or its
+                                         status is not one of statuses
+    """
+    output = []
+    # output may be longer than the connection keeps in last_stdout
+    status = connection.recv_exit_status(command, timeout,
+                                         callback=lambda name, data: name == 'stdout' and output.append(data))
+    if status is None:
+        raise StitchesConnectionException("Command '%s' timed out on %s" % (command, connection.hostname))
+    if status not in statuses:
+        raise StitchesConnectionException("Command '%s' failed on %s: %s" %
+                                          (command, connection.hostname,
+                                           _text(connection.last_stderr).strip()))
+    return status, b''.join(output)
+
+
+def _grep_options(pattern, fixed, ignore_case):
+    """ grep options selecting lines matching pattern """
+    options = '-a -F' if fixed else '-a -E'
+    if ignore_case:
+        options += ' -i'
+    return "%s -e %s" % (options, quote(pattern))
+
+
+def grep(connection, path, pattern, context=0, before=None, after=None,
+         fixed=False, ignore_case=False, max_count=None, timeout=60):
+    """
+    Find lines matching pattern in remote file
+
+    @param path: remote file
+    @type path: str
+
+    @param pattern: extended regular expression (or string if fixed)
+    @type pattern: str
+
+    @param context: number of lines around matches to return
+    @type context: int
+
+    @param before: number of lines preceding matches (context if None)
+    @type before: int
+
+    @param after: number of lines following matches (context if None)
+    @type after: int
+
+    @param fixed: pattern is a plain string
+    @type fixed: bool
+
+    @param ignore_case: ignore case
+    @type ignore_case: bool
+
+    @param max_count: stop reading the file after this number of matches
+    @type max_count: int
+
+    @param timeout: timeout (seconds)
+    @type timeout: int or float
+
+    @return: matches in file order
+    @rtype: list of L{GrepMatch}
+
+    @raises StitchesConnectionException: if the file can't be read
+    """
+    before = context if before is None else before
+    after = context if after is None else after
+    command = "grep -n %s" % _grep_options(pattern, fixed, ignore_case)
+    if before:
+        command += " -B %i" % before
+    if after:
+        command += " -A %i" % after
+    if max_count is not None:
+        command += " -m %i" % max_count
+    command += " -- %s" % quote(path)
+    # 1 means no match
+    _, output = _run(connection, command, timeout, (0, 1))
+    lines = {}
+    matches = []
+    for line in _text(output).split('\n'):
+        match = _GREP_LINE.match(line)
+        if match is None:
+            # '--' between groups of context
+            continue
+        number = int(match.group(1))
+        lines[number] = match.group(3)
+        if match.group(2) == ':':
+            matches.append(number)
+    return [GrepMatch(number, lines[number],
+                      [(idx, lines[idx]) for idx in range(number - before, number) if idx in lines],
+                      [(idx, lines[idx]) for idx in range(number + 1, number + after + 1) if idx in lines])
+            for number in matches]
+
+
+def tail(connection, path, lines=10, timeout=60):
+    """
+    Get last lines of remote file
+
+    @param lines: number of lines
+    @type lines: int
+
+    @rtype: list of str
+
+    @raises StitchesConnectionException: if the file can't be read
+    """
+    _, output = _run(connection, "tail -n %i -- %s" % (lines, quote(path)), timeout)
+    return _text(output).splitlines()
+
+
+def read_range(connection, path, offset, length, timeout=60):
+    """
+    Read part of remote file
+
+    @param offset: first byte to read
+    @type offset: int
+
+    @param length: maximum number of bytes to read
+    @type length: int
+
+    @return: data (shorter than length at the end of the file)
+    @rtype: bytes
+
+    @raises StitchesConnectionException: if the file can't be read
+    """
+    # tail seeks in regular files, head stops reading after length bytes
+    command = "{ tail -c +%i | head -c %i; } <%s" % (offset + 1, length, quote(path))
+    _, output = _run(connection, command, timeout)
+    return output
+
+
+def checksum(connection, path, algorithm='sha256', timeout=600):
+    """
+    Compute checksum of remote file
+
+    @param algorithm: one of L{CHECKSUMS}
+    @type algorithm: str
+
+    @return: hex digest
+    @rtype: str
+
+    @raises ValueError: if the algorithm is not supported
+    @raises StitchesConnectionException: if the file can't be read
+    """
+    if algorithm not in CHECKSUMS:
+        raise ValueError("Unsupported checksum '%s' (%s)" % (algorithm, ", ".join(CHECKSUMS)))
+    _, output = _run(connection, "%ssum -- %s" % (algorithm, quote(path)), timeout)
+    return _text(output).split()[0].lstrip('\\')
+
+
+def stat_many(connection, paths, follow=True, timeout=60):
+    """
+    Stat remote paths in one round-trip
+
+    @param paths: remote paths
+    @type paths: list of str
+
+    @param follow: follow symbolic links (like SFTP stat, lstat otherwise)
+    @type follow: bool
+
+    @return: path -> attributes (None if the path doesn't exist or can't be
+             accessed)
+    @rtype: dict of L{paramiko.SFTPAttributes}
+    """
+    paths = list(paths)
+    result = dict((path, None) for path in paths)
+    if not paths:
+        return result
+    command = "stat %s--printf '%s' -- %s 2>/dev/null" % ('-L ' if follow else '', _STAT_FORMAT,
+                                                        " ".join(quote(path) for path in paths))
+    # 1 means some paths are missing
+    _, output = _run(connection, command, timeout, (0, 1))
+    for entry in output.split(b'\0'):
+        if not entry:
+            continue
+        size, mode, uid, gid, atime, mtime, name = _text(entry).split('\t', 6)
+        attributes = paramiko.SFTPAttributes()
+        attributes.st_size = int(size)
+        attributes.st_mode = int(mode, 16)
+        attributes.st_uid = int(uid)
+        attributes.st_gid = int(gid)
+        attributes.st_atime = int(atime)
+        attributes.st_mtime = int(mtime)
+        attributes.filename = name
+        result[name] = attributes
+    return result
+
+
+def wait_for_pattern(connection, path, pattern, timeout=60, offset=None,
+                     fixed=False, ignore_case=False):
+    """
+    Wait until a line matching pattern appears in remote file
+
+    The file is followed by name, so it may not exist yet or get rotated
+    while waiting.
+
+    @param pattern: extended regular expression (or string if fixed)
+    @type pattern: str
+
+    @param timeout: maximum time to wait (seconds)
+    @type timeout: int or float
+
+    @param offset: byte offset to search from (e.g. st_size from
+                   L{stat_many} taken before triggering the event, so that
+                   lines written meanwhile aren't missed); None for lines
+                   appended after the call only
+    @type offset: int
+
+    @return: matching line
+    @rtype: str
+
+    @raises ExpectFailed: if no such line appears within timeout
+    """
+    if offset is None:
+        start = "-n 0"
+    else:
+        start = "-c +%i" % (offset + 1)
+    # tail -F never exits on its own: it reports its pid (kept by exec) and is
+    # killed once grep finds the line or times out
+    command = ("sh -c 'echo $$; exec tail %s -F -- \"$0\" 2>/dev/null' %s | "
+               "{ read pid; timeout %s grep -m 1 %s; rc=$?; kill $pid; exit $rc; }" %
+               (start, quote(path), timeout, _grep_options(pattern, fixed, ignore_case)))
+    status, output = _run(connection, command, timeout + 10, (0, 1, 124))
+    if status != 0:
+        raise ExpectFailed("'%s' didn't appear in %s on %s within %s seconds" %
+                           (pattern, path, connection.hostname, timeout))
+    return _text(output).rstrip('\n')
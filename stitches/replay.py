@@ -0,0 +1,744 @@
+"""
+Recording and replaying of connection sessions
+
+Connection(..., record='session.jsonl') saves every executed command,
+interactive shell, byte received from and sent to channels, exit status
+and SFTP read (stat, listdir, get, reading open) with timestamps to a
+session file, one JSON object per line (gzip compressed when the path ends
+with '.gz'). L{ReplayConnection} serves the same calls from such a file
+without any host, so L{Expect} based test logic can be iterated on
+offline:
+
+ - commands get the output of the next recorded execution of the same
+   command
+ - shells get recorded shells in order; output recorded after the client
+   sent something is released once the same input is sent again
+ - SFTP reads return recorded results, writes are discarded
+
+Output is released at full speed by default or paced by the recorded
+timestamps (speed=1 for the recorded pace, 2 for twice as fast...).
+"""
+
+import base64
+import collections
+import gzip
+import io
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+
+import paramiko
+import paramiko.channel
+
+from stitches.connection import Connection, StitchesConnectionException
+
+SESSION_VERSION = 1
+
+# paramiko < 2.7 has no dedicated stdin file class
+_StdinFile = getattr(paramiko.channel, 'ChannelStdinFile', paramiko.channel.ChannelFile)
+
+_ATTRS = ('st_size', 'st_uid', 'st_gid', 'st_mode', 'st_atime', 'st_mtime', 'filename', 'longname')
+
+
+class ReplayError(StitchesConnectionException):
+    """
+    Replayed session diverged from the recorded one
+    """
+    pass
+
+
+def _open(path, mode):
+    """ Open session file (compressed files may have many gzip members) """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _bytes(data):
+    """ Data sent to channels may be str or buffers """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return bytes(data)
+    return data.encode('utf-8')
+
+
+def _attrs_dict(attrs):
+    """ Serialize SFTPAttributes """
+    return dict((name, getattr(attrs, name, None)) for name in _ATTRS)
+
+
+def _attrs(record):
+    """ Deserialize SFTPAttributes """
+    attrs = paramiko.SFTPAttributes()
+    for name, value in record.items():
+        setattr(attrs, name, value)
+    return attrs
+
+
+class Recorder(object):
+    """
+    Session file writer
+    """
+    def __init__(self, path, connection):
+        """
+        Create session file
+
+        @param path: session file path
+        @type path: str
+
+        @param connection: recorded connection
+        @type connection: L{Connection}
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.start = time.time()
+        self.compress = path.endswith('.gz')
+        self.file = open(path, 'wb')
+        # gzip member records are written to, started by the first record
+        # after a flush
+        self.member = None
+        self.write({'ev': 'session', 'version': SESSION_VERSION, 'hostname': connection.hostname,
+                    'username': connection.username, 'port': connection.port,
+                    'started': self.start})
+
+    def write(self, record):
+        """
+        Append record with current timestamp
+        """
+        record['t'] = round(time.time() - self.start, 6)
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with self.lock:
+            if self.file is None:
+                return
+            if not self.compress:
+                self.file.write(line)
+                return
+            if self.member is None:
+                self.member = gzip.GzipFile(fileobj=self.file, mode='wb')
+            self.member.write(line)
+
+    def _end_member(self):
+        """ Write gzip trailer of the current member """
+        if self.member is not None:
+            # the underlying file stays open
+            self.member.close()
+            self.member = None
+
+    def data(self, channel_id, event, data):
+        """
+        Append channel data record
+        """
+        self.write({'ev': event, 'ch': channel_id,
+                    'data': base64.b64encode(data).decode('ascii')})
+
+    def wrap(self, client):
+        """
+        Record calls on ssh client
+
+        @param client: connected client
+        @type client: L{paramiko.SSHClient}
+
+        @rtype: L{_RecordingClient}
+        """
+        return _RecordingClient(self, client)
+
+    def flush(self):
+        """
+        Write buffered records
+
+        Compressed files get a complete gzip member, so the file can be
+        replayed without closing the recorder.
+        """
+        with self.lock:
+            if self.file is not None:
+                self._end_member()
+                self.file.flush()
+
+    def close(self):
+        """
+        Close session file
+        """
+        with self.lock:
+            if self.file is not None:
+                self._end_member()
+                self.file.close()
+                self.file = None
+
+
+class _RecordingChannel(object):
+    """
+    Channel logging received and sent data and exit status
+    """
+    def __init__(self, recorder, channel):
+        self.recorder = recorder
+        self.channel = channel
+        self.id = next(recorder.ids)
+        self.status_logged = False
+        self.eof_logged = False
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def recv(self, nbytes):
+        data = self.channel.recv(nbytes)
+        if data:
+            self.recorder.data(self.id, 'out', data)
+        return data
+
+    def recv_stderr(self, nbytes):
+        data = self.channel.recv_stderr(nbytes)
+        if data:
+            self.recorder.data(self.id, 'err', data)
+        return data
+
+    def send(self, data):
+        sent = self.channel.send(data)
+        if sent:
+            self.recorder.data(self.id, 'in', _bytes(data)[:sent])
+        return sent
+
+    def sendall(self, data):
+        self.channel.sendall(data)
+        self.recorder.data(self.id, 'in', _bytes(data))
+
+    def _log_status(self):
+        """ Log exit status once """
+        if not self.status_logged:
+            self.status_logged = True
+            self.recorder.write({'ev': 'exit', 'ch': self.id,
+                                 'status': self.channel.recv_exit_status()})
+
+    def exit_status_ready(self):
+        ready = self.channel.exit_status_ready()
+        if ready:
+            self._log_status()
+        return ready
+
+    def recv_exit_status(self):
+        status = self.channel.recv_exit_status()
+        self._log_status()
+        return status
+
+    @property
+    def eof_received(self):
+        """ EOF flag of the channel """
+        eof = self.channel.eof_received
+        if eof and not self.eof_logged:
+            self.eof_logged = True
+            self.recorder.write({'ev': 'eof', 'ch': self.id})
+        return eof
+
+
+class _RecordingClient(object):
+    """
+    SSH client recording channels it opens
+    """
+    def __init__(self, recorder, client):
+        self.recorder = recorder
+        self.wrapped = client
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def exec_command(self, command, bufsize=-1, timeout=None, get_pty=False,
+                     environment=None):
+        """ See L{paramiko.SSHClient.exec_command} """
+        chan = self.wrapped.get_transport().open_session(timeout=timeout)
+        if get_pty:
+            chan.get_pty()
+        chan.settimeout(timeout)
+        if environment:
+            chan.update_environment(environment)
+        channel = _RecordingChannel(self.recorder, chan)
+        self.recorder.write({'ev': 'exec', 'ch': channel.id, 'command': command})
+        chan.exec_command(command)
+        return (_StdinFile(channel, 'wb', bufsize),
+                paramiko.channel.ChannelFile(channel, 'r', bufsize),
+                paramiko.channel.ChannelStderrFile(channel, 'r', bufsize))
+
+    def invoke_shell(self, term='vt100', width=80, height=24, width_pixels=0,
+                     height_pixels=0, environment=None):
+        """ See L{paramiko.SSHClient.invoke_shell} """
+        chan = self.wrapped.get_transport().open_session()
+        chan.get_pty(term, width, height, width_pixels, height_pixels)
+        if environment:
+            chan.update_environment(environment)
+        channel = _RecordingChannel(self.recorder, chan)
+        self.recorder.write({'ev': 'shell', 'ch': channel.id})
+        chan.invoke_shell()
+        return channel
+
+    def open_sftp(self):
+        """ See L{paramiko.SSHClient.open_sftp} """
+        return _RecordingSFTP(self.recorder, self.wrapped.open_sftp())
+
+
+class _File(io.BytesIO):
+    """ Fully read remote file """
+    def prefetch(self, *args, **kwargs):
+        pass
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+
+class _RecordingSFTP(object):
+    """
+    SFTP client recording reads
+    """
+    def __init__(self, recorder, sftp):
+        self.recorder = recorder
+        self.sftp = sftp
+
+    def __getattr__(self, name):
+        return getattr(self.sftp, name)
+
+    def _call(self, op, path, func, serialize):
+        """ Call SFTP method and record its result or error """
+        try:
+            result = func()
+        except (IOError, OSError) as err:
+            self.recorder.write({'ev': 'sftp', 'op': op, 'path': path, 'errno': err.errno,
+                                 'message': err.strerror or str(err)})
+            raise
+        self.recorder.write({'ev': 'sftp', 'op': op, 'path': path, 'result': serialize(result)})
+        return result
+
+    def stat(self, path):
+        return self._call('stat', path, lambda: self.sftp.stat(path), _attrs_dict)
+
+    def lstat(self, path):
+        return self._call('lstat', path, lambda: self.sftp.lstat(path), _attrs_dict)
+
+    def listdir(self, path='.'):
+        return self._call('listdir', path, lambda: self.sftp.listdir(path), list)
+
+    def listdir_attr(self, path='.'):
+        return self._call('listdir_attr', path, lambda: self.sftp.listdir_attr(path),
+                          lambda result: [_attrs_dict(attrs) for attrs in result])
+
+    def _read(self, path):
+        """ Read whole remote file """
+        with self.sftp.open(path, 'rb') as remote:
+            remote.prefetch()
+            return remote.read()
+
+    def open(self, filename, mode='r', bufsize=-1):
+        if 'r' not in mode or '+' in mode:
+            return self.sftp.open(filename, mode, bufsize)
+        return _File(self._call('open', filename, lambda: self._read(filename),
+                                lambda data: base64.b64encode(data).decode('ascii')))
+
+    file = open
+
+    def getfo(self, remotepath, fl, callback=None, *args, **kwargs):
+        data = self._call('get', remotepath, lambda: self._read(remotepath),
+                          lambda data: base64.b64encode(data).decode('ascii'))
+        fl.write(data)
+        if callback is not None:
+            callback(len(data), len(data))
+        return len(data)
+
+    def get(self, remotepath, localpath, callback=None, *args, **kwargs):
+        with open(localpath, 'wb') as local:
+            self.getfo(remotepath, local, callback)
+
+
+class _Session(object):
+    """
+    Parsed session file
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.header = None
+        # command -> timelines of its executions
+        self.execs = {}
+        self.shells = collections.deque()
+        # (operation, path) -> records
+        self.sftp = {}
+        channels = {}
+        with _open(path, 'rb') as session:
+            for line in session:
+                record = json.loads(line.decode('utf-8'))
+                event = record['ev']
+                if event == 'session':
+                    if record.get('version') != SESSION_VERSION:
+                        raise ReplayError("Unsupported session file version %s" % record.get('version'))
+                    self.header = record
+                elif event == 'exec':
+                    # output is paced relative to the time the channel opened
+                    channels[record['ch']] = [(record['t'], 'open', None)]
+                    self.execs.setdefault(record['command'], collections.deque()).append(
+                        channels[record['ch']])
+                elif event == 'shell':
+                    channels[record['ch']] = [(record['t'], 'open', None)]
+                    self.shells.append(channels[record['ch']])
+                elif event in ('out', 'err', 'in'):
+                    channels[record['ch']].append((record['t'], event,
+                                                   base64.b64decode(record['data'])))
+                elif event == 'exit':
+                    channels[record['ch']].append((record['t'], event, record['status']))
+                elif event == 'eof':
+                    channels[record['ch']].append((record['t'], event, None))
+                elif event == 'sftp':
+                    self.sftp.setdefault((record['op'], record['path']),
+                                         collections.deque()).append(record)
+        if self.header is None:
+            raise ReplayError("%s is not a session file" % path)
+        for timeline in channels.values():
+            _settle_eof(timeline)
+
+    def exec_timeline(self, command):
+        """ Timeline of the next recorded execution of command """
+        with self.lock:
+            if not self.execs.get(command):
+                raise ReplayError("No more recorded executions of '%s'" % command)
+            return self.execs[command].popleft()
+
+    def shell_timeline(self):
+        """ Timeline of the next recorded shell """
+        with self.lock:
+            if not self.shells:
+                raise ReplayError("No more recorded shells")
+            return self.shells.popleft()
+
+    def sftp_record(self, op, path):
+        """ Next recorded result of SFTP operation, the last one repeats """
+        with self.lock:
+            records = self.sftp.get((op, path))
+            if not records:
+                raise ReplayError("SFTP %s of %s wasn't recorded" % (op, path))
+            record = records.popleft() if len(records) > 1 else records[0]
+        if 'errno' in record:
+            raise IOError(record['errno'], record['message'])
+        return record['result']
+
+
+def _settle_eof(timeline):
+    """
+    Move EOF after the last output: it is recorded when the client notices
+    it, possibly before reading buffered output
+    """
+    eofs = [idx for idx, event in enumerate(timeline) if event[1] == 'eof']
+    if not eofs:
+        return
+    eof = timeline.pop(eofs[0])
+    last = max([idx for idx, event in enumerate(timeline) if event[1] in ('out', 'err')] or [-1])
+    timeline.insert(max(last + 1, eofs[0]), eof)
+
+
+class ReplayChannel(object):
+    """
+    Channel serving a recorded timeline
+
+    Output events are released in order; at an input event the channel
+    waits until the client sends the same data. The channel is selectable
+    while it has output or EOF pending.
+    """
+    def __init__(self, timeline, speed=None):
+        """
+        @param timeline: (time, event, data) tuples, event is 'open', 'out',
+                         'err', 'in', 'exit' or 'eof'
+        @type timeline: list
+
+        @param speed: None to release output at once, otherwise recorded
+                      pace multiplied by speed
+        @type speed: float
+        """
+        self.timeline = timeline
+        self.speed = speed
+        self.idx = 0
+        # bytes of the current input event the client sent already
+        self.consumed = 0
+        self.anchor = (time.time(), timeline[0][0] if timeline else 0)
+        self.buffers = {'out': bytearray(), 'err': bytearray()}
+        self.exit_status = -1
+        self.status_event = threading.Event()
+        self.eof_received = False
+        self.closed = False
+        self.timeout = None
+        self.timer = None
+        self.cond = threading.Condition(threading.RLock())
+        self.rfd, self.wfd = os.pipe()
+        self.readable = False
+        self._release()
+
+    def _release(self, now=False):
+        """ Release due output events (all up to the next input if now), schedule the next ones """
+        with self.cond:
+            if self.closed:
+                return
+            while self.idx < len(self.timeline):
+                stamp, event, data = self.timeline[self.idx]
+                if event == 'in':
+                    break
+                if self.speed and not now:
+                    due = self.anchor[0] + (stamp - self.anchor[1]) / self.speed
+                    if due > time.time():
+                        if self.timer is None:
+                            self.timer = threading.Timer(due - time.time(), self._tick)
+                            self.timer.daemon = True
+                            self.timer.start()
+                        break
+                if event in self.buffers:
+                    self.buffers[event].extend(data)
+                elif event == 'exit':
+                    # hosts send EOF before the exit status, the client may
+                    # not have noticed it while recording
+                    self.exit_status = data
+                    self.eof_received = True
+                    self.status_event.set()
+                elif event == 'eof':
+                    self.eof_received = True
+                self.idx += 1
+            self._signal()
+            self.cond.notify_all()
+
+    def _tick(self):
+        """ Timer callback """
+        with self.cond:
+            self.timer = None
+            self._release()
+
+    def _signal(self):
+        """ Keep the pipe readable while there is something to read """
+        if self.closed:
+            return
+        ready = bool(self.buffers['out'] or self.buffers['err'] or self.eof_received)
+        if ready and not self.readable:
+            os.write(self.wfd, b'*')
+        elif not ready and self.readable:
+            os.read(self.rfd, 1)
+        self.readable = ready
+
+    def fileno(self):
+        return self.rfd
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def get_id(self):
+        return id(self)
+
+    def recv_ready(self):
+        return bool(self.buffers['out'])
+
+    def recv_stderr_ready(self):
+        return bool(self.buffers['err'])
+
+    def _recv(self, name, nbytes):
+        """ Read from buffer, waiting for data or EOF like paramiko """
+        with self.cond:
+            deadline = None if self.timeout is None else time.time() + self.timeout
+            while not self.buffers[name] and not self.eof_received and not self.closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout()
+                self.cond.wait(remaining)
+            data = bytes(self.buffers[name][:nbytes])
+            del self.buffers[name][:nbytes]
+            self._signal()
+            return data
+
+    def recv(self, nbytes):
+        return self._recv('out', nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self._recv('err', nbytes)
+
+    def send(self, data):
+        data = _bytes(data)
+        with self.cond:
+            # output still held back by pace was received before the input
+            self._release(now=True)
+            sent = 0
+            while sent < len(data):
+                if self.idx >= len(self.timeline) or self.timeline[self.idx][1] != 'in':
+                    raise ReplayError("Unexpected input %r" % data[sent:])
+                stamp, _, expected = self.timeline[self.idx]
+                chunk = data[sent:sent + len(expected) - self.consumed]
+                if expected[self.consumed:self.consumed + len(chunk)] != chunk:
+                    raise ReplayError("Sent %r, recorded %r" % (data[sent:], expected[self.consumed:]))
+                sent += len(chunk)
+                self.consumed += len(chunk)
+                if self.consumed == len(expected):
+                    self.idx += 1
+                    self.consumed = 0
+                    self.anchor = (time.time(), stamp)
+            self._release()
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def exit_status_ready(self):
+        return self.status_event.is_set()
+
+    def recv_exit_status(self):
+        self.status_event.wait()
+        return self.exit_status
+
+    def shutdown_write(self):
+        pass
+
+    def get_pty(self, *args, **kwargs):
+        pass
+
+    def resize_pty(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            if self.timer is not None:
+                self.timer.cancel()
+            os.close(self.rfd)
+            os.close(self.wfd)
+            self.status_event.set()
+            self.cond.notify_all()
+
+
+class _ReplayTransport(object):
+    """
+    Transport of a replayed session
+    """
+    def is_active(self):
+        return True
+
+    def set_keepalive(self, interval):
+        pass
+
+    def open_session(self, *args, **kwargs):
+        return ReplayChannel([])
+
+    def close(self):
+        pass
+
+
+class _ReplaySFTP(object):
+    """
+    SFTP client serving recorded reads and discarding writes
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def stat(self, path):
+        return _attrs(self.session.sftp_record('stat', path))
+
+    def lstat(self, path):
+        return _attrs(self.session.sftp_record('lstat', path))
+
+    def listdir(self, path='.'):
+        return list(self.session.sftp_record('listdir', path))
+
+    def listdir_attr(self, path='.'):
+        return [_attrs(record) for record in self.session.sftp_record('listdir_attr', path)]
+
+    def open(self, filename, mode='r', bufsize=-1):
+        if 'r' not in mode or '+' in mode:
+            return _File()
+        return _File(base64.b64decode(self.session.sftp_record('open', filename)))
+
+    file = open
+
+    def getfo(self, remotepath, fl, callback=None, *args, **kwargs):
+        data = base64.b64decode(self.session.sftp_record('get', remotepath))
+        fl.write(data)
+        if callback is not None:
+            callback(len(data), len(data))
+        return len(data)
+
+    def get(self, remotepath, localpath, callback=None, *args, **kwargs):
+        with open(localpath, 'wb') as local:
+            self.getfo(remotepath, local, callback)
+
+    def put(self, localpath, remotepath, *args, **kwargs):
+        attrs = paramiko.SFTPAttributes()
+        attrs.st_size = os.path.getsize(localpath)
+        return attrs
+
+    def putfo(self, fl, remotepath, *args, **kwargs):
+        attrs = paramiko.SFTPAttributes()
+        attrs.st_size = len(fl.read())
+        return attrs
+
+    def _discard(self, *args, **kwargs):
+        """ Modifications are not replayed """
+        pass
+
+    mkdir = rmdir = remove = unlink = rename = posix_rename = chmod = chown = \
+        utime = truncate = symlink = chdir = close = _discard
+
+
+class _ReplayClient(object):
+    """
+    SSH client of a replayed session
+    """
+    def __init__(self, session, speed):
+        self.session = session
+        self.speed = speed
+        self.transport = _ReplayTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def exec_command(self, command, bufsize=-1, timeout=None, get_pty=False,
+                     environment=None):
+        """ See L{paramiko.SSHClient.exec_command} """
+        channel = ReplayChannel(self.session.exec_timeline(command), self.speed)
+        channel.settimeout(timeout)
+        return (_StdinFile(channel, 'wb', bufsize),
+                paramiko.channel.ChannelFile(channel, 'r', bufsize),
+                paramiko.channel.ChannelStderrFile(channel, 'r', bufsize))
+
+    def invoke_shell(self, *args, **kwargs):
+        """ See L{paramiko.SSHClient.invoke_shell} """
+        return ReplayChannel(self.session.shell_timeline(), self.speed)
+
+    def open_sftp(self):
+        """ See L{paramiko.SSHClient.open_sftp} """
+        return _ReplaySFTP(self.session)
+
+    def close(self):
+        pass
+
+
+class ReplayConnection(Connection):
+    """
+    Connection serving a recorded session (see L{replay})
+    """
+    def __init__(self, path, speed=None, **kwargs):
+        """
+        Load session file
+
+        @param path: session file recorded with Connection(..., record=path)
+        @type path: str
+
+        @param speed: None to replay at full speed, otherwise recorded pace
+                      multiplied by speed
+        @type speed: float
+
+        Other keyword arguments are passed to L{Connection}.
+
+        @raises ReplayError: if the file is not a session file
+        """
+        self.session = _Session(path)
+        self.speed = speed
+        header = self.session.header
+        kwargs.setdefault('username', header['username'])
+        kwargs.setdefault('port', header['port'])
+        kwargs['mux'] = False
+        kwargs['use_agent'] = False
+        Connection.__init__(self, {'private_hostname': header['hostname'],
+                                   'public_hostname': header['hostname']}, **kwargs)
+
+    def _open(self, timeout=None):
+        return _ReplayClient(self.session, self.speed)
@@ -0,0 +1,104 @@
+"""
+Interactive shell sessions of L{Connection}
+"""
+
+import random
+import re
+import string
+import time
+
+from stitches.connection import StitchesConnectionException
+from stitches.expect import CTRL_C, Expect, ExpectFailed, _Matcher
+
+# maximum time reset waits for the prompt after interrupting
+SETTLE_TIMEOUT = 2
+
+
+class ShellSession(object):
+    """
+    Interactive shell on a channel of its own
+
+    Sessions can be passed to L{Expect} methods instead of the connection,
+    attributes not defined here are taken from the connection.
+    """
+    def __init__(self, connection, prompt=None, timeout=10):
+        """
+        Start shell and wait for its prompt
+
+        @param connection: connection to the host
+        @type connection: L{Connection}
+
+        @param prompt: regular expression found in the shell prompt
+                       ('username@' by default)
+        @type prompt: str or compiled regexp
+
+        @param timeout: timeout for the prompt to appear
+        @type timeout: int or float
+
+        @raises StitchesConnectionException: if the prompt doesn't appear
+        """
+        self.connection = connection
+        self.requested_prompt = prompt
+        if prompt is None:
+            prompt = re.escape('%s@' % connection.username)
+        self.prompt = prompt if hasattr(prompt, 'search') else re.compile(prompt)
+        start = time.time()
+        self.channel = connection.cli.invoke_shell(width=360, height=80)
+        self.channel.settimeout(10)
+        try:
+            self.wait_prompt(timeout)
+        except ExpectFailed:
+            self.channel.close()
+            raise StitchesConnectionException("Failed to get shell prompt")
+        connection.metrics.observe('shell_open_seconds', time.time() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    @property
+    def alive(self):
+        """ True if the shell can take commands """
+        return not self.channel.closed and not self.channel.eof_received
+
+    def wait_prompt(self, timeout=10):
+        """
+        Read output until the prompt appears
+
+        @raises ExpectFailed
+        """
+        Expect._wait(self, _Matcher([(self.prompt, True)], search=True), timeout)
+
+    def drain(self):
+        """
+        Discard output received so far
+        """
+        while self.channel.recv_ready():
+            self.connection.metrics.inc('bytes_received', len(self.channel.recv(32768)))
+
+    def reset(self, timeout=10):
+        """
+        Interrupt whatever runs in the shell and wait for a fresh prompt
+
+        @raises ExpectFailed
+        """
+        self.drain()
+        # some shells (e.g. dash) discard input typed ahead of the interrupt,
+        # the command goes after the prompt (or a short settle time)
+        self.channel.send(CTRL_C)
+        try:
+            self.wait_prompt(min(timeout, SETTLE_TIMEOUT))
+        except ExpectFailed:
+            pass
+        self.drain()
+        token = ''.join(random.choice(string.ascii_lowercase) for _ in range(16))
+        # the echoed command line doesn't contain the token, its output does
+        command = "echo %s''%s" % (token[:8], token[8:])
+        Expect.enter(self, command)
+        pattern = re.compile(re.escape(token) + r'[\s\S]*?(?:%s)' % self.prompt.pattern, self.prompt.flags)
+        Expect._wait(self, _Matcher([(pattern, True)], search=True), timeout)
+
+    def close(self):
+        """
+        Close the shell
+        """
+        self.channel.close()
@@ -4,43 +4,491 @@ Class to represent the whole setup (a bunch of nodes)
 
 
 import logging
-import yaml
+import threading
 
-from stitches.connection import Connection
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from stitches.connection import Connection, CommandResult, \
+    StitchesConnectionException
+from stitches.inventory import HostRecord, Inventory, LazyConnections, load_yaml
+from stitches.metrics import Metrics, to_prometheus
+
+
+class StitchesUnreachableException(StitchesConnectionException):
+    """
+    Some instances couldn't be connected to
+    """
+    def __init__(self, failures):
+        """
+        @param failures: hostname -> exception
+        @type failures: dict
+        """
+        StitchesConnectionException.__init__(
+            self, "Failed to connect to %i instance(s): %s" %
+            (len(failures), ", ".join("%s (%s)" % (hostname, failures[hostname])
+                                      for hostname in sorted(failures))))
+        self.failures = failures
+
+
+def _created(connections):
+    """ Connections of a role which exist already """
+    if isinstance(connections, LazyConnections):
+        return connections.created()
+    return connections
+
+
+def _imap_unordered(func, items, workers):
+    """
+    Apply func to every item using a bounded pool of threads
+
+    Results are yielded as (item, result, error) tuples in order of
+    completion. Items not started yet are dropped when the generator is
+    closed.
+    """
+    items = list(items)
+    if not items:
+        return
+    tasks = queue.Queue()
+    for item in items:
+        tasks.put(item)
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        """ Pool worker """
+        while not stop.is_set():
+            try:
+                item = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results.put((item, func(item), None))
+            except Exception as err:
+                results.put((item, None, err))
+
+    for _ in range(max(1, min(workers, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    try:
+        for _ in range(len(items)):
+            yield results.get()
+    finally:
+        stop.set()
 
 
 class Structure(object):
     """
     Stateful object to represent whole setup
+
+    Instances maps roles to lists of connections; instances are kept in an
+    L{Inventory} and their connections are created on first access.
     """
+    # class used to create connections to instances
+    connection_class = Connection
+
     def __init__(self):
         self.logger = logging.getLogger('stitches.structure')
         self.Instances = {}
+        self.inventory = Inventory()
         self.config = {}
 
     def __del__(self):
         """
         Close all connections
         """
-        for role in self.Instances.keys():
-            for connection in self.Instances[role]:
-                connection.sftp.close()
-                connection.cli.close()
+        self.disconnect_all()
 
-    def reconnect_all(self):
+    def disconnect_all(self):
         """
-        Re-establish connection to all instances
+        Close all connections (only what was actually opened is closed)
         """
         for role in self.Instances.keys():
-            for connection in self.Instances[role]:
-                connection.reconnect()
+            for connection in _created(self.Instances[role]):
+                connection.disconnect()
+
+    @staticmethod
+    def _connect(connection, timeout):
+        """ Connect instance from a worker thread """
+        return connection.connect(timeout)
+
+    def connect_all(self, roles=None, workers=32, timeout=None,
+                    raise_on_failure=True):
+        """
+        Connect to all instances in parallel
+
+        @param roles: roles to connect to (all roles if None)
+        @type roles: list of str or str
+
+        @param workers: maximum number of concurrent connection attempts
+        @type workers: int
+
+        @param timeout: per-instance connection timeout (connection's
+                        timeout by default)
+        @type timeout: int or float
+
+        @param raise_on_failure: raise an exception listing all unreachable
+                                 instances
+        @type raise_on_failure: bool
+
+        @return: unreachable instances, hostname -> exception
+        @rtype: dict
+
+        @raises StitchesUnreachableException
+        """
+        return self._each_connection(self._connect, self.connections(roles),
+                                     workers, timeout, raise_on_failure)
+
+    def _each_connection(self, func, targets, workers, timeout, raise_on_failure):
+        """
+        Call func(connection, timeout) for (role, connection) targets in
+        parallel, collecting failures (see L{connect_all})
+        """
+        failures = {}
+        for (_, connection), _, error in _imap_unordered(
+                lambda target: func(target[1], timeout), targets, workers):
+            if error is not None:
+                self.logger.debug('Failed to connect to %s: %s',
+                                  connection.hostname, error)
+                failures[connection.hostname] = error
+        if failures and raise_on_failure:
+            raise StitchesUnreachableException(failures)
+        return failures
+
+    def connections(self, roles=None, selector=None):
+        """
+        Get connections to instances
+
+        @param roles: roles to select (all roles if None)
+        @type roles: list of str or str
+
+        @param selector: select instances by role, hostname and labels
+                         instead (see L{inventory}), e.g.
+                         'region=eu-west-1,!canary'
+        @type selector: str
+
+        @return: list of (role, connection) tuples
+        @rtype: list
+
+        @raises ValueError: if selector is malformed
+        """
+        if selector is not None:
+            return [(record.role, record.connection)
+                    for record in self.inventory.select(selector)]
+        if roles is None:
+            roles = sorted(self.Instances.keys())
+        elif not isinstance(roles, (list, tuple, set)):
+            roles = [roles]
+        result = []
+        for role in roles:
+            for connection in self.Instances.get(role, []):
+                result.append((role, connection))
+        return result
+
+    def _created(self, roles=None):
+        """ (role, connection) tuples of connections created already """
+        if roles is None:
+            roles = sorted(self.Instances.keys())
+        elif not isinstance(roles, (list, tuple, set)):
+            roles = [roles]
+        return [(role, connection) for role in roles
+                for connection in _created(self.Instances.get(role, []))]
+
+    def host(self, hostname, role=None):
+        """
+        Get connection to instance by hostname
+
+        @param hostname: instance's hostname
+        @type hostname: str
+
+        @param role: role the instance has to have (any role if None)
+        @type role: str
+
+        @rtype: L{Connection}
+
+        @raises KeyError: if there is no such instance
+        """
+        return self.inventory.host(hostname, role).connection
+
+    def run(self, commands, roles=None, timeout=10, workers=16,
+            fail_fast=False, max_failures=None, get_pty=False):
+        """
+        Run command(s) on all instances in parallel
+
+        Commands for a single instance are executed one after another,
+        execution on the instance stops at the first failed command.
+
+        @param commands: command or list of commands to execute
+        @type commands: str or list of str
+
+        @param roles: roles to run commands on (all roles if None)
+        @type roles: list of str or str
+
+        @param timeout: per-command execution timeout
+        @type timeout: int
+
+        @param workers: maximum number of instances handled concurrently
+        @type workers: int
+
+        @param fail_fast: stop after the first failure
+        @type fail_fast: bool
+
+        @param max_failures: stop after this number of failures
+        @type max_failures: int
+
+        @param get_pty: get pty
+        @type get_pty: bool
+
+        @return: generator of command results in order of completion
+        @rtype: generator of L{CommandResult}
+        """
+        if not isinstance(commands, (list, tuple)):
+            commands = [commands]
+        if fail_fast:
+            max_failures = 1
+
+        def run_instance(target):
+            """ Run all commands on one instance """
+            role, connection = target
+            results = []
+            for command in commands:
+                try:
+                    result = connection.run(command, timeout, get_pty)
+                except Exception as err:
+                    result = CommandResult(connection.hostname, command,
+                                           error=err)
+                result.role = role
+                results.append(result)
+                if result.failed:
+                    break
+            return results
+
+        failures = 0
+        pool = _imap_unordered(run_instance, self.connections(roles), workers)
+        try:
+            for _, results, _ in pool:
+                for result in results:
+                    yield result
+                    if result.failed:
+                        failures += 1
+                if max_failures is not None and failures >= max_failures:
+                    self.logger.debug('Stopping after %s failure(s)', failures)
+                    return
+        finally:
+            pool.close()
+
+    def prefetch_facts(self, names=None, roles=None, timeout=30, workers=16,
+                       ttl=None):
+        """
+        Get facts of all instances in parallel, one remote session per
+        instance, and cache them in the connections (see
+        L{Connection.prefetch_facts})
+
+        @param names: fact names (all of L{facts.FACTS} if None)
+        @type names: list of str
+
+        @param roles: roles to get facts of (all roles if None)
+        @type roles: list of str or str
+
+        @param timeout: per-instance timeout (seconds)
+        @type timeout: int or float
+
+        @param workers: maximum number of instances handled concurrently
+        @type workers: int
+
+        @param ttl: number of seconds the facts are valid for (connection's
+                    facts_ttl by default)
+        @type ttl: int or float
+
+        @return: hostname -> fact name -> value (instances which failed are
+                 left out)
+        @rtype: dict
+        """
+        result = {}
+        for (_, connection), facts, error in _imap_unordered(
+                lambda target: target[1].prefetch_facts(names, timeout, ttl),
+                self.connections(roles), workers):
+            if error is not None:
+                self.logger.debug('Failed to get facts of %s: %s',
+                                  connection.hostname, error)
+                continue
+            result[connection.hostname] = facts
+        return result
+
+    def distribute(self, local_path, remote_path, roles=None, seeds=2,
+                   fanout=2, timeout=3600, progress=None,
+                   raise_on_failure=True, relay=False):
+        """
+        Copy local file to all instances; with relay, upload it to a few seed
+        instances only and relay it between instances from there (see
+        L{distribute.distribute})
+
+        @param local_path: local file
+        @type local_path: str
+
+        @param remote_path: remote file
+        @type remote_path: str
+
+        @param roles: roles to copy the file to (all roles if None)
+        @type roles: list of str or str
+
+        @param seeds: number of instances the controller uploads to
+                      (concurrently when not relaying)
+        @type seeds: int
+
+        @param fanout: number of instances every holder of a copy relays to
+                       concurrently
+        @type fanout: int
+
+        @param timeout: timeout for a single copy (seconds)
+        @type timeout: int or float
+
+        @param progress: function called with (hostname, state, detail)
+        @type progress: callable
+
+        @param raise_on_failure: raise an exception listing all instances
+                                 the file couldn't be delivered to
+        @type raise_on_failure: bool
+
+        @param relay: let instances relay the file to each other over ssh
+                      with an ephemeral key
+        @type relay: bool
+
+        @return: hostname -> source hostname or 'controller'
+        @rtype: dict
+
+        @raises StitchesDistributionException
+        """
+        from stitches import distribute
+        return distribute.distribute([connection for _, connection in self.connections(roles)],
+                                     local_path, remote_path, seeds, fanout, timeout,
+                                     progress, raise_on_failure=raise_on_failure,
+                                     relay=relay)
+
+    def process_pool(self, processes=None, roles=None):
+        """
+        Shard connections across worker processes (see L{procpool})
+
+        @param processes: number of worker processes (number of CPUs by
+                          default)
+        @type processes: int
+
+        @param roles: roles to include (all roles if None)
+        @type roles: list of str or str
+
+        @return: started process pool, close it (or use it as a context
+                 manager) to stop the workers
+        @rtype: L{procpool.ProcessPool}
+        """
+        from stitches.procpool import ProcessPool
+        return ProcessPool(self, processes, roles)
+
+    def metrics(self, roles=None):
+        """
+        Aggregate connection metrics per role
+
+        @param roles: roles to aggregate (all roles if None)
+        @type roles: list of str or str
+
+        @return: role -> aggregated metrics
+        @rtype: dict of L{Metrics}
+        """
+        result = {}
+        for role, connection in self._created(roles):
+            if role not in result:
+                result[role] = Metrics()
+            result[role].merge(connection.metrics)
+        return result
+
+    def metrics_snapshot(self, roles=None, per_host=False):
+        """
+        Export metrics as a dict
+
+        @param roles: roles to export (all roles if None)
+        @type roles: list of str or str
+
+        @param per_host: export metrics of every connection rather than
+                         aggregates per role (instances never used are left
+                         out)
+        @type per_host: bool
+
+        @return: role -> snapshot or role -> hostname -> snapshot
+        @rtype: dict
+        """
+        if not per_host:
+            return dict((role, metrics.snapshot())
+                        for role, metrics in self.metrics(roles).items())
+        result = {}
+        for role, connection in self._created(roles):
+            result.setdefault(role, {})[connection.hostname] = connection.metrics.snapshot()
+        return result
+
+    def prometheus_metrics(self, roles=None, per_host=False):
+        """
+        Export metrics in prometheus text format, labeled with role (and
+        host)
+
+        @param roles: roles to export (all roles if None)
+        @type roles: list of str or str
+
+        @param per_host: export metrics of every connection rather than
+                         aggregates per role
+        @type per_host: bool
+
+        @return: prometheus text exposition
+        @rtype: str
+        """
+        if not per_host:
+            return to_prometheus([({'role': role}, metrics)
+                                  for role, metrics in sorted(self.metrics(roles).items())])
+        return to_prometheus([({'role': role, 'host': connection.hostname}, connection.metrics)
+                              for role, connection in self._created(roles)])
+
+    @staticmethod
+    def _reconnect(connection, timeout):
+        """ Reconnect instance from a worker thread """
+        return connection.reconnect(timeout)
+
+    def reconnect_all(self, roles=None, workers=32, timeout=None,
+                      raise_on_failure=True):
+        """
+        Re-establish connections to instances in parallel
+
+        Only connections which were opened already are reconnected, lazy
+        connections to instances which weren't used stay unopened.
+
+        @param roles: roles to reconnect (all roles if None)
+        @type roles: list of str or str
+
+        @param workers: maximum number of concurrent connection attempts
+        @type workers: int
+
+        @param timeout: per-instance connection timeout (connection's
+                        timeout by default)
+        @type timeout: int or float
+
+        @param raise_on_failure: raise an exception listing all unreachable
+                                 instances
+        @type raise_on_failure: bool
+
+        @return: unreachable instances, hostname -> exception
+        @rtype: dict
+
+        @raises StitchesUnreachableException
+        """
+        return self._each_connection(self._reconnect, self._created(roles),
+                                     workers, timeout, raise_on_failure)
 
     def add_instance(self,
                     role,
                     instance,
                     username='root',
                     key_filename=None,
-                    output_shell=False):
+                    output_shell=False,
+                    pool=None):
         """
         Add instance to the setup
 
@@ -60,18 +508,29 @@ class Structure(object):
         @param output_shell: write output from this connection to standard
                              output
         @type output_shell: bool
+
+        @param pool: share ssh transports between connections to the same
+                     host using this pool (True for the process-wide pool)
+        @type pool: L{TransportPool} or bool
+
+        @return: inventory record, its connection is created on first use
+        @rtype: L{HostRecord}
         """
         if not role in self.Instances.keys():
-            self.Instances[role] = []
-        self.logger.debug('Adding ' + role + ' with private_hostname ' +
-                          instance['private_hostname'] +
-                          ', public_hostname ' + instance['public_hostname'])
-        self.Instances[role].append(Connection(instance,
-                                               username,
-                                               key_filename,
-                                               output_shell=output_shell))
+            self.Instances[role] = LazyConnections()
+        self.logger.debug('Adding %s with private_hostname %s, public_hostname %s',
+                          role, instance['private_hostname'], instance['public_hostname'])
+        record = HostRecord(role, instance, self.connection_class, username,
+                            key_filename, output_shell, pool)
+        self.inventory.add(record)
+        if isinstance(self.Instances[role], LazyConnections):
+            self.Instances[role].append(record)
+        else:
+            self.Instances[role].append(record.connection)
+        return record
 
-    def setup_from_yamlfile(self, yamlfile, output_shell=False):
+    def setup_from_yamlfile(self, yamlfile, output_shell=False, pool=None,
+                            warmup=False):
         """
         Setup from yaml config
 
@@ -81,14 +540,28 @@ class Structure(object):
         @param output_shell: write output from this connection to standard
                              output
         @type output_shell: bool
+
+        @param pool: share ssh transports between connections to the same
+                     host using this pool (True for the process-wide pool)
+        @type pool: L{TransportPool} or bool
+
+        @param warmup: connect to all instances in parallel right away (see
+                       L{connect_all})
+        @type warmup: bool
+
+        @raises StitchesUnreachableException: if warmup fails for some
+                                              instances
         """
         self.logger.debug('Loading config from ' + yamlfile)
         with open(yamlfile, 'r') as yamlfd:
-            yamlconfig = yaml.load(yamlfd)
+            yamlconfig = load_yaml(yamlfd)
             for instance in yamlconfig['Instances']:
                 self.add_instance(instance['role'].upper(),
                                   instance,
-                                  output_shell=output_shell)
+                                  output_shell=output_shell,
+                                  pool=pool)
             if 'Config' in yamlconfig.keys():
                 self.logger.debug('Config found: ' + str(yamlconfig['Config']))
                 self.config = yamlconfig['Config'].copy()
+        if warmup:
+            self.connect_all()
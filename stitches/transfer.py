@@ -0,0 +1,412 @@
+"""
+Bulk file and directory transfer over L{Connection}
+"""
+
+import hashlib
+import logging
+import os
+import posixpath
+import stat
+import tarfile
+import threading
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from stitches.connection import StitchesConnectionException
+
+# files smaller than this are sent in one tar stream instead of over SFTP
+SMALL_FILE = 65536
+
+
+class TransferResult(object):
+    """
+    Summary of a tree transfer
+    """
+    def __init__(self):
+        self.transferred = []
+        self.skipped = []
+        self.bytes = 0
+
+    def __repr__(self):
+        return "<TransferResult transferred=%i skipped=%i bytes=%i>" % (len(self.transferred),
+                                                                       len(self.skipped),
+                                                                       self.bytes)
+
+
+class _ChannelStream(object):
+    """
+    Minimal file object over a channel for streaming tarfile modes
+
+    paramiko's ChannelFile objects can't be finalized after their buffers
+    when garbage collected in a reference cycle (tarfile creates cycles).
+    """
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        """ Send all data """
+        self.channel.sendall(data)
+
+    def read(self, size):
+        """ Read size bytes or until EOF """
+        chunks = []
+        while size > 0:
+            data = self.channel.recv(min(size, 1048576))
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+
+def _sha256(path):
+    """ Checksum of local file """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(1048576), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _local_tree(local_dir):
+    """
+    List local tree, symbolic links are listed as links (not followed)
+
+    @return: (list of relative directories, relpath -> size, relpath ->
+             link target)
+    @rtype: tuple
+    """
+    dirs, files, links = [], {}, {}
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        rel = os.path.relpath(dirpath, local_dir)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            relpath = posixpath.normpath(posixpath.join(rel.replace(os.sep, '/'), name))
+            if os.path.islink(path):
+                links[relpath] = os.readlink(path)
+            elif name in dirnames:
+                dirs.append(relpath)
+            elif os.path.isfile(path):
+                files[relpath] = os.path.getsize(path)
+    return dirs, files, links
+
+
+def _remote_tree(connection, remote_dir, checksum=False, timeout=600,
+                 missing_ok=False):
+    """
+    List remote tree in one round-trip, symbolic links are listed as links
+    (not followed)
+
+    @param missing_ok: list a missing remote_dir as an empty tree
+    @type missing_ok: bool
+
+    @return: (list of relative directories, relpath -> (size, sha256 or
+             None, permission bits), relpath -> link target)
+    @rtype: tuple
+
+    @raises StitchesConnectionException: if remote_dir can't be listed
+    """
+    command = ("cd %s || exit 2; find . -mindepth 1 -type d -printf 'd %%P\\n' "
+               "-o -type f -printf 'f %%s %%m %%P\\n' -o -type l -printf 'l %%P\\0%%l\\n'" %
+               quote(remote_dir))
+    if missing_ok:
+        command = "[ -e %s ] || exit 0; %s" % (quote(remote_dir), command)
+    if checksum:
+        command += "; echo; find . -type f -exec sha256sum {} +"
+    output = []
+    # listing may be longer than the connection keeps in last_stdout
+    status = connection.recv_exit_status(command, timeout,
+                                         callback=lambda name, data: name == 'stdout' and output.append(data))
+    if status != 0:
+        raise StitchesConnectionException("Failed to list %s: %s" % (remote_dir, connection.last_stderr))
+    dirs, sizes, sums, links = [], {}, {}, {}
+    listing, _, checksums = b''.join(output).decode('utf-8', 'replace').partition('\n\n')
+    for line in listing.splitlines():
+        if line.startswith('d '):
+            dirs.append(line[2:])
+        elif line.startswith('f '):
+            size, mode, relpath = line[2:].split(' ', 2)
+            sizes[relpath] = (int(size), int(mode, 8))
+        elif line.startswith('l '):
+            relpath, _, target = line[2:].partition('\0')
+            links[relpath] = target
+    for line in checksums.splitlines():
+        if line:
+            digest, relpath = line.split('  ', 1)
+            sums[posixpath.normpath(relpath)] = digest
+    return dirs, dict((relpath, (size, sums.get(relpath), mode))
+                      for relpath, (size, mode) in sizes.items()), links
+
+
+def _unlink(path):
+    """ Remove local symbolic link or file about to be replaced """
+    if os.path.islink(path) or os.path.isfile(path):
+        os.unlink(path)
+
+
+def _unchanged(size, local_path, remote, skip):
+    """ Check if remote (size, sha256, permission bits) matches local file """
+    if skip is None or remote is None or remote[0] != size:
+        return False
+    if remote[2] != stat.S_IMODE(os.stat(local_path).st_mode):
+        return False
+    if skip == 'checksum':
+        return remote[1] == _sha256(local_path)
+    return True
+
+
+def _parallel_sftp(connection, jobs, workers, func):
+    """ Run func(sftp, job) for all jobs using workers SFTP channels """
+    tasks = queue.Queue()
+    for job in jobs:
+        tasks.put(job)
+    errors = []
+
+    def worker():
+        """ Transfer worker with its own SFTP channel """
+        sftp = connection.cli.open_sftp()
+        try:
+            while not errors:
+                try:
+                    job = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                func(sftp, job)
+        except Exception as err:
+            errors.append(err)
+        finally:
+            sftp.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(jobs))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def put_tree(connection, local_dir, remote_dir, workers=4, skip='size',
+             small_file=SMALL_FILE, timeout=600):
+    """
+    Copy local directory tree to the host
+
+    Small files and symbolic links are sent in a single tar stream over an
+    exec channel, large files are uploaded over several SFTP channels at
+    once. Permission bits of files are copied too.
+
+    @param connection: connection to the host
+    @type connection: L{Connection}
+
+    @param local_dir: local directory
+    @type local_dir: str
+
+    @param remote_dir: remote directory (created if missing)
+    @type remote_dir: str
+
+    @param workers: number of files uploaded concurrently
+    @type workers: int
+
+    @param skip: skip files whose permission bits and 'size' or 'checksum'
+                 (sha256) already match on the remote side, None to copy
+                 everything
+    @type skip: str or None
+
+    @param small_file: size limit for files sent in the tar stream
+    @type small_file: int
+
+    @param timeout: timeout for remote commands
+    @type timeout: int or float
+
+    @return: transfer summary
+    @rtype: L{TransferResult}
+    """
+    logger = logging.getLogger('stitches.transfer')
+    result = TransferResult()
+    dirs, files, links = _local_tree(local_dir)
+    remote, remote_links = {}, {}
+    if skip:
+        _, remote, remote_links = _remote_tree(connection, remote_dir, skip == 'checksum', timeout,
+                                               missing_ok=True)
+    small, large = [], []
+    for relpath in sorted(links):
+        if skip and remote_links.get(relpath) == links[relpath]:
+            result.skipped.append(relpath)
+        else:
+            small.append(relpath)
+    for relpath in sorted(files):
+        local_path = os.path.join(local_dir, *relpath.split('/'))
+        if _unchanged(files[relpath], local_path, remote.get(relpath), skip):
+            result.skipped.append(relpath)
+        elif files[relpath] < small_file:
+            small.append(relpath)
+        else:
+            large.append(relpath)
+    small.sort()
+    logger.debug('put_tree %s -> %s: %i small, %i large, %i skipped', local_dir, remote_dir,
+                 len(small), len(large), len(result.skipped))
+
+    # directories, small files and links go in one tar stream
+    stdin, stdout, stderr = connection.exec_command("mkdir -p %s && tar -xf - -C %s" %
+                                                    (quote(remote_dir), quote(remote_dir)))
+    tar = tarfile.open(fileobj=_ChannelStream(stdin.channel), mode='w|')
+    for relpath in dirs:
+        tar.add(os.path.join(local_dir, *relpath.split('/')), arcname=relpath, recursive=False)
+    for relpath in small:
+        tar.add(os.path.join(local_dir, *relpath.split('/')), arcname=relpath)
+    tar.close()
+    stdin.close()
+    stdout.channel.status_event.wait(timeout)
+    if not stdout.channel.exit_status_ready() or stdout.channel.recv_exit_status() != 0:
+        raise StitchesConnectionException("Failed to extract files to %s: %s" %
+                                          (remote_dir, stderr.read()))
+    stdout.channel.close()
+
+    def upload(sftp, relpath):
+        """ Upload one large file """
+        local_path = os.path.join(local_dir, *relpath.split('/'))
+        remote_path = posixpath.join(remote_dir, relpath)
+        try:
+            # don't write through a link left from a previous copy
+            sftp.remove(remote_path)
+        except IOError:
+            pass
+        sftp.put(local_path, remote_path)
+        sftp.chmod(remote_path, stat.S_IMODE(os.stat(local_path).st_mode))
+    _parallel_sftp(connection, large, workers, upload)
+
+    for relpath in small + large:
+        result.transferred.append(relpath)
+        result.bytes += files.get(relpath, 0)
+    connection.metrics.inc('bytes_sent', result.bytes)
+    return result
+
+
+def get_tree(connection, remote_dir, local_dir, workers=4, skip='size',
+             small_file=SMALL_FILE, timeout=600):
+    """
+    Copy directory tree from the host
+
+    Small files and symbolic links are received in a single tar stream over
+    an exec channel, large files are downloaded over several SFTP channels
+    at once. Permission bits of files are copied too.
+
+    @param connection: connection to the host
+    @type connection: L{Connection}
+
+    @param remote_dir: remote directory (has to exist)
+    @type remote_dir: str
+
+    @param local_dir: local directory (created if missing)
+    @type local_dir: str
+
+    @param workers: number of files downloaded concurrently
+    @type workers: int
+
+    @param skip: skip files whose permission bits and 'size' or 'checksum'
+                 (sha256) already match on the local side, None to copy
+                 everything
+    @type skip: str or None
+
+    @param small_file: size limit for files received in the tar stream
+    @type small_file: int
+
+    @param timeout: timeout for remote commands
+    @type timeout: int or float
+
+    @return: transfer summary
+    @rtype: L{TransferResult}
+
+    @raises StitchesConnectionException: if remote_dir can't be listed
+    """
+    logger = logging.getLogger('stitches.transfer')
+    result = TransferResult()
+    remote_dirs, remote, remote_links = _remote_tree(connection, remote_dir, skip == 'checksum', timeout)
+    small, large = [], []
+    for relpath in sorted(remote_links):
+        local_path = os.path.join(local_dir, *relpath.split('/'))
+        if skip and os.path.islink(local_path) and os.readlink(local_path) == remote_links[relpath]:
+            result.skipped.append(relpath)
+        else:
+            small.append(relpath)
+    for relpath in sorted(remote):
+        local_path = os.path.join(local_dir, *relpath.split('/'))
+        size = remote[relpath][0]
+        if os.path.isfile(local_path) and not os.path.islink(local_path) and \
+                _unchanged(os.path.getsize(local_path), local_path, remote[relpath], skip):
+            result.skipped.append(relpath)
+        elif size < small_file:
+            small.append(relpath)
+        else:
+            large.append(relpath)
+    small.sort()
+    logger.debug('get_tree %s -> %s: %i small, %i large, %i skipped', remote_dir, local_dir,
+                 len(small), len(large), len(result.skipped))
+    # empty directories are copied too
+    for relpath in [''] + remote_dirs:
+        local_subdir = os.path.join(local_dir, *relpath.split('/'))
+        if not os.path.isdir(local_subdir):
+            os.makedirs(local_subdir)
+
+    if small:
+        stdin, stdout, stderr = connection.exec_command("tar -cf - -C %s --null -T -" % quote(remote_dir))
+        # file list is written from a thread: tar starts producing output
+        # before it reads the whole list
+        names = b''.join(relpath.encode('utf-8') + b'\0' for relpath in small)
+        writer = threading.Thread(target=lambda: (stdin.write(names), stdin.close()))
+        writer.start()
+        tar = tarfile.open(fileobj=_ChannelStream(stdout.channel), mode='r|')
+        for member in tar:
+            if member.issym() and member.name in remote_links:
+                local_path = os.path.join(local_dir, *member.name.split('/'))
+                _unlink(local_path)
+                os.symlink(member.linkname, local_path)
+                continue
+            if not member.isfile() or member.name not in remote:
+                continue
+            local_path = os.path.join(local_dir, *member.name.split('/'))
+            if not os.path.isdir(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            # don't write through a link left from a previous copy
+            _unlink(local_path)
+            source = tar.extractfile(member)
+            with open(local_path, 'wb') as fd:
+                for block in iter(lambda: source.read(1048576), b''):
+                    fd.write(block)
+            os.chmod(local_path, stat.S_IMODE(member.mode))
+        tar.close()
+        writer.join()
+        stdout.channel.status_event.wait(timeout)
+        if not stdout.channel.exit_status_ready() or stdout.channel.recv_exit_status() != 0:
+            raise StitchesConnectionException("Failed to pack files in %s: %s" %
+                                              (remote_dir, stderr.read()))
+        stdout.channel.close()
+
+    def download(sftp, relpath):
+        """ Download one large file """
+        local_path = os.path.join(local_dir, *relpath.split('/'))
+        local_subdir = os.path.dirname(local_path)
+        try:
+            os.makedirs(local_subdir)
+        except OSError:
+            if not os.path.isdir(local_subdir):
+                raise
+        _unlink(local_path)
+        sftp.get(posixpath.join(remote_dir, relpath), local_path,
+                 **connection.profile.sftp_get_kwargs())
+        os.chmod(local_path, stat.S_IMODE(remote[relpath][2]))
+    _parallel_sftp(connection, large, workers, download)
+
+    for relpath in small + large:
+        result.transferred.append(relpath)
+        result.bytes += remote[relpath][0] if relpath in remote else 0
+    connection.metrics.inc('bytes_received', result.bytes)
+    return result
@@ -0,0 +1,3 @@
+"""
+Stitches tests, run against the in-process SSH server of the benchmarks
+"""
@@ -0,0 +1,53 @@
+"""
+Local SSH server shared by the tests
+
+The server from benchmarks/sshserver.py accepts any user and key, runs
+commands with the local /bin/sh and serves the local filesystem over SFTP.
+"""
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.join(_ROOT, 'benchmarks'))
+
+import paramiko
+
+from sshserver import SSHServer
+
+_SERVER = {}
+
+
+def _stop():
+    """ Stop the server and remove its key """
+    _SERVER['server'].close()
+    shutil.rmtree(_SERVER['tmpdir'], ignore_errors=True)
+
+
+def server():
+    """
+    Get server started on first use
+
+    @return: (L{SSHServer}, private key file)
+    @rtype: tuple
+    """
+    if not _SERVER:
+        tmpdir = tempfile.mkdtemp(prefix='stitches-test-key-')
+        key_filename = os.path.join(tmpdir, 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_filename)
+        _SERVER.update(server=SSHServer(), tmpdir=tmpdir, key_filename=key_filename)
+        atexit.register(_stop)
+    return _SERVER['server'], _SERVER['key_filename']
+
+
+def instance(**parameters):
+    """ Instance dict pointing to the local server """
+    ssh_server, key_filename = server()
+    result = {'private_hostname': '127.0.0.1', 'public_hostname': '127.0.0.1',
+              'port': ssh_server.port, 'key_filename': key_filename}
+    result.update(parameters)
+    return result
@@ -0,0 +1,67 @@
+"""
+Tests of L{Connection.run_batch} output framing
+"""
+
+import unittest
+
+from tests.common import instance
+
+from stitches import Connection
+from stitches.connection import _split_batch
+
+
+class SplitBatchTest(unittest.TestCase):
+    """ Parsing of framed output """
+    token = 'STITCHES_ABCDEFGHIJKLMNOP'
+
+    def framed(self, idx, data, status):
+        """ Output of one command as framed by the batch script """
+        return (('%s:%i:B\n' % (self.token, idx)).encode() + data +
+                ('\n%s:%i:E:%i\n' % (self.token, idx, status)).encode())
+
+    def test_commands(self):
+        data = self.framed(0, b'a\n', 0) + self.framed(1, b'', 3) + self.framed(2, b'x', 0)
+        self.assertEqual(_split_batch(data, self.token),
+                         {0: (b'a\n', 0), 1: (b'', 3), 2: (b'x', 0)})
+
+    def test_other_token(self):
+        # output looking like framing of another batch is kept
+        inner = self.framed(0, b'nested', 1).replace(b'ABCD', b'ZZZZ')
+        self.assertEqual(_split_batch(self.framed(0, inner, 0), self.token), {0: (inner, 0)})
+
+    def test_unterminated(self):
+        data = self.framed(0, b'done', 0) + ('%s:1:B\n' % self.token).encode() + b'partial'
+        self.assertEqual(_split_batch(data, self.token), {0: (b'done', 0), 1: (b'partial', None)})
+
+
+class RunBatchTest(unittest.TestCase):
+    """ Batches executed on the host """
+    def setUp(self):
+        self.connection = Connection(instance())
+
+    def tearDown(self):
+        self.connection.disconnect()
+
+    def test_results(self):
+        results = self.connection.run_batch(['echo a', 'echo b >&2; exit 3', 'printf x', 'cd /; pwd'])
+        self.assertEqual([(res.status, res.stdout, res.stderr) for res in results],
+                         [(0, b'a\n', b''), (3, b'', b'b\n'), (0, b'x', b''), (0, b'/\n', b'')])
+
+    def test_subshells(self):
+        results = self.connection.run_batch(['cd /tmp; exit 1', 'pwd', 'read line; echo $?'])
+        self.assertNotEqual(results[1].stdout, b'/tmp\n')
+        # stdin is /dev/null
+        self.assertEqual(results[2].stdout, b'1\n')
+
+    def test_stop_on_error(self):
+        results = self.connection.run_batch(['true', 'false', 'echo never'], stop_on_error=True)
+        self.assertEqual([res.status for res in results], [0, 1])
+
+    def test_timeout(self):
+        results = self.connection.run_batch(['echo a', 'sleep 10', 'echo b'], timeout=1)
+        self.assertEqual([res.status for res in results], [0, None])
+        self.assertEqual(results[0].stdout, b'a\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
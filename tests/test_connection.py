@@ -0,0 +1,145 @@
+"""
+Tests of L{Connection} against the local server
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tests.common import instance
+
+from stitches import Connection, ReplayConnection
+from stitches.pool import TransportPool
+
+
+class ConnectionTest(unittest.TestCase):
+    """ Command execution """
+    def setUp(self):
+        self.connection = Connection(instance())
+
+    def tearDown(self):
+        self.connection.disconnect()
+
+    def test_run(self):
+        result = self.connection.run('echo out; echo err >&2; exit 3')
+        self.assertEqual((result.status, result.stdout, result.stderr), (3, b'out\n', b'err\n'))
+
+    def test_timeout_output_type(self):
+        result = self.connection.run('echo out; sleep 10', timeout=1)
+        self.assertIsNone(result.status)
+        self.assertEqual((result.stdout, result.stderr), (b'', b''))
+
+    def test_callback(self):
+        chunks = []
+        status = self.connection.recv_exit_status('echo a; sleep 0.5; echo b >&2', 10,
+                                                  callback=lambda name, data: chunks.append((name, data)))
+        self.assertEqual(status, 0)
+        self.assertEqual(chunks, [('stdout', b'a\n'), ('stderr', b'b\n')])
+
+    def test_reconnect_dead(self):
+        self.assertEqual(self.connection.recv_exit_status('true'), 0)
+        sftp = self.connection.sftp
+        self.connection.cli.get_transport().close()
+        self.assertEqual(self.connection.state, 'dead')
+        # channels of the dead transport are replaced
+        self.assertIsNot(self.connection.sftp, sftp)
+        self.assertTrue(self.connection.sftp.listdir('/'))
+        self.assertEqual(self.connection.recv_exit_status('true'), 0)
+
+
+class AgentTest(unittest.TestCase):
+    """ Commands executed through the remote agent """
+    def setUp(self):
+        self.connection = Connection(instance(), use_agent=True)
+
+    def tearDown(self):
+        self.connection.disconnect()
+
+    def test_run(self):
+        result = self.connection.run('echo out; echo err >&2; exit 3')
+        self.assertIsNotNone(self.connection.agent)
+        self.assertEqual((result.status, result.stdout, result.stderr), (3, b'out\n', b'err\n'))
+
+    def test_streaming(self):
+        chunks = []
+        start = time.time()
+        status = self.connection.recv_exit_status(
+            'echo a; sleep 1; echo b', 10,
+            callback=lambda name, data: chunks.append((time.time() - start, name, data)))
+        self.assertEqual(status, 0)
+        self.assertEqual([(name, data) for _, name, data in chunks], [('stdout', b'a\n'), ('stdout', b'b\n')])
+        # the first chunk arrived before the command finished
+        self.assertLess(chunks[0][0], chunks[1][0] - 0.5)
+
+    def test_tail(self):
+        self.connection.tail_size = 1000
+        self.assertEqual(self.connection.recv_exit_status('head -c 100000 /dev/zero'), 0)
+        self.assertEqual(self.connection.last_stdout, b'\0' * 1000)
+
+    def test_timeout(self):
+        self.assertIsNone(self.connection.recv_exit_status('sleep 10', 1))
+        self.assertEqual(self.connection.recv_exit_status('true'), 0)
+
+
+class RecordingTest(unittest.TestCase):
+    """ Recorded sessions replay offline """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, name):
+        """ Record and replay a few commands """
+        path = os.path.join(self.tmpdir, name)
+        connection = Connection(instance(), record=path)
+        commands = ['echo line%i; echo err%i >&2; exit %i' % (idx, idx, idx % 3) for idx in range(5)]
+        recorded = [connection.run(command) for command in commands]
+        # complete without closing the recorder
+        connection.disconnect()
+        replayed = ReplayConnection(path)
+        for result in recorded:
+            res = replayed.run(result.command)
+            self.assertEqual((res.status, res.stdout, res.stderr),
+                             (result.status, result.stdout, result.stderr))
+        replayed.disconnect()
+        connection.recorder.close()
+
+    def test_plain(self):
+        self.check('session.jsonl')
+
+    def test_compressed(self):
+        self.check('session.jsonl.gz')
+
+
+class PoolTest(unittest.TestCase):
+    """ Pooled transports """
+    def test_idle_reaper(self):
+        pool = TransportPool(idle_timeout=0.5)
+        connections = [Connection(instance(), pool=pool) for _ in range(2)]
+        try:
+            for connection in connections:
+                self.assertEqual(connection.recv_exit_status('true'), 0)
+            self.assertEqual([len(entries) for entries in pool.entries.values()], [1])
+        finally:
+            for connection in connections:
+                connection.disconnect()
+        # closed without further pool calls
+        time.sleep(1.5)
+        self.assertEqual(pool.entries, {})
+
+    def test_key_list(self):
+        pool = TransportPool()
+        params = instance()
+        connection = Connection(params, key_filename=[params.pop('key_filename')], pool=pool)
+        try:
+            self.assertEqual(connection.recv_exit_status('true'), 0)
+        finally:
+            connection.disconnect()
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Tests of incremental matching and L{Expect.expect_many}
+"""
+
+import re
+import unittest
+
+from tests.common import instance
+
+from stitches import Connection, Expect
+from stitches.expect import SEARCH_WINDOW, ExpectFailed, _Matcher, _max_width
+
+
+class MatcherTest(unittest.TestCase):
+    """ Matching of output fed in chunks """
+    def feed(self, matcher, chunks):
+        """ Feed chunks, return the first match """
+        for chunk in chunks:
+            matcher.feed(chunk)
+            result = matcher.match()
+            if result is not None:
+                return result
+        return None
+
+    def test_search_across_chunks(self):
+        matcher = _Matcher([(re.compile('needle'), True)], search=True)
+        result = self.feed(matcher, [b'hay ne', b'ed', b'le hay'])
+        self.assertEqual(result[0].group(0), 'needle')
+
+    def test_unbounded_pattern_beyond_window(self):
+        # START.*END spanning more than the search window
+        matcher = _Matcher([(re.compile('START.*END', re.DOTALL), True)], search=True)
+        self.assertIsNone(matcher.window)
+        chunks = [b'START'] + [b'x' * 1024] * (SEARCH_WINDOW // 1024 + 2) + [b'END']
+        self.assertIsNotNone(self.feed(matcher, chunks))
+
+    def test_bounded_pattern_window(self):
+        matcher = _Matcher([(re.compile('abc'), 1), (re.compile('[0-9]{3}'), 2)], search=True)
+        self.assertEqual(matcher.window, 3)
+        result = self.feed(matcher, [b'x' * 10000, b'a', b'b', b'c'])
+        self.assertEqual(result[1], 1)
+
+    def test_first_expression_wins(self):
+        matcher = _Matcher([('.*foo', 'first'), ('.*fo', 'second')])
+        self.assertEqual(self.feed(matcher, [b'xfoo'])[1], 'first')
+
+    def test_match_anchored(self):
+        matcher = _Matcher([('prompt', True)])
+        self.assertIsNone(self.feed(matcher, [b'xx prompt']))
+
+    def test_split_utf8(self):
+        matcher = _Matcher([(re.compile(u'\u017e'), True)], search=True)
+        data = u'\u017e'.encode('utf-8')
+        self.assertIsNotNone(self.feed(matcher, [data[:1], data[1:]]))
+
+    def test_transcript_limit(self):
+        matcher = _Matcher([('never', True)], search=True, limit=100)
+        self.feed(matcher, [b'x' * 1000, b'y' * 10])
+        self.assertEqual(len(matcher.transcript), 100)
+        self.assertTrue(matcher.transcript.endswith('y' * 10))
+
+    def test_max_width(self):
+        self.assertEqual(_max_width([re.compile('ab?c')]), 3)
+        self.assertIsNone(_max_width([re.compile('a.*')]))
+        self.assertIsNone(_max_width([re.compile('a{%i}' % (SEARCH_WINDOW + 1))]))
+
+
+class ExpectManyTest(unittest.TestCase):
+    """ Waiting for output of several shells """
+    def setUp(self):
+        self.connections = [Connection(instance()) for _ in range(3)]
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.disconnect()
+
+    def enter(self, idx, delay=0):
+        """ Make shell idx print 'ready<idx>' (not part of the echoed command) """
+        Expect.enter(self.connections[idx], 'sleep %s; echo rea""dy%i' % (delay, idx))
+
+    def test_all(self):
+        for idx in range(3):
+            self.enter(idx)
+        targets = [(connection, 'ready%i' % idx) for idx, connection in enumerate(self.connections)]
+        matches = Expect.expect_many(targets, timeout=10)
+        self.assertEqual(sorted(self.connections.index(connection) for connection, _ in matches),
+                         [0, 1, 2])
+
+    def test_first(self):
+        self.enter(0, 5)
+        self.enter(1)
+        targets = [(self.connections[0], 'ready0'), (self.connections[1], [('ready1', 'one')])]
+        self.assertEqual(Expect.expect_many(targets, timeout=4, mode='first'),
+                         [(self.connections[1], 'one')])
+
+    def test_timeout(self):
+        self.enter(0)
+        targets = [(self.connections[0], 'ready0'), (self.connections[1], 'never')]
+        self.assertRaises(ExpectFailed, Expect.expect_many, targets, 1)
+
+    def test_iter_many_order(self):
+        self.enter(0, 1)
+        self.enter(1)
+        targets = [(self.connections[0], 'ready0'), (self.connections[1], 'ready1')]
+        order = [connection for connection, _ in Expect.iter_many(targets, timeout=10)]
+        self.assertEqual(order, [self.connections[1], self.connections[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
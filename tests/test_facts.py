@@ -0,0 +1,101 @@
+"""
+Tests of cached facts and their invalidation
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests.common import instance
+
+from stitches import Connection
+from stitches.connection import CommandResult
+from stitches.facts import FACTS, MUTATING, FactCache
+
+
+class FactCacheTest(unittest.TestCase):
+    """ Cache without a host """
+    def setUp(self):
+        self.cache = FactCache(ttl=60, size=3)
+        self.cache.put('uname -r', CommandResult('host', 'uname -r', 0, b'5.0\n'))
+
+    def test_expiration(self):
+        self.cache.put('hostname', CommandResult('host', 'hostname', 0), ttl=-1)
+        self.assertIsNone(self.cache.get('hostname'))
+        self.assertEqual(self.cache.get('uname -r').stdout, b'5.0\n')
+
+    def test_size(self):
+        for command in ('a', 'b', 'c'):
+            self.cache.put(command, CommandResult('host', command, 0))
+        self.assertIsNone(self.cache.get('uname -r'))
+        self.assertEqual(len(self.cache), 3)
+
+    def test_unknown_commands_invalidate(self):
+        for command in ('touch /x', 'mkdir /x', 'kill 1', 'pip install x', './script', 'ls'):
+            self.cache.put('uname -r', CommandResult('host', 'uname -r', 0))
+            self.assertTrue(self.cache.observe(command), command)
+            self.assertEqual(len(self.cache), 0)
+
+    def test_probes_keep_cache(self):
+        self.assertFalse(self.cache.observe(FACTS['kernel']))
+        self.assertFalse(self.cache.observe(FACTS['packages']))
+        with self.cache.probing():
+            self.assertFalse(self.cache.observe('test -f /x'))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_best_effort(self):
+        cache = FactCache(mutating=MUTATING)
+        for command in ('touch /x', 'truncate -s 0 /x', 'pkill httpd', 'modprobe dummy',
+                        'firewall-cmd --reload', 'passwd -l user', 'sh -c true', 'echo 1 > /x',
+                        'yum -y install httpd', 'rpm -e httpd'):
+            cache.put('uname -r', CommandResult('host', 'uname -r', 0))
+            self.assertTrue(cache.observe(command), command)
+        for command in ('cat /etc/passwd', 'rpm -q httpd', 'grep x /y', 'echo 1 >/dev/null'):
+            cache.put('uname -r', CommandResult('host', 'uname -r', 0))
+            self.assertFalse(cache.observe(command), command)
+
+    def test_explicit_only(self):
+        cache = FactCache(mutating='(?!)')
+        cache.put('uname -r', CommandResult('host', 'uname -r', 0))
+        self.assertFalse(cache.observe('rm -rf /x'))
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+
+class ConnectionFactsTest(unittest.TestCase):
+    """ Facts of a connection to the local server """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.connection = Connection(instance())
+
+    def tearDown(self):
+        self.connection.disconnect()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_run(self):
+        path = os.path.join(self.tmpdir, 'x')
+        self.assertEqual(self.connection.cached_run('test -f %s' % path).status, 1)
+        self.assertEqual(self.connection.fact('arch'), os.uname()[4])
+        # served from the cache
+        self.assertEqual(self.connection.cached_run('test -f %s' % path).status, 1)
+        self.assertEqual(self.connection.metrics.counters['facts_hits'], 1)
+
+    def test_invalidation(self):
+        path = os.path.join(self.tmpdir, 'x')
+        self.assertEqual(self.connection.cached_run('test -f %s' % path).status, 1)
+        self.connection.recv_exit_status('touch %s' % path)
+        self.assertEqual(self.connection.cached_run('test -f %s' % path).status, 0)
+        self.connection.run('rm %s' % path)
+        self.assertEqual(self.connection.cached_run('test -f %s' % path).status, 1)
+
+    def test_prefetch(self):
+        self.connection.cached_run('echo cached')
+        facts = self.connection.prefetch_facts(['kernel', 'arch'])
+        self.assertEqual(facts['arch'], os.uname()[4])
+        self.assertEqual(len(self.connection.facts), 3)
+        self.assertEqual(self.connection.fact('kernel'), os.uname()[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+Tests of the YAML inventory loader and lazy connections of L{Structure}
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+from tests.common import instance
+
+from stitches import Structure
+from stitches.inventory import load_yaml
+
+CONFIG = """
+Instances:
+  - role: web
+    private_hostname: web1.example.com
+    public_hostname: web1.example.com
+    port: 2222
+    labels: {region: eu-west-1, canary: true}
+  - role: web
+    private_hostname: web2.example.com
+    public_hostname: web2.example.com
+    labels: {region: us-east-1}
+  - role: db
+    private_hostname: db1.example.com
+    public_hostname: db1.example.com
+    labels: {region: eu-west-1, canary: no}
+Config:
+  timeout: 1.5
+  retries: ~
+  name: '007'
+  ports: [22, "2222", 0x10]
+  when: 2020-01-01
+"""
+
+
+class LoadYamlTest(unittest.TestCase):
+    """ Event loader gives the same documents as the safe loader """
+    def check(self, document):
+        """ Compare with yaml.safe_load """
+        self.assertEqual(load_yaml(document), yaml.safe_load(document))
+
+    def test_config(self):
+        self.check(CONFIG)
+
+    def test_scalars(self):
+        self.check("a: [yes, No, off, 1e3, .inf, -0o17, '1', null, '', 12:30, 1_000]")
+
+    def test_anchors(self):
+        self.check("base: &base {user: root, port: 22}\nhosts: [*base, *base]")
+
+    def test_merge_keys(self):
+        # loaded by the regular loader
+        self.check("base: &base {user: root}\nhost: {<<: *base, port: 22}")
+
+    def test_empty(self):
+        self.assertIsNone(load_yaml(""))
+
+    def test_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'config.yaml')
+            with open(path, 'w') as fd:
+                fd.write("a: &x [1]\nb: {<<: {c: *x}}\n")
+            with open(path) as fd:
+                self.assertEqual(load_yaml(fd), {'a': [1], 'b': {'c': [1]}})
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class StructureInventoryTest(unittest.TestCase):
+    """ Instances loaded from YAML are connected on first use only """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'config.yaml')
+        with open(self.path, 'w') as fd:
+            fd.write(CONFIG)
+        self.structure = Structure()
+        self.structure.setup_from_yamlfile(self.path)
+
+    def tearDown(self):
+        self.structure.disconnect_all()
+        shutil.rmtree(self.tmpdir)
+
+    def test_setup(self):
+        self.assertEqual(sorted(self.structure.Instances), ['DB', 'WEB'])
+        self.assertEqual(len(self.structure.Instances['WEB']), 2)
+        self.assertEqual(self.structure.config['name'], '007')
+        self.assertEqual(self.structure._created(), [])
+
+    def test_select(self):
+        selected = self.structure.connections(selector='region=eu-west-1,role!=DB')
+        self.assertEqual([(role, connection.hostname) for role, connection in selected],
+                         [('WEB', 'web1.example.com')])
+        self.assertEqual([connection.hostname for _, connection in self.structure._created()],
+                         ['web1.example.com'])
+        self.assertEqual([connection.hostname for _, connection in
+                          self.structure.connections(selector='canary=false')], ['db1.example.com'])
+        self.assertEqual([connection.hostname for _, connection in
+                          self.structure.connections(selector='!canary')], ['web2.example.com'])
+        self.assertEqual(len(self.structure.connections(selector='role=WEB|DB,region!=us-east-1')), 2)
+        self.assertRaises(ValueError, self.structure.connections, selector='role=WEB,,')
+
+    def test_host(self):
+        connection = self.structure.host('web1.example.com')
+        self.assertEqual(connection.port, 2222)
+        self.assertRaises(KeyError, self.structure.host, 'web1.example.com', 'DB')
+
+    def test_reconnect_unused(self):
+        # instances which weren't used are neither created nor connected
+        self.assertEqual(self.structure.reconnect_all(timeout=1), {})
+        self.assertEqual(self.structure._created(), [])
+
+    def test_reconnect_used(self):
+        structure = Structure()
+        structure.add_instance('LOCAL', instance())
+        structure.add_instance('LOCAL', instance())
+        structure.add_instance('BROKEN', instance(private_hostname='127.0.0.1', port=1))
+        try:
+            connection = structure.Instances['LOCAL'][0]
+            self.assertEqual(connection.recv_exit_status('true'), 0)
+            self.assertEqual(structure.reconnect_all(), {})
+            self.assertEqual(connection.metrics.counters['reconnects'], 1)
+            self.assertEqual(len(structure._created()), 1)
+            broken = structure.Instances['BROKEN'][0]
+            self.assertRaises(Exception, broken.connect, 1)
+            failures = structure.reconnect_all(timeout=1, raise_on_failure=False)
+            self.assertEqual(list(failures), ['127.0.0.1'])
+        finally:
+            structure.disconnect_all()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+"""
+Tests of the key cache and of keys offered by L{Connection}
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import paramiko
+
+from tests.common import instance
+
+from stitches import Connection
+from stitches.keys import KeyCache
+
+
+class _AuthHandler(object):
+    """ Authentication state of the fake client """
+    def __init__(self, key):
+        self.private_key = key
+
+
+class _Transport(object):
+    """ Transport of the fake client """
+    def __init__(self, key):
+        self.auth_handler = _AuthHandler(key)
+
+
+class _Client(object):
+    """ SSH client accepting only one key, records the offered keys """
+    def __init__(self, accepted):
+        self.accepted = accepted
+        self.offered = []
+        self.transport = None
+
+    def connect(self, **kwargs):
+        """ Offer pkey, then the key files in order (like paramiko) """
+        if kwargs.get('pkey') is not None:
+            self.offered.append(kwargs['pkey'])
+        for path in kwargs.get('key_filename') or []:
+            self.offered.append(paramiko.RSAKey.from_private_key_file(path))
+        for key in self.offered:
+            if key.asbytes() == self.accepted.asbytes():
+                self.transport = _Transport(key)
+                return
+        raise paramiko.AuthenticationException("refused")
+
+    def get_transport(self):
+        """ Authenticated transport """
+        return self.transport
+
+
+class _KeysTest(unittest.TestCase):
+    """ Two key files and an empty cache """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        self.keys = []
+        for name in ('first', 'second'):
+            path = os.path.join(self.tmpdir, name)
+            key = paramiko.RSAKey.generate(1024)
+            key.write_private_key_file(path)
+            self.paths.append(path)
+            self.keys.append(key)
+        self.cache = KeyCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class KeyCacheTest(_KeysTest):
+    """ Key files and credentials """
+    def test_load(self):
+        key = self.cache.load(self.paths[0])
+        self.assertIs(self.cache.load(self.paths[0]), key)
+        # a changed file is parsed again
+        self.keys[1].write_private_key_file(self.paths[0])
+        os.utime(self.paths[0], (0, 0))
+        self.assertEqual(self.cache.load(self.paths[0]).asbytes(), self.keys[1].asbytes())
+
+    def test_identify(self):
+        self.assertEqual(self.cache.identify(self.keys[1], self.paths), self.paths[1])
+        self.assertIsNone(self.cache.identify(self.keys[1], self.paths[:1]))
+
+    def test_user_fallback(self):
+        self.cache.remember('a', 22, 'root', self.paths[0])
+        self.assertEqual(self.cache.credential('a', 22, 'root'), self.paths[0])
+        # only keys the connection offers anyway are used elsewhere
+        self.assertIsNone(self.cache.credential('b', 22, 'root'))
+        self.assertIsNone(self.cache.credential('b', 22, 'root', self.paths[1:]))
+        self.assertEqual(self.cache.credential('b', 22, 'root', self.paths), self.paths[0])
+        self.assertIsNone(self.cache.credential('b', 22, 'user', self.paths))
+
+    def test_forget(self):
+        self.cache.remember('a', 22, 'root', self.paths[0])
+        self.cache.forget('b', 22, 'root', self.paths[0])
+        self.assertIsNone(self.cache.credential('b', 22, 'root', self.paths))
+        self.assertEqual(self.cache.credential('a', 22, 'root'), self.paths[0])
+        self.cache.forget('a', 22, 'root')
+        self.assertIsNone(self.cache.credential('a', 22, 'root', self.paths))
+
+
+class AuthenticateTest(_KeysTest):
+    """ Keys offered by connections """
+    def connection(self, hostname, key_filename):
+        """ Connection using the test cache """
+        return Connection(instance(private_hostname=hostname, key_filename=key_filename),
+                          key_cache=self.cache)
+
+    def test_remembered(self):
+        self.connection('a', self.paths[::-1])._authenticate(_Client(self.keys[0]), 1)
+        self.assertEqual(self.cache.credential('a', instance()['port'], 'root'), self.paths[0])
+        # offered first next time
+        client = _Client(self.keys[0])
+        self.connection('a', self.paths[::-1])._authenticate(client, 1)
+        self.assertEqual(client.offered[0].asbytes(), self.keys[0].asbytes())
+
+    def test_not_leaked(self):
+        self.connection('a', self.paths[:1])._authenticate(_Client(self.keys[0]), 1)
+        # another host configured with a different key isn't offered the
+        # key which worked elsewhere
+        client = _Client(self.keys[1])
+        self.connection('b', self.paths[1:])._authenticate(client, 1)
+        self.assertEqual([key.asbytes() for key in client.offered], [self.keys[1].asbytes()])
+
+    def test_refused_forgotten(self):
+        port = instance()['port']
+        self.connection('a', self.paths)._authenticate(_Client(self.keys[0]), 1)
+        # the user-wide key goes first on another host offering it
+        client = _Client(self.keys[1])
+        self.connection('b', self.paths[::-1])._authenticate(client, 1)
+        self.assertEqual(client.offered[0].asbytes(), self.keys[0].asbytes())
+        self.assertEqual(self.cache.credential('b', port, 'root'), self.paths[1])
+        # a refused key isn't offered first again
+        self.cache.clear()
+        self.cache.remember('a', port, 'root', self.paths[0])
+        self.assertRaises(paramiko.AuthenticationException,
+                          self.connection('c', self.paths[:1])._authenticate,
+                          _Client(self.keys[1]), 1)
+        self.assertIsNone(self.cache.credential('d', port, 'root', self.paths))
+
+
+class ConnectTest(unittest.TestCase):
+    """ Connections to the local server """
+    def test_key_list(self):
+        cache = KeyCache()
+        params = instance()
+        connection = Connection(params, key_filename=[params.pop('key_filename')], key_cache=cache)
+        try:
+            self.assertEqual(connection.recv_exit_status('true'), 0)
+            self.assertEqual(cache.credential('127.0.0.1', connection.port, 'root'),
+                             os.path.abspath(connection.key_filename[0]))
+        finally:
+            connection.disconnect()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Tests of directory tree transfers
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from tests.common import instance
+
+from stitches import Connection
+from stitches.transfer import get_tree, put_tree
+
+
+class TreeTest(unittest.TestCase):
+    """ Trees copied through the local server """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'source')
+        self.target = os.path.join(self.tmpdir, 'target')
+        os.makedirs(os.path.join(self.source, 'sub', 'empty'))
+        self.write('small', b'x' * 10, 0o755)
+        self.write('sub/large', b'y' * 100000, 0o600)
+        os.symlink('small', os.path.join(self.source, 'link'))
+        os.symlink('missing', os.path.join(self.source, 'sub', 'dangling'))
+        self.connection = Connection(instance())
+
+    def tearDown(self):
+        self.connection.disconnect()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, relpath, data, mode=0o644):
+        """ Create file in the source tree """
+        path = os.path.join(self.source, relpath)
+        with open(path, 'wb') as fd:
+            fd.write(data)
+        os.chmod(path, mode)
+
+    def check(self, target):
+        """ Compare target tree with the source tree """
+        for relpath in ('small', 'sub/large'):
+            source, copy = os.path.join(self.source, relpath), os.path.join(target, relpath)
+            with open(source, 'rb') as fd1, open(copy, 'rb') as fd2:
+                self.assertEqual(fd1.read(), fd2.read())
+            self.assertEqual(stat.S_IMODE(os.stat(source).st_mode), stat.S_IMODE(os.stat(copy).st_mode))
+        self.assertTrue(os.path.isdir(os.path.join(target, 'sub', 'empty')))
+        self.assertEqual(os.readlink(os.path.join(target, 'link')), 'small')
+        self.assertEqual(os.readlink(os.path.join(target, 'sub', 'dangling')), 'missing')
+
+    def test_put(self):
+        result = put_tree(self.connection, self.source, self.target, small_file=1000)
+        self.check(self.target)
+        self.assertEqual(len(result.transferred), 4)
+        # nothing changed
+        result = put_tree(self.connection, self.source, self.target, small_file=1000)
+        self.assertEqual(result.transferred, [])
+        self.assertEqual(len(result.skipped), 4)
+
+    def test_get(self):
+        result = get_tree(self.connection, self.source, self.target, small_file=1000)
+        self.check(self.target)
+        self.assertEqual(len(result.transferred), 4)
+        result = get_tree(self.connection, self.source, self.target, small_file=1000)
+        self.assertEqual(result.transferred, [])
+
+    def test_changed(self):
+        put_tree(self.connection, self.source, self.target, small_file=1000)
+        # same size, different content
+        self.write('small', b'z' * 10, 0o755)
+        result = put_tree(self.connection, self.source, self.target, skip='size', small_file=1000)
+        self.assertEqual(result.transferred, [])
+        result = put_tree(self.connection, self.source, self.target, skip='checksum', small_file=1000)
+        self.assertEqual(result.transferred, ['small'])
+        self.check(self.target)
+
+    def test_changed_mode(self):
+        put_tree(self.connection, self.source, self.target, small_file=1000)
+        os.chmod(os.path.join(self.source, 'sub', 'large'), 0o640)
+        result = put_tree(self.connection, self.source, self.target, small_file=1000)
+        self.assertEqual(result.transferred, ['sub/large'])
+        self.check(self.target)
+        os.chmod(os.path.join(self.target, 'small'), 0o700)
+        result = get_tree(self.connection, self.source, self.target, small_file=1000)
+        self.assertEqual(result.transferred, ['small'])
+        self.check(self.target)
+
+    def test_replaced_link(self):
+        put_tree(self.connection, self.source, self.target, small_file=1000)
+        os.unlink(os.path.join(self.source, 'link'))
+        os.symlink('sub', os.path.join(self.source, 'link'))
+        result = put_tree(self.connection, self.source, self.target, small_file=1000)
+        self.assertEqual(result.transferred, ['link'])
+        self.assertEqual(os.readlink(os.path.join(self.target, 'link')), 'sub')
+
+
+if __name__ == '__main__':
+    unittest.main()